@@ -0,0 +1,290 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+# --- MEMORY ADMISSION & IDLE UNLOADING ---
+# Each run's peak memory above the idle baseline (VRAM with CUDA, RAM on the CPU)
+# is recorded, and a straight line peak ≈ a + b × megapixels × batch is fitted
+# to those runs by least squares, one line per setup (weights, offload strategy,
+# mode, tiled decode). Before a request runs, that line predicts what it needs:
+#   admit     - fits in the memory free right now
+#   queue     - fits once memory this process still holds is given back
+#   downscale - can never fit, but a smaller size with the same aspect ratio can
+#   reject    - not even the smallest size fits
+# A batch that doesn't fit is split. Until a setup has runs on record its
+# prediction is only a rough prior, which is trusted only where it was measured
+# (`use_prior`, on with CUDA); otherwise the first run is admitted as it is.
+# Downscaled sizes keep the margin below what is available, so they still fit
+# when the run starts. The idle policy releases the weights' VRAM
+# after a quiet period and reloads them on the next request from host copies.
+# Memory probes and the clock are passed in, so the predictor, the decisions and
+# the idle state machine can all be driven with fake readings.
+
+BYTES_PER_MEGAPIXEL = 2 * 1024**3  # Prior slope until a setup has runs at two sizes
+MARGIN = 0.15         # Headroom on top of every prediction
+MAX_SAMPLES = 64      # Runs kept per setup (the oldest are dropped)
+MIN_SIDE = 256        # Smallest side a request is downscaled to
+SIZE_STEP = 64        # Downscaled sizes are multiples of this
+
+
+def megapixels(width, height, batch=1):
+    return width * height * batch / 1e6
+
+
+class MemoryPredictor:
+    """Least-squares fit of peak bytes against megapixels × batch, per setup key.
+
+    Saved to `path` as JSON (if given) so calibration survives restarts.
+    """
+
+    def __init__(self, path=None, prior_slope=BYTES_PER_MEGAPIXEL, margin=MARGIN, max_samples=MAX_SAMPLES):
+        self.path = path
+        self.prior_slope = prior_slope
+        self.margin = margin
+        self.max_samples = max_samples
+        self.samples = {}  # key -> [[megapixels, peak bytes], ...]
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.samples = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Ignoring memory calibration {path}: {e}")
+
+    def observe(self, key, megapixels, peak_bytes):
+        with self._lock:
+            points = self.samples.setdefault(key, [])
+            points.append([round(megapixels, 4), int(max(0, peak_bytes))])
+            del points[:-self.max_samples]
+
+    def fit(self, key):
+        """(intercept, slope, rmse) in bytes, or None while `key` has no runs on record."""
+        with self._lock:
+            points = list(self.samples.get(key, ()))
+        if not points:
+            return None
+        n = len(points)
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        sxx = sum((x - mean_x) ** 2 for x, _ in points)
+        if sxx > 1e-6:
+            slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx)
+        else:
+            # Only one size so far: the prior slope through that point (flatter if it would cross zero)
+            slope = min(self.prior_slope, mean_y / mean_x) if mean_x > 0 else self.prior_slope
+        intercept = max(0.0, mean_y - slope * mean_x)
+        rmse = math.sqrt(sum((y - intercept - slope * x) ** 2 for x, y in points) / n)
+        return intercept, slope, rmse
+
+    def predict(self, key, megapixels):
+        """Peak bytes a run of `megapixels` (× batch) is expected to need, with headroom."""
+        intercept, slope, rmse = self.fit(key) or (0.0, self.prior_slope, 0.0)
+        return int((intercept + slope * megapixels) * (1 + self.margin) + 2 * rmse)
+
+    def calibrated(self, key):
+        with self._lock:
+            return bool(self.samples.get(key))
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self.samples)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Could not save memory calibration: {e}")
+
+
+class AdmissionController:
+    """Decides what happens to a request of a given size before it runs.
+
+    `probe()` returns (free, reclaimable) bytes: memory free right now, and memory
+    this process holds that comes back once its current work is done. `extra` is
+    memory needed on top of the run itself (e.g. weights that must be reloaded).
+    With `use_prior=False` a setup with no runs on record is always admitted.
+    """
+
+    def __init__(self, predictor, probe, min_side=MIN_SIDE, step=SIZE_STEP, clock=time.monotonic, sleep=time.sleep,
+                 use_prior=True):
+        self.predictor = predictor
+        self.probe = probe
+        self.use_prior = use_prior
+        self.min_side = min_side
+        self.step = step
+        self.clock = clock
+        self.sleep = sleep
+        self.decisions = {"admit": 0, "queue": 0, "downscale": 0, "reject": 0}
+
+    def need(self, key, width, height, batch=1, extra=0):
+        return self.predictor.predict(key, megapixels(width, height, batch)) + extra
+
+    def trusted(self, key):
+        """Whether predictions for `key` are good enough to act on."""
+        return self.use_prior or self.predictor.calibrated(key)
+
+    def decide(self, key, width, height, batch=1, extra=0, downscale=True):
+        """Returns {"action", "width", "height", "need", "free", "available"}; with
+        `downscale=False` requests that can never fit are rejected instead."""
+        need = self.need(key, width, height, batch, extra)
+        free, reclaimable = self.probe()
+        available = free + reclaimable
+        if need <= free or not self.trusted(key):
+            action = "admit"
+        elif need <= available:
+            action = "queue"
+        else:
+            # Aim below what is available, so the smaller size still fits when it runs
+            budget = available * (1 - self.predictor.margin) - extra
+            size = self.fit_size(key, width, height, batch, budget) if downscale else None
+            action = "downscale" if size else "reject"
+            if size:
+                width, height = size
+        self.decisions[action] += 1
+        return {"action": action, "width": width, "height": height, "need": need, "free": free,
+                "available": available}
+
+    def fit_size(self, key, width, height, batch, budget):
+        """Largest (width, height) with the same aspect ratio whose prediction fits `budget`, or None."""
+        longest = max(width, height)
+        for side in range(longest // self.step * self.step, self.min_side - 1, -self.step):
+            scale = side / longest
+            w = max(self.step, int(width * scale) // self.step * self.step)
+            h = max(self.step, int(height * scale) // self.step * self.step)
+            if (w, h) != (width, height) and self.predictor.predict(key, megapixels(w, h, batch)) <= budget:
+                return w, h
+        return None
+
+    def max_batch(self, key, width, height, batch, extra=0):
+        """How many requests of a batch fit at once (at least 1, the rest run after)."""
+        if not self.trusted(key):
+            return batch
+        free, reclaimable = self.probe()
+        for n in range(batch, 1, -1):
+            if self.need(key, width, height, n, extra) <= free + reclaimable:
+                return n
+        return 1
+
+    def wait(self, key, width, height, batch=1, extra=0, timeout=60, cancelled=None, poll=0.5):
+        """Waits until the run fits in free memory; False on timeout, once `cancelled()`, or
+        straight away when this process holds nothing it could give back."""
+        if not self.trusted(key):
+            return True
+        need = self.need(key, width, height, batch, extra)
+        deadline = self.clock() + timeout
+        while True:
+            free, reclaimable = self.probe()
+            if need <= free + reclaimable:
+                return True
+            if not reclaimable or self.clock() >= deadline or (cancelled is not None and cancelled()):
+                return False
+            self.sleep(poll)
+
+
+class RssPeak:
+    """Step-end callback tracking the process's peak RSS (runs on the CPU have no VRAM counter)."""
+
+    def __init__(self):
+        self._process = psutil.Process()
+        self.baseline = self._process.memory_info().rss
+        self.peak = self.baseline
+
+    def sample(self):
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        self.sample()
+        return callback_kwargs
+
+
+class IdlePolicy:
+    """loaded → (idle `timeout` seconds) → unloaded → (next run) → reloading → loaded.
+
+    Runs are wrapped in `active()`. `unload()` may return False when it can't run
+    right now; the next `tick()` tries again. A timeout of 0 never unloads.
+    """
+
+    def __init__(self, unload, reload, timeout=0, clock=time.monotonic):
+        self.unload = unload
+        self.reload = reload
+        self.timeout = timeout
+        self.clock = clock
+        self.state = "loaded"
+        self.busy = 0
+        self.last_used = clock()
+        self.unloads = 0
+        self.reload_seconds = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def acquire(self):
+        """Marks a run as started, reloading released weights first."""
+        with self._lock:
+            if self.state == "unloaded":
+                self.state = "reloading"
+                started = self.clock()
+                try:
+                    self.reload()
+                except Exception:
+                    self.state = "unloaded"
+                    raise
+                self.reload_seconds = self.clock() - started
+                self.state = "loaded"
+            self.busy += 1
+
+    def release(self):
+        with self._lock:
+            self.busy -= 1
+            self.last_used = self.clock()
+
+    @contextmanager
+    def active(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def reset(self):
+        """The weights were placed again from outside (reload, new offload strategy)."""
+        with self._lock:
+            self.state = "loaded"
+            self.last_used = self.clock()
+
+    def tick(self):
+        """Unloads once idle for `timeout` seconds; True if it did."""
+        with self._lock:
+            if not self.timeout or self.state != "loaded" or self.busy:
+                return False
+            if self.clock() - self.last_used < self.timeout:
+                return False
+            self.state = "unloading"
+            try:
+                done = bool(self.unload())
+            except Exception as e:
+                print(f"❌ Releasing idle weights failed: {e}")
+                done = False
+            self.state = "unloaded" if done else "loaded"
+            self.unloads += done
+            return done
+
+    def start(self, interval=5.0):
+        """Ticks on a background thread (once per process)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, args=(interval,), name="idle-unload", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def _loop(self, interval):
+        while True:
+            time.sleep(interval)
+            self.tick()
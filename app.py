@@ -1,141 +1,340 @@
-import gradio as gr
-import torch
-import numpy as np
-from diffusers import Flux2KleinPipeline
+import argparse
 import os
-import psutil
+import subprocess
+import sys
+import threading
 import time
-from huggingface_hub import snapshot_download
 
-# --- CONFIGURATION ---
-MODEL_ID = "black-forest-labs/FLUX.2-klein-4B"
-LOCAL_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache")
-OUTPUT_DIR = "outputs"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# --- COMMAND LINE ---
+# Parsed before Gradio is imported so --help answers instantly.
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FLUX.2 Klein 4B local GUI.")
+    parser.add_argument("--stub", action="store_true", help="Serve the UI with the CPU stub pipeline (no model)")
+    parser.add_argument("--no-browser", action="store_true", help="Don't open a browser tab on start")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Port of the /metrics endpoint (0 = off)")
+    parser.add_argument("--trace-dir", default=None, help="Write a JSON trace per request into this folder")
+    parser.add_argument("--no-tracing", action="store_true", help="Disable per-stage latency tracing")
+    parser.add_argument("--quantization", choices=("bf16", "int8", "fp8", "int4"), default=None,
+                        help="Weight precision of the transformer and text encoder (default: bf16)")
+    parser.add_argument("--compile", action="store_true",
+                        help="torch.compile the transformer for fixed resolution buckets (warms up in the background)")
+    parser.add_argument("--consolidate", action="store_true",
+                        help="Convert the weights once to page-aligned files and memory-map them on start")
+    parser.add_argument("--verify-model", action="store_true",
+                        help="Hash every model file on start instead of only new or changed ones")
+    parser.add_argument("--idle-unload", type=float, default=None, metavar="MINUTES",
+                        help="Release the weights' VRAM after this many idle minutes (reloaded on the next request)")
+    parser.add_argument("--workers", nargs="?", const="auto", default=None,
+                        help="Run the model in worker processes: 'auto' (per GPU memory) or devices like cuda:0,cuda:1")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    ARGS = parse_args()
+
+import gradio as gr
+import engine
+if __name__ == "__main__":
+    engine.QUANTIZATION = ARGS.quantization or engine.QUANTIZATION
+    engine.COMPILE_ENABLED = ARGS.compile or engine.COMPILE_ENABLED
+    engine.MODEL_FORMAT = "consolidated" if ARGS.consolidate else engine.MODEL_FORMAT
+    engine.VERIFY_MODEL = "full" if ARGS.verify_model else engine.VERIFY_MODEL
+    engine.IDLE_UNLOAD_MINUTES = engine.IDLE_UNLOAD_MINUTES if ARGS.idle_unload is None else ARGS.idle_unload
+from engine import OUTPUT_DIR, BATCH_MAX_SIZE
+from batching import PRIORITY_BATCH, GenerationCancelled
+from offload import STRATEGIES
+from grid import AXES, contact_sheet, parse_values, plan_grid, run_grid
+from metrics import start_metrics_server
+from PIL import Image
+from system_monitor import SystemSampler, sparkline_svg
 
 # --- GLOBAL VARIABLES ---
-pipe = None
+system_monitor = SystemSampler(interval=1.0, history=60)
+active_requests = {}  # Browser session -> requests it is waiting for (for the Cancel button)
+active_lock = threading.Lock()
 
 # --- FUNCTIONS ---
 
 def shutdown_server():
     """Kill switch to stop the script."""
     print("Shutting down...")
+    engine.output_writer.close()  # Flush images that are still being written
+    if engine.worker_pool is not None:
+        engine.worker_pool.close(timeout=5)  # os._exit skips multiprocessing's own cleanup
     os._exit(0)
 
 def open_output_folder():
-    """Opens the output folder in Windows Explorer."""
+    """Opens the output folder in the system file manager."""
     path = os.path.abspath(OUTPUT_DIR)
-    os.startfile(path)
+    try:
+        if sys.platform == "win32":
+            os.startfile(path)
+        elif sys.platform == "darwin":
+            subprocess.Popen(["open", path])
+        else:
+            subprocess.Popen(["xdg-open", path])
+    except Exception as e:
+        print(f"❌ Could not open {path}: {e}")
+
+PILL = (
+    "display:inline-flex; align-items:center; gap:6px; "
+    "padding:6px 14px; border-radius:20px; font-size:13px; "
+    "font-family:-apple-system,BlinkMacSystemFont,'SF Pro Display','Segoe UI',sans-serif; "
+    "font-weight:600; letter-spacing:0.2px; "
+    "background:rgba(255,255,255,0.06); "
+    "backdrop-filter:blur(12px); -webkit-backdrop-filter:blur(12px); "
+    "border:1px solid rgba(255,255,255,0.08); "
+    "box-shadow:0 2px 8px rgba(0,0,0,0.15)"
+)
+
+def render_system_stats(sampler):
+    """System Monitor (CPU/RAM/VRAM/GPU) with HTML Styling and sparklines."""
+    stats = sampler.snapshot() or {}
+    cpu = stats.get("cpu")
+    ram = stats.get("ram")
+    cpu_display = "N/A" if cpu is None else f"{cpu:.0f}%"
+    ram_display = "N/A" if ram is None else f"{ram:.0f}%"
 
-def get_system_stats():
-    """System Monitor (CPU/RAM/VRAM) with HTML Styling."""
-    cpu = psutil.cpu_percent(interval=None)
-    ram = psutil.virtual_memory().percent
-    
     vram_display = "N/A"
-    if torch.cuda.is_available():
-        free, total = torch.cuda.mem_get_info()
-        used = total - free
-        used_gb = used / (1024**3)
-        total_gb = total / (1024**3)
-        percent = (used / total) * 100
+    vram_used, vram_total = stats.get("vram_used"), stats.get("vram_total")
+    if vram_used is not None and vram_total:
+        used_gb = vram_used / (1024**3)
+        total_gb = vram_total / (1024**3)
+        percent = (vram_used / vram_total) * 100
         vram_display = f"{used_gb:.1f}GB / {total_gb:.1f}GB ({percent:.0f}%)"
-    
-    pill = (
-        "display:inline-flex; align-items:center; gap:6px; "
-        "padding:6px 14px; border-radius:20px; font-size:13px; "
-        "font-family:-apple-system,BlinkMacSystemFont,'SF Pro Display','Segoe UI',sans-serif; "
-        "font-weight:600; letter-spacing:0.2px; "
-        "background:rgba(255,255,255,0.06); "
-        "backdrop-filter:blur(12px); -webkit-backdrop-filter:blur(12px); "
-        "border:1px solid rgba(255,255,255,0.08); "
-        "box-shadow:0 2px 8px rgba(0,0,0,0.15)"
-    )
+    peak = sampler.last_peak
+    peak_display = f" · peak {peak['vram'] / (1024**3):.1f}GB" if peak else ""
+
+    gpu_pill = ""
+    if stats.get("gpu_util") is not None:
+        gpu_pill = f"""
+        <span style="{PILL}; color:#f472b6;">
+            <span style="width:8px;height:8px;border-radius:50%;background:#f472b6;box-shadow:0 0 8px rgba(244,114,182,0.5);display:inline-block;"></span>
+            GPU {stats['gpu_util']}% · {stats['gpu_temp']}°C
+            {sparkline_svg(sampler.series("gpu_util"), "#f472b6", maximum=100)}
+        </span>"""
+
+    state = engine.load_state
+    if state["state"] == "ready" and engine.idle.state == "unloaded":
+        model_color, model_display = "#94a3b8", "Model Idle (VRAM released)"
+    elif state["state"] == "ready":
+        model_color, model_display = "#92FE9D", "Model Ready"
+    elif state["state"] == "error":
+        model_color, model_display = "#f87171", "Model Error"
+    else:
+        model_color, model_display = "#fbbf24", f"{state['detail']} {state['progress'] * 100:.0f}%"
     return f"""
     <div style="display:flex; gap:10px; align-items:center; justify-content:flex-end; flex-wrap:wrap;">
-        <span style="{pill}; color:#60a5fa;">
+        <span style="{PILL}; color:{model_color};" title="{state['detail']}">
+            <span style="width:8px;height:8px;border-radius:50%;background:{model_color};box-shadow:0 0 8px {model_color};display:inline-block;"></span>
+            {model_display}
+        </span>
+        <span style="{PILL}; color:#60a5fa;">
             <span style="width:8px;height:8px;border-radius:50%;background:#60a5fa;box-shadow:0 0 8px rgba(96,165,250,0.5);display:inline-block;"></span>
-            CPU {cpu}%
+            CPU {cpu_display}
+            {sparkline_svg(sampler.series("cpu"), "#60a5fa", maximum=100)}
         </span>
-        <span style="{pill}; color:#a78bfa;">
+        <span style="{PILL}; color:#a78bfa;">
             <span style="width:8px;height:8px;border-radius:50%;background:#a78bfa;box-shadow:0 0 8px rgba(167,139,250,0.5);display:inline-block;"></span>
-            RAM {ram}%
+            RAM {ram_display}
+            {sparkline_svg(sampler.series("ram"), "#a78bfa", maximum=100)}
         </span>
-        <span style="{pill}; color:#34d399;">
+        <span style="{PILL}; color:#34d399;">
             <span style="width:8px;height:8px;border-radius:50%;background:#34d399;box-shadow:0 0 8px rgba(52,211,153,0.5);display:inline-block;"></span>
-            VRAM {vram_display}
-        </span>
+            VRAM {vram_display}{peak_display}
+            {sparkline_svg(sampler.series("vram_used"), "#34d399", maximum=vram_total, marker=peak and peak["vram"])}
+        </span>{gpu_pill}
     </div>
     """
 
-# --- LOAD MODEL ---
-def load_model():
-    global pipe
-    try:
-        # Download directly into local folder (portable, no ~/.cache/huggingface used)
-        if not os.path.exists(os.path.join(LOCAL_MODEL_DIR, "model_index.json")):
-            print(f"⏳ Downloading {MODEL_ID} to {LOCAL_MODEL_DIR} (first time only)...")
-            snapshot_download(repo_id=MODEL_ID, local_dir=LOCAL_MODEL_DIR)
-        print(f"⏳ Loading model from {LOCAL_MODEL_DIR}...")
-        pipe = Flux2KleinPipeline.from_pretrained(LOCAL_MODEL_DIR, torch_dtype=torch.bfloat16)
-        pipe.enable_model_cpu_offload()
-        print("✅ Model loaded successfully!")
-        return "Ready"
-    except Exception as e:
-        print(f"❌ Loading error: {e}")
-        return f"Error: {e}"
+def get_system_stats():
+    """Shared snapshot for every client; HTML is only rebuilt when the numbers change."""
+    state = engine.load_state
+    return system_monitor.render(
+        render_system_stats, extra_key=(state["state"], state["detail"], state["progress"], engine.idle.state)
+    )
 
-# --- GENERATE IMAGE ---
-def generate_image(prompt, input_image, width, height, steps, guidance, seed, strength):
-    global pipe
-    if pipe is None:
-        return None, "Error: Model not loaded!"
+def change_offload_strategy(strategy):
+    """Switches the offload strategy without restarting."""
+    return engine.set_offload_strategy(strategy)
+
+def change_quantization(mode):
+    """Reloads the model with the chosen weight precision and reports the savings."""
+    yield f"⏳ Reloading the model with {mode} weights..."
+    yield engine.set_quantization(mode)
+
+# --- CANCELLATION ---
+def track(client, *requests):
+    with active_lock:
+        active_requests.setdefault(client.session_hash, set()).update(requests)
+
+def untrack(client, *requests):
+    """Forgets finished requests; ones still running (the tab was closed) are cancelled."""
+    with active_lock:
+        tracked = active_requests.get(client.session_hash, set())
+        tracked.difference_update(requests)
+        if not tracked:
+            active_requests.pop(client.session_hash, None)
+    for request in requests:
+        if not request.future.done():
+            engine.cancel(request)
+
+def cancel_generation(client: gr.Request):
+    """Stops this tab's queued and running generations (within one denoising step)."""
+    with active_lock:
+        requests = active_requests.pop(client.session_hash, set())
+    for request in requests:
+        engine.cancel(request)
+    return "🛑 Cancelling..." if requests else "Nothing to cancel."
+
+def cancelled_status(error):
+    return "⏰ Deadline exceeded, generation stopped." if error.reason == "deadline" else "🛑 Cancelled."
 
+# --- GENERATE IMAGE ---
+def generate_image(prompt, input_image, width, height, steps, guidance, seed, strength, hires, refine,
+                   client: gr.Request):
+    """Streams progressive previews while denoising, then the final image."""
     if not prompt or not prompt.strip():
-        return None, "Error: Please enter a prompt!"
-
-    width, height, steps = int(width), int(height), int(steps)
+        yield None, "Error: Please enter a prompt!"
+        return
 
-    if seed == -1 or seed is None:
-        seed = torch.randint(0, 2**32, (1,)).item()
-    generator = torch.Generator("cuda").manual_seed(int(seed))
-
-    mode = "img2img" if input_image is not None else "txt2img"
-    print(f"🎨 Generating ({mode}): '{prompt}'")
-    
-    start_time = time.time()
+    started = system_monitor.clock()
+    request = base = None
     
     try:
-        with torch.inference_mode():
-            if input_image is not None:
-                # Image-to-Image: use strength to shorten the sigma schedule
-                full_sigmas = np.linspace(1.0, 1 / steps, steps)
-                start = int(round(steps * (1 - strength)))
-                sigmas = full_sigmas[start:]
-                image = pipe(
-                    prompt=prompt, image=input_image, height=height, width=width,
-                    sigmas=sigmas.tolist(), num_inference_steps=steps, guidance_scale=guidance,
-                    generator=generator, max_sequence_length=512
-                ).images[0]
-            else:
-                # Text-to-Image Generation
-                image = pipe(
-                    prompt=prompt, height=height, width=width,
-                    num_inference_steps=steps, guidance_scale=guidance,
-                    generator=generator, max_sequence_length=512
-                ).images[0]
-
-        elapsed_time = time.time() - start_time
-        timestamp = int(time.time())
-        image.save(f"{OUTPUT_DIR}/flux2_{timestamp}_{int(seed)}.png")
-        torch.cuda.empty_cache()
-
-        return image, f"✅ Done! Seed: {seed} ({elapsed_time:.2f}s)"
-
+        request = engine.make_request(prompt, input_image, width, height, steps, guidance, seed, strength, hires)
+        track(client, request)
+        if refine and request.hires:
+            # Compose at the base size first, then upscale and refine at full size
+            base = engine.base_request(request)
+            track(client, base)
+            for kind, image, info in engine.generate_stream(base):
+                if kind == "preview":
+                    step, total = info
+                    yield image, f"⏳ Base pass {base.width}x{base.height}: step {step}/{total}..."
+            yield image, f"⏳ Upscaling to {request.width}x{request.height} and refining..."
+            if request.is_cancelled():
+                raise GenerationCancelled(request.cancel_reason)
+            untrack(client, request)
+            request = engine.refine_request(request, image)
+            track(client, request)
+
+        stage = "Refine" if refine and request.hires else "Step"
+        for kind, image, info in engine.generate_stream(request):
+            if kind == "preview":
+                step, total = info
+                yield image, f"⏳ {stage} {step}/{total}..."
+        elapsed_time = system_monitor.clock() - started
+        if request.cache_hit:
+            yield image, f"♻️ Done! Seed: {request.seed} (cached result, {elapsed_time:.2f}s)"
+            return
+        system_monitor.mark_generation(started, peak_vram=getattr(request.trace, "peak_vram", None))
+        engine.output_writer.submit(image, engine.output_params(request, elapsed_time))
+
+        cache = engine.prompt_cache.stats()
+        print(f"📝 Prompt cache: {cache['hits']} hits / {cache['misses']} misses")
+        batch_info = f", batch of {request.batch_size}" if request.batch_size > 1 else ""
+        if request.requested_size is not None:
+            sizes = request.sizes()
+            batch_info += f", requested {sizes['requested_size']}, admitted {sizes['admitted_size']} to fit memory"
+        yield image, f"✅ Done! Seed: {request.seed} ({elapsed_time:.2f}s{batch_info})"
+
+    except GenerationCancelled as e:
+        yield None, cancelled_status(e)
     except Exception as e:
-        torch.cuda.empty_cache()
+        yield None, f"❌ Error: {e}"
+    finally:
+        untrack(client, *[r for r in (base, request) if r is not None])
+
+def generate_grid(prompts_text, axis, values_text, input_image, width, height, steps, guidance, seed, strength,
+                  client: gr.Request):
+    """Runs every prompt against every value, streaming cells into the gallery."""
+    prompts = [p.strip() for p in (prompts_text or "").splitlines() if p.strip()]
+    if not prompts:
+        yield [], None, "Error: Please enter at least one prompt (one per line)!"
+        return
+
+    cells = []
+    finished = []
+    try:
+        values = parse_values(values_text, axis)
+        # Grid cells queue as batch work, so single images clicked meanwhile go first
+        cells = plan_grid(
+            engine.make_request, prompts, axis, values, input_image=input_image, width=width,
+            height=height, steps=steps, guidance=guidance, seed=seed, strength=strength,
+            priority=PRIORITY_BATCH
+        )
+        track(client, *(cell.request for cell in cells))
+        window = engine.max_batch(cells[0].request, BATCH_MAX_SIZE)
+        folder = f"grid_{time.strftime('%Y%m%d_%H%M%S')}"
+        extension = engine.output_writer.extension
+        started = time.time()
+        for cell in run_grid(engine.submit, cells, window, cancel=engine.cancel):
+            engine.output_writer.submit(
+                cell.image, engine.output_params(cell.request, cell.elapsed),
+                filename=os.path.join(folder, cell.filename(extension))
+            )
+            finished.append(cell)
+            gallery = [(c.image, f"{c.request.prompt[:40]} | {c.label}")
+                       for c in sorted(finished, key=lambda c: (c.row, c.col))]
+            yield gallery, cell.image, f"⏳ Cell {len(finished)}/{len(cells)} done..."
+
+        elapsed_time = time.time() - started
+        sheet = contact_sheet(cells, prompts, [f"{axis} {v}" for v in values])
+        engine.output_writer.submit(
+            sheet, {"prompts": prompts, "axis": axis, "values": values, "elapsed": round(elapsed_time, 3)},
+            filename=os.path.join(folder, "contact_sheet" + extension)
+        )
+        yield gallery, sheet, (
+            f"✅ Grid done! {len(cells)} cells in {elapsed_time:.1f}s "
+            f"({elapsed_time / len(cells):.2f}s per cell) → {folder}"
+        )
+
+    except GenerationCancelled as e:
+        gallery = [(c.image, f"{c.request.prompt[:40]} | {c.label}")
+                   for c in sorted(finished, key=lambda c: (c.row, c.col))]
+        yield gallery, None, f"{cancelled_status(e)} {len(finished)}/{len(cells)} cells finished."
+    except Exception as e:
+        yield [], None, f"❌ Error: {e}"
+    finally:
+        untrack(client, *(cell.request for cell in cells))
+
+# --- HISTORY ---
+def history_caption(row):
+    prompt = (row["prompt"] or "").strip()
+    seed = f" | seed {row['seed']}" if row["seed"] is not None else ""
+    return f"{prompt[:60]}{'…' if len(prompt) > 60 else ''}{seed}"
+
+def show_history(query, pages):
+    """Renders the last page in `pages` (a list of page-start cursors, None = newest)."""
+    rows, next_cursor = engine.history.page(query, pages[-1])
+    thumbs = engine.history.thumbnails(rows)
+    if next_cursor is not None:
+        engine.history.prefetch(engine.history.page(query, next_cursor)[0])
+    items = [(thumb, history_caption(row)) for row, thumb in zip(rows, thumbs) if thumb is not None]
+    shown = [row for row, thumb in zip(rows, thumbs) if thumb is not None]
+    status = f"Page {len(pages)} · {len(rows)} images" + ("" if next_cursor else " (last page)")
+    return items, status, pages, {"next": next_cursor, "rows": shown}
+
+def search_history(query):
+    return show_history(query, [None])
+
+def older_history(query, pages, page):
+    if page and page.get("next") is not None:
+        pages = pages + [page["next"]]
+    return show_history(query, pages)
+
+def newer_history(query, pages):
+    return show_history(query, pages[:-1] or [None])
+
+def select_history(page, evt: gr.SelectData):
+    """Opens a history entry in the result view with its settings in the status line."""
+    row = page["rows"][evt.index]
+    try:
+        image = Image.open(row["path"])
+    except OSError as e:
         return None, f"❌ Error: {e}"
+    settings = ", ".join(f"{key} {row[key]}" for key in ("seed", "steps", "guidance", "strength") if row[key] is not None)
+    return image, f"🕘 {row['prompt'] or ''} ({row['width']}x{row['height']}, {settings}) → {row['path']}"
 
 # --- GUI CSS ---
 custom_css = """
@@ -479,8 +678,12 @@ with gr.Blocks(title="Flux.2 Klein GUI") as demo:
             # Advanced Settings (Collapsed by default to save space)
             with gr.Accordion("⚙️ Advanced Settings", open=True):
                 with gr.Row():
-                    width = gr.Slider(512, 2048, value=1024, step=64, label="Width")
-                    height = gr.Slider(512, 2048, value=1024, step=64, label="Height")
+                    width = gr.Slider(512, engine.HIRES_MAX_RESOLUTION, value=1024, step=64, label="Width")
+                    height = gr.Slider(512, engine.HIRES_MAX_RESOLUTION, value=1024, step=64, label="Height")
+
+                with gr.Row():
+                    hires = gr.Checkbox(label=f"High-Res Mode (tiled decode, auto above {engine.MAX_RESOLUTION})", value=False)
+                    refine = gr.Checkbox(label="Upscale & Refine", value=False)
                 
                 with gr.Row():
                     steps = gr.Slider(1, 50, value=4, step=1, label="Steps (4 rec.)")
@@ -490,8 +693,25 @@ with gr.Blocks(title="Flux.2 Klein GUI") as demo:
                     seed = gr.Number(label="Seed (-1 = Random)", value=-1)
                     strength = gr.Slider(0.0, 1.0, value=0.8, step=0.05, label="Img Strength")
 
+                with gr.Row():
+                    offload = gr.Dropdown(
+                        ["auto", *STRATEGIES], value=engine.OFFLOAD_STRATEGY, label="Memory Offload"
+                    )
+                    quantization = gr.Dropdown(
+                        list(engine.QUANTIZATION_MODES), value=engine.QUANTIZATION, label="Weight Precision"
+                    )
+
             # Main Action Button
             generate_btn = gr.Button("🚀 GENERATE IMAGE", elem_classes="generate-btn")
+            cancel_btn = gr.Button("✋ Cancel", elem_classes="folder-btn")
+
+            # Grid Mode (Prompts x Seeds / Steps / Strength)
+            with gr.Accordion("🔢 Grid Mode", open=False):
+                grid_prompts = gr.Textbox(label="Prompts (one per line)", lines=3)
+                with gr.Row():
+                    grid_axis = gr.Dropdown(list(AXES), value="seed", label="Vary")
+                    grid_values = gr.Textbox(label="Values", value="1-4", placeholder="1-4 or 2,4,8 or 0.2:0.8:0.2")
+                grid_btn = gr.Button("🧮 GENERATE GRID", elem_classes="folder-btn")
             
             # Bottom Controls
             with gr.Row():
@@ -502,6 +722,19 @@ with gr.Blocks(title="Flux.2 Klein GUI") as demo:
         with gr.Column(scale=2):
             result_image = gr.Image(label="Result", type="pil")
             log_status = gr.Textbox(label="Status", interactive=False, lines=1)
+            with gr.Accordion("🔢 Grid Cells", open=False):
+                grid_gallery = gr.Gallery(label="Grid", columns=4, height="auto")
+            with gr.Accordion("🕘 History", open=False) as history_accordion:
+                with gr.Row():
+                    history_query = gr.Textbox(label="Search prompts", placeholder="lighthouse storm", scale=3)
+                    history_refresh = gr.Button("🔍 Search", elem_classes="folder-btn", scale=1)
+                history_gallery = gr.Gallery(label="History", columns=6, height="auto", allow_preview=False)
+                with gr.Row():
+                    history_newer = gr.Button("◀ Newer", elem_classes="folder-btn")
+                    history_status = gr.Markdown("")
+                    history_older = gr.Button("Older ▶", elem_classes="folder-btn")
+                history_pages = gr.State([None])
+                history_page = gr.State({})
             
             # Spotify Link (Right side)
             gr.Markdown(
@@ -529,19 +762,49 @@ with gr.Blocks(title="Flux.2 Klein GUI") as demo:
 
     # --- LOGIC ---
     
+    # First browser render marks time-to-first-paint
+    demo.load(engine.record_first_paint)
+
     # Timer updates stats every second
     timer = gr.Timer(1)
     timer.tick(get_system_stats, outputs=stats_display)
 
     generate_btn.click(
         generate_image, 
-        [prompt, input_image, width, height, steps, guidance, seed, strength], 
-        [result_image, log_status]
+        [prompt, input_image, width, height, steps, guidance, seed, strength, hires, refine], 
+        [result_image, log_status],
+        concurrency_limit=BATCH_MAX_SIZE
+    )
+    grid_btn.click(
+        generate_grid,
+        [grid_prompts, grid_axis, grid_values, input_image, width, height, steps, guidance, seed, strength],
+        [grid_gallery, result_image, log_status]
     )
+    cancel_btn.click(cancel_generation, None, log_status, queue=False)
+    offload.change(change_offload_strategy, offload, log_status)
+    quantization.change(change_quantization, quantization, log_status)
+    history_outputs = [history_gallery, history_status, history_pages, history_page]
+    history_accordion.expand(search_history, history_query, history_outputs)  # First page when opened
+    history_refresh.click(search_history, history_query, history_outputs)
+    history_query.submit(search_history, history_query, history_outputs)
+    history_older.click(older_history, [history_query, history_pages, history_page], history_outputs)
+    history_newer.click(newer_history, [history_query, history_pages], history_outputs)
+    history_gallery.select(select_history, history_page, [result_image, log_status])
     folder_btn.click(open_output_folder)
     shutdown_btn.click(shutdown_server)
 
 if __name__ == "__main__":
-    load_model()
+    # Weights load in the background; generate clicks during warm-up wait in the queue
+    engine.configure_tracing(enabled=not ARGS.no_tracing, trace_dir=ARGS.trace_dir or engine.TRACE_DIR)
+    metrics_port = engine.METRICS_PORT if ARGS.metrics_port is None else ARGS.metrics_port
+    if metrics_port and engine.tracer.enabled:
+        start_metrics_server(engine.tracer.registry, metrics_port)
+    engine.history.start_scan()  # Brings in images saved by earlier runs
+    if ARGS.workers == "auto":
+        engine.start_worker_pool(stub=ARGS.stub)
+    elif ARGS.workers:
+        engine.start_worker_pool(devices=ARGS.workers.split(","), stub=ARGS.stub)
+    else:
+        engine.start_background_load(stub=ARGS.stub)
     # CSS passed here to avoid Gradio 6.0 warning
-    demo.launch(inbrowser=True, css=custom_css, theme=glass_theme)
\ No newline at end of file
+    demo.launch(inbrowser=not ARGS.no_browser, css=custom_css, theme=glass_theme)
\ No newline at end of file
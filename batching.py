@@ -0,0 +1,231 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from result_cache import image_digest
+
+# --- DYNAMIC BATCHING ---
+# Requests that arrive within a short window and share the same shape
+# (size, steps, guidance, mode) are merged into one pipeline call.
+# The queue is ordered by priority, so an interactive click is picked before
+# queued batch jobs (grid cells, cli.py). A request can be cancelled, or given a
+# deadline: while queued it is failed right away; while running, the step-end
+# callback from `cancel_callback` raises at the next denoising step.
+
+PRIORITY_INTERACTIVE = 0  # Single images from the UI
+PRIORITY_BATCH = 10       # Grid cells and headless jobs
+
+
+class GenerationCancelled(Exception):
+    """Raised for a request that was cancelled or ran past its deadline."""
+
+    def __init__(self, reason="cancelled"):
+        super().__init__("Deadline exceeded" if reason == "deadline" else "Cancelled")
+        self.reason = reason
+
+
+class GenerationRequest:
+    """One generate click: everything needed to produce a single image."""
+
+    def __init__(self, prompt, width, height, steps, guidance, seed, input_image=None, strength=1.0,
+                 hires=False, priority=PRIORITY_INTERACTIVE, timeout=None):
+        self.prompt = prompt
+        self.width = int(width)
+        self.height = int(height)
+        self.steps = int(steps)
+        self.guidance = float(guidance)
+        self.seed = int(seed)
+        self.input_image = input_image
+        self.strength = float(strength)
+        self.hires = bool(hires)  # Tiled VAE decode
+        self.future = Future()
+        self.submitted_at = None
+        self.batch_size = 1
+        self.trace = None
+        self.cache_key = None
+        self.input_digest = None
+        self.on_preview = None  # Called as on_preview(image, step, total) while denoising
+        self.cache_hit = False
+        self.priority = int(priority)  # Lower runs first
+        self.timeout = timeout  # Seconds from submission until the request is cancelled
+        self.deadline = None
+        self.cancel_reason = None
+        self.requested_size = None  # (width, height) before admission control downscaled it
+
+    @property
+    def mode(self):
+        return "img2img" if self.input_image is not None else "txt2img"
+
+    def sizes(self):
+        """{"requested_size", "admitted_size"} as "WxH" strings, for status lines."""
+        requested = self.requested_size or (self.width, self.height)
+        return {"requested_size": f"{requested[0]}x{requested[1]}", "admitted_size": f"{self.width}x{self.height}"}
+
+    def cancel(self, reason="cancelled"):
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+
+    def is_cancelled(self, now=None):
+        """True once cancelled or past the deadline (which then counts as the reason)."""
+        if self.cancel_reason is None and self.deadline is not None:
+            if (now if now is not None else time.perf_counter()) >= self.deadline:
+                self.cancel_reason = "deadline"
+        return self.cancel_reason is not None
+
+    def fail(self, error):
+        """Sets `error` on the future unless it already has a result."""
+        if not self.future.done():
+            self.future.set_exception(error)
+
+    def batch_key(self):
+        """Requests with equal keys can share one pipeline call."""
+        key = (self.mode, self.width, self.height, self.steps, self.guidance, self.hires)
+        if self.input_image is not None:
+            # Reference images are shared by the whole batch, so only equal pixels merge
+            if self.input_digest is None:
+                self.input_digest = image_digest(self.input_image)
+            key += (self.strength, self.input_digest)
+        return key
+
+
+def cancel_callback(requests):
+    """callback_on_step_end that fails cancelled requests of a running batch right
+    away and aborts the run (GenerationCancelled) once none of them is wanted."""
+    def callback(pipe, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        cancelled = [r for r in requests if r.is_cancelled(now)]
+        for request in cancelled:
+            request.fail(GenerationCancelled(request.cancel_reason))
+        if len(cancelled) == len(requests):
+            raise GenerationCancelled(requests[0].cancel_reason)
+        return callback_kwargs
+    return callback
+
+
+class BatchScheduler:
+    """Collects requests for up to `max_wait` seconds and runs them in batches.
+
+    `run_batch(requests)` is called on the scheduler thread with a list of
+    compatible requests and must return one image per request, in order.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait))
+        self.batch_sizes = deque(maxlen=1000)
+        self.cancelled = 0
+        self._pending = []
+        self._deadlines = []  # Heap of (deadline, n, request) for queued requests
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        self._watchdog = threading.Thread(target=self._expire_loop, name="batch-deadlines", daemon=True)
+        self._watchdog.start()
+
+    def submit(self, request):
+        """Queues a request and returns its Future (resolves to the image)."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler is shut down")
+            request.submitted_at = time.perf_counter()
+            if request.timeout:
+                request.deadline = request.submitted_at + request.timeout
+                heapq.heappush(self._deadlines, (request.deadline, next(self._sequence), request))
+            self._pending.append(request)
+            self._cond.notify_all()
+        return request.future
+
+    def cancel(self, request, reason="cancelled"):
+        """Cancels a queued request at once, a running one at its next denoising step."""
+        request.cancel(reason)
+        with self._cond:
+            if request in self._pending:
+                self._pending.remove(request)
+                self._dropped(request)
+
+    def _dropped(self, request):
+        self.cancelled += 1
+        request.fail(GenerationCancelled(request.cancel_reason))
+
+    def close(self, wait=True):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            self._thread.join()
+
+    def _expire_loop(self):
+        """Fails queued requests as their deadlines pass (running ones stop in the step callback)."""
+        with self._cond:
+            while not self._closed:
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                remaining = self._deadlines[0][0] - time.perf_counter()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                _, _, request = heapq.heappop(self._deadlines)
+                if request in self._pending and request.is_cancelled():
+                    self._pending.remove(request)
+                    self._dropped(request)
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.perf_counter()
+                for request in [r for r in self._pending if r.is_cancelled(now)]:
+                    self._pending.remove(request)
+                    self._dropped(request)
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+
+                # Most urgent first (lowest priority value, then oldest)
+                order = lambda r: (r.priority, r.submitted_at)
+                head = min(self._pending, key=order)
+                key = head.batch_key()
+                wait_until = head.submitted_at + self.max_wait
+                while True:
+                    batch = sorted((r for r in self._pending if r.batch_key() == key), key=order)[:self.max_batch_size]
+                    remaining = wait_until - time.perf_counter()
+                    if (len(batch) >= self.max_batch_size or remaining <= 0 or self._closed
+                            or head not in self._pending):
+                        break
+                    self._cond.wait(remaining)
+
+                if batch:
+                    for request in batch:
+                        self._pending.remove(request)
+                    return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.batch_sizes.append(len(batch))
+            for request in batch:
+                request.batch_size = len(batch)
+            try:
+                images = self.run_batch(batch)
+                if len(images) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} images, got {len(images)}")
+            except Exception as e:
+                if isinstance(e, GenerationCancelled):
+                    self.cancelled += len(batch)
+                for request in batch:
+                    request.fail(e)
+                continue
+            for request, image in zip(batch, images):
+                # Requests cancelled while the rest of their batch ran already failed
+                if not request.future.done():
+                    request.future.set_result(image)
@@ -0,0 +1,351 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+# --- SERVING BENCHMARK ---
+# Drives the same entry point as the GUI (engine.generate) with a grid of
+# resolutions, step counts, modes and concurrency levels, and reports latency
+# percentiles, throughput, peak memory and a per-stage breakdown as JSON.
+#
+#   python bench.py                                  # CPU stub pipeline (CI)
+#   python bench.py --real --resolutions 1024x1024   # the real model on a GPU box
+#   python bench.py --save-baseline bench_baseline.json
+#   python bench.py --baseline bench_baseline.json   # exit code 1 on regressions
+#   python bench.py --real --quality int8,fp8,int4   # quantized vs bf16 on fixed seeds
+#   python bench.py --history 50000                  # history index with synthetic images
+
+PROMPTS = (
+    "A cinematic shot of a lighthouse in a storm",
+    "A macro photo of a dew-covered spider web at sunrise",
+    "An isometric illustration of a tiny floating island city",
+    "A portrait of an old fisherman, dramatic rim lighting",
+)
+
+
+def percentile(values, q):
+    """Linear-interpolated percentile (q in 0..100) of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class PeakRSS:
+    """Samples the process RSS on a background thread while active."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._process = psutil.Process()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            if self._stop.wait(self.interval):
+                return
+
+
+def source_image(width, height):
+    """Deterministic gradient used as the img2img input."""
+    from PIL import Image
+    return Image.linear_gradient("L").resize((width, height)).convert("RGB")
+
+
+def run_scenario(engine, width, height, steps, mode, concurrency, requests, warmup):
+    import torch
+    input_image = source_image(width, height) if mode == "img2img" else None
+    counter = itertools.count()
+
+    def one(_=None):
+        index = next(counter)
+        request = engine.make_request(
+            PROMPTS[index % len(PROMPTS)], input_image, width, height, steps, 1.0,
+            seed=index, strength=0.8
+        )
+        image, elapsed = engine.generate(request)
+        return elapsed, request
+
+    for _ in range(warmup):
+        one()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    with PeakRSS() as rss, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(one, range(requests)))
+        wall = time.perf_counter() - start
+
+    latencies = [elapsed for elapsed, _ in results]
+    stages = {}
+    for _, request in results:
+        for stage, seconds in getattr(request.trace, "spans", {}).items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        "width": width, "height": height, "steps": steps, "mode": mode,
+        "concurrency": concurrency, "requests": requests,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "images_per_second": requests / wall if wall else 0.0,
+        "mean_batch_size": sum(r.batch_size for _, r in results) / len(results),
+        "peak_rss_bytes": rss.peak,
+        "peak_vram_bytes": torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0,
+        "stages": {stage: sum(v) / len(v) for stage, v in sorted(stages.items())},
+    }
+
+
+def quality_check(engine, modes, width, height, steps, seeds, min_psnr):
+    """Generates the same prompts and seeds in bf16 and in each quantized mode and
+    reports PSNR against bf16, time per image and weight memory."""
+    from quantization import image_psnr
+    reference = None
+    report = []
+    for mode in ["bf16", *modes]:
+        status = engine.set_quantization(mode)
+        if status.startswith("Error"):
+            raise RuntimeError(status)
+        images = []
+        start = time.perf_counter()
+        for seed in seeds:
+            request = engine.make_request(PROMPTS[seed % len(PROMPTS)], None, width, height, steps, 1.0, seed=seed)
+            images.append(engine.generate(request)[0])
+        seconds = (time.perf_counter() - start) / len(seeds)
+        if reference is None:
+            reference, reference_seconds = images, seconds
+            continue
+        psnr = [image_psnr(a, b) for a, b in zip(reference, images)]
+        summary = engine.quantization_summary.values()
+        report.append({
+            "mode": mode, "psnr_min": min(psnr), "psnr_mean": sum(psnr) / len(psnr),
+            "seconds_per_image": seconds, "speed_vs_bf16": reference_seconds / seconds if seconds else 0.0,
+            "weight_bytes_before": sum(s["bytes_before"] for s in summary),
+            "weight_bytes_after": sum(s["bytes_after"] for s in summary),
+            "regression": min(psnr) < min_psnr,
+        })
+    return report
+
+
+def history_benchmark(count, page_size=48, thumb_pages=2):
+    """Indexes `count` synthetic images and times the scan, page listing across the
+    whole history, prompt search and thumbnail generation (cold and cached)."""
+    import io
+    import shutil
+    import struct
+    import tempfile
+    import zlib
+    from PIL import Image
+    from history import History
+    from output_writer import encode_metadata
+    root = tempfile.mkdtemp(prefix="flux_history_")
+    try:
+        output_dir = os.path.join(root, "outputs")
+        os.makedirs(output_dir)
+        # One encoded 512x512 PNG; each file gets its own "parameters" chunk spliced in after IHDR
+        buffer = io.BytesIO()
+        Image.new("RGB", (512, 512), (40, 90, 160)).save(buffer, format="PNG", compress_level=1)
+        encoded = buffer.getvalue()
+        head, tail = encoded[:33], encoded[33:]  # Signature + IHDR, then IDAT + IEND
+        created = time.time() - count
+        for i in range(count):
+            text = b"parameters\0" + encode_metadata({
+                "prompt": f"{PROMPTS[i % len(PROMPTS)]}, variation {i}", "seed": i, "width": 512,
+                "height": 512, "steps": 4, "guidance": 1.0, "mode": "txt2img", "elapsed": 1.0,
+            }).encode("latin-1", "replace")
+            chunk = struct.pack(">I", len(text)) + b"tEXt" + text + struct.pack(">I", zlib.crc32(b"tEXt" + text))
+            path = os.path.join(output_dir, f"flux2_{i:07d}.png")
+            with open(path, "wb") as f:
+                f.write(head + chunk + tail)
+            os.utime(path, (created + i, created + i))
+
+        history = History(os.path.join(output_dir, ".history"), output_dir)
+        start = time.perf_counter()
+        history.scan()
+        scan_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        history.scan()
+        rescan_seconds = time.perf_counter() - start
+
+        page_seconds, cursor = [], None
+        while True:
+            start = time.perf_counter()
+            rows, cursor = history.page("", cursor, page_size)
+            page_seconds.append(time.perf_counter() - start)
+            if cursor is None:
+                break
+        search = {}
+        for query in ("lighthouse", "spider web", "nomatch"):
+            start = time.perf_counter()
+            rows, _ = history.page(query, None, page_size)
+            search[query] = {"seconds": time.perf_counter() - start, "results": len(rows)}
+
+        cold, warm = [], []
+        cursor = None
+        for _ in range(thumb_pages):
+            rows, cursor = history.page("", cursor, page_size)
+            for times in (cold, warm):
+                start = time.perf_counter()
+                history.thumbnails(rows)
+                times.append(time.perf_counter() - start)
+        return {
+            "images": count, "fts": history.fts,
+            "scan_seconds": scan_seconds, "rescan_seconds": rescan_seconds,
+            "pages": len(page_seconds), "page_first_ms": page_seconds[0] * 1000,
+            "page_p50_ms": percentile(page_seconds, 50) * 1000, "page_last_ms": page_seconds[-1] * 1000,
+            "search": search,
+            "thumbnail_page_cold_seconds": sum(cold) / len(cold),
+            "thumbnail_page_cached_seconds": sum(warm) / len(warm),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def scenario_key(result):
+    return f"{result['mode']}-{result['width']}x{result['height']}-{result['steps']}steps-c{result['concurrency']}"
+
+
+def compare(results, baseline, tolerance):
+    """Compares p50 latency and throughput with a saved baseline."""
+    previous = {scenario_key(r): r for r in baseline.get("results", [])}
+    comparison = []
+    for result in results:
+        key = scenario_key(result)
+        if key not in previous:
+            continue
+        old = previous[key]
+        latency_ratio = result["latency_p50"] / old["latency_p50"] if old["latency_p50"] else 1.0
+        throughput_ratio = (result["images_per_second"] / old["images_per_second"]
+                            if old["images_per_second"] else 1.0)
+        comparison.append({
+            "scenario": key,
+            "latency_p50_ratio": latency_ratio,
+            "throughput_ratio": throughput_ratio,
+            "regression": latency_ratio > 1 + tolerance or throughput_ratio < 1 - tolerance,
+        })
+    return comparison
+
+
+def parse_resolutions(text):
+    return [tuple(int(v) for v in item.lower().split("x")) for item in text.split(",")]
+
+
+def parse_ints(text):
+    return [int(v) for v in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the FLUX.2 Klein serving path.")
+    parser.add_argument("--real", action="store_true", help="Load the real Flux2KleinPipeline instead of the stub")
+    parser.add_argument("--resolutions", default="512x512,1024x1024", help="Comma-separated WxH list")
+    parser.add_argument("--steps", default="4", help="Comma-separated step counts")
+    parser.add_argument("--modes", default="txt2img,img2img", help="txt2img and/or img2img")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=16, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured requests per scenario")
+    parser.add_argument("--step-time", type=float, default=0.02, help="Stub: seconds per denoising step")
+    parser.add_argument("--encode-time", type=float, default=0.01, help="Stub: seconds per text-encoder pass")
+    parser.add_argument("--vae-time", type=float, default=0.01, help="Stub: seconds per VAE encode")
+    parser.add_argument("--result-cache", action="store_true", help="Keep the result cache enabled")
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--baseline", help="Compare against a previously saved report")
+    parser.add_argument("--save-baseline", help="Save this report as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown before flagging a regression")
+    parser.add_argument("--compile", action="store_true", help="Compiled mode: warm up the resolution buckets first")
+    parser.add_argument("--quality", help="Instead of the serving grid, compare these quantization modes with bf16")
+    parser.add_argument("--quality-seeds", default="0,1,2,3", help="Fixed seeds for --quality")
+    parser.add_argument("--history", type=int, help="Instead of the serving grid, benchmark the history index with N synthetic images")
+    parser.add_argument("--min-psnr", type=float, default=30.0, help="Lowest PSNR (dB) vs bf16 before --quality fails")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    if args.history:
+        report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "history": history_benchmark(args.history)}
+        out.write(json.dumps(report, indent=2) + "\n")
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(json.dumps(report, indent=2) + "\n")
+        return 0
+    with contextlib.redirect_stdout(sys.stderr):
+        import engine
+        engine.configure_tracing(enabled=True)
+        if not args.result_cache:
+            engine.result_cache = None
+        engine.COMPILE_ENABLED = args.compile
+        status = engine.load_model(stub=not args.real)
+        if status != "Ready":
+            print(status)
+            return 2
+        if not args.real:
+            engine.pipe.step_time = args.step_time
+            engine.pipe.encode_time = args.encode_time
+            engine.pipe.vae_time = args.vae_time
+        for thread in threading.enumerate():
+            if thread.name == "compile-warmup":
+                thread.join()
+
+        results = []
+        if args.quality:
+            (width, height), steps = parse_resolutions(args.resolutions)[-1], parse_ints(args.steps)[0]
+            quality = quality_check(
+                engine, args.quality.split(","), width, height, steps,
+                parse_ints(args.quality_seeds), args.min_psnr
+            )
+        for (width, height), steps, mode, concurrency in [] if args.quality else itertools.product(
+            parse_resolutions(args.resolutions), parse_ints(args.steps),
+            args.modes.split(","), parse_ints(args.concurrency)
+        ):
+            print(f"⏱️ {mode} {width}x{height} {steps} steps, concurrency {concurrency}...")
+            results.append(run_scenario(
+                engine, width, height, steps, mode, concurrency, args.requests, args.warmup
+            ))
+
+    report = {
+        "pipeline": "real" if args.real else "stub",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "batch_max_size": engine.BATCH_MAX_SIZE,
+        "results": results,
+    }
+    if engine.compiler is not None:
+        report["compile"] = engine.compiler.report
+    exit_code = 0
+    if args.quality:
+        report["quality"] = quality
+        if any(q["regression"] for q in quality):
+            exit_code = 1
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare(results, json.load(f), args.tolerance)
+        if any(c["regression"] for c in report["comparison"]):
+            exit_code = 1
+
+    text = json.dumps(report, indent=2)
+    out.write(text + "\n")
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
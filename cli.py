@@ -0,0 +1,148 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import time
+
+# --- HEADLESS BATCH MODE ---
+# Streams a JSONL job file (or stdin) through the loaded pipeline without
+# Gradio. One JSON status line is printed to stdout per finished job; all other
+# logging goes to stderr so the output can be piped into other tools.
+#
+#   python cli.py jobs.jsonl --output-dir outputs/batch
+#   cat jobs.jsonl | python cli.py - --stub
+#
+# A job is an object like {"prompt": "...", "seed": 42, "width": 1024}. Missing
+# fields fall back to the UI defaults. Jobs whose output file already exists
+# are skipped, so a crashed run can simply be started again.
+
+JOB_DEFAULTS = {
+    "width": 1024, "height": 1024, "steps": 4, "guidance": 1.0,
+    "seed": -1, "strength": 0.8, "input_image": None, "hires": False, "timeout": None,
+}
+
+
+def job_id(job, index):
+    """Stable name for a job: explicit "id" or line number + content hash."""
+    if job.get("id"):
+        return str(job["id"])
+    digest = hashlib.sha1(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+    return f"job_{index:06d}_{digest}"
+
+
+def read_jobs(stream):
+    """Yields (index, job) for every non-empty line; bad lines yield an error dict."""
+    for index, line in enumerate(stream):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict) or not str(job.get("prompt", "")).strip():
+                raise ValueError("job needs a non-empty 'prompt'")
+        except ValueError as e:
+            yield index, {"error": f"line {index + 1}: {e}"}
+            continue
+        yield index, job
+
+
+def emit(out, **status):
+    out.write(json.dumps(status, ensure_ascii=False) + "\n")
+    out.flush()
+
+
+def run(args, out):
+    import engine
+    from PIL import Image
+    from batching import PRIORITY_BATCH
+    from output_writer import OutputWriter
+
+    writer = OutputWriter(
+        args.output_dir, fmt=args.format,
+        compress_level=engine.OUTPUT_COMPRESS_LEVEL, quality=engine.OUTPUT_QUALITY
+    )
+    status = engine.load_model(stub=args.stub)
+    if status != "Ready":
+        emit(out, status="error", error=status)
+        return 1
+
+    base_dir = os.path.dirname(os.path.abspath(args.jobs)) if args.jobs != "-" else os.getcwd()
+    stream = sys.stdin if args.jobs == "-" else open(args.jobs, "r", encoding="utf-8")
+    in_flight = []
+    counts = {"done": 0, "skipped": 0, "error": 0}
+
+    def finish(entry):
+        name, request, future, started = entry
+        try:
+            image = future.result()
+            elapsed = time.time() - started
+            path = os.path.join(args.output_dir, name + writer.extension)
+            writer.write(image, engine.output_params(request, elapsed), path)
+            counts["done"] += 1
+            emit(out, id=name, status="done", path=path, seed=request.seed,
+                 elapsed=round(elapsed, 3), batch_size=request.batch_size, **request.sizes())
+        except Exception as e:
+            counts["error"] += 1
+            emit(out, id=name, status="error", error=str(e))
+
+    try:
+        for index, job in read_jobs(stream):
+            if "error" in job:
+                counts["error"] += 1
+                emit(out, line=index + 1, status="error", error=job["error"])
+                continue
+            name = job_id(job, index)
+            path = os.path.join(args.output_dir, name + writer.extension)
+            if os.path.exists(path):
+                counts["skipped"] += 1
+                emit(out, id=name, status="skipped", path=path)
+                continue
+
+            params = {**JOB_DEFAULTS, **job}
+            try:
+                input_image = None
+                if params["input_image"]:
+                    input_image = Image.open(os.path.join(base_dir, params["input_image"])).convert("RGB")
+                request = engine.make_request(
+                    params["prompt"], input_image, params["width"], params["height"],
+                    params["steps"], params["guidance"], params["seed"], params["strength"],
+                    hires=params["hires"], priority=PRIORITY_BATCH, timeout=params["timeout"]
+                )
+                in_flight.append((name, request, engine.submit(request), time.time()))
+            except Exception as e:
+                counts["error"] += 1
+                emit(out, id=name, status="error", error=str(e))
+                continue
+
+            # Keep enough jobs queued to fill a batch, write out whatever has finished
+            while len(in_flight) >= args.max_in_flight or (in_flight and in_flight[0][2].done()):
+                finish(in_flight.pop(0))
+        while in_flight:
+            finish(in_flight.pop(0))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        writer.close()
+
+    emit(out, status="summary", **counts)
+    return 0 if counts["error"] == 0 else 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run FLUX.2 Klein jobs from a JSONL file without the GUI.")
+    parser.add_argument("jobs", help="JSONL job file, or '-' to read from stdin")
+    parser.add_argument("--output-dir", default=os.path.join("outputs", "batch"), help="Where images are written")
+    parser.add_argument("--format", default="png", choices=["png", "webp", "jpeg"], help="Output image format")
+    parser.add_argument("--max-in-flight", type=int, default=8, help="Jobs queued ahead of the pipeline")
+    parser.add_argument("--stub", action="store_true", help="Use the CPU stub pipeline instead of the model")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        return run(args, out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- COMPILED MODE ---
+# torch.compile specialises the graph on input shapes, so every new width/height
+# would trigger a fresh compile. Requests are therefore snapped to a fixed set of
+# resolution buckets (the result is cropped/resized back to the requested size),
+# each bucket is compiled once in a background warmup, and the compiled kernels
+# are kept on disk (inductor's FX graph cache plus torch.compiler cache
+# artifacts) so a restart loads them instead of compiling again. Sizes far from
+# every bucket run eagerly rather than adding another specialisation.
+# The batch and sequence dims of the transformer's inputs are marked dynamic, so
+# batch sizes and img2img reference tokens don't multiply the graphs, and the
+# recompile limit follows the input shapes actually seen: hitting it would make
+# dynamo fall back to eager without a word.
+
+ARTIFACTS_FILE = "artifacts.bin"
+REPORT_FILE = "warmup.json"
+DYNAMIC_DIMS = 2  # Leading dims of every tensor input compiled dynamic (batch, sequence)
+
+
+def configure_cache(cache_dir):
+    """Points inductor's on-disk caches at `cache_dir` and preloads saved artifacts."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    import torch
+    path = os.path.join(cache_dir, ARTIFACTS_FILE)
+    if os.path.exists(path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        try:
+            with open(path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            return True
+        except Exception as e:
+            print(f"⚠️ Ignoring compile cache artifacts: {e}")
+    return False
+
+
+def save_artifacts(cache_dir):
+    """Writes the compile artifacts of this process to `cache_dir` (torch >= 2.7)."""
+    import torch
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return False
+    tmp_path = os.path.join(cache_dir, ARTIFACTS_FILE + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(artifacts[0])
+    os.replace(tmp_path, os.path.join(cache_dir, ARTIFACTS_FILE))
+    return True
+
+
+def raise_recompile_limit(limit):
+    """Raises dynamo's per-function recompile limit to at least `limit`."""
+    import torch
+    for name in ("recompile_limit", "cache_size_limit"):
+        if hasattr(torch._dynamo.config, name):
+            setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), limit))
+
+
+def snap_to_bucket(width, height, buckets, max_aspect_error=0.1, max_area_ratio=1.5):
+    """Closest bucket by aspect ratio and area, or None if none is close enough."""
+    def cost(bucket):
+        aspect = abs(math.log((bucket[0] / bucket[1]) / (width / height)))
+        area = abs(math.log((bucket[0] * bucket[1]) / (width * height)))
+        return aspect + 0.5 * area, aspect, area
+
+    best = min(buckets, key=cost)
+    _, aspect, area = cost(best)
+    if aspect > math.log(1 + max_aspect_error) or area > math.log(max_area_ratio):
+        return None
+    return tuple(best)
+
+
+def fit_to_size(image, width, height):
+    """Scales `image` to cover width x height and centre-crops the rest."""
+    if image.size == (width, height):
+        return image
+    from PIL import Image, ImageOps
+    return ImageOps.fit(image, (width, height), Image.LANCZOS)
+
+
+class BucketCompiler:
+    """Compiles `module.forward` in place, static per bucket except for batch and sequence dims.
+
+    Calls inside `eager()` (on the calling thread) bypass the compiled graph.
+    `warm(bucket, run)` times `run(bucket)` eagerly, on first compiled use and
+    once compiled, and records compile time and speedup in `report`.
+    Offload hooks replace `module.forward` too; call `install()` after adding or
+    removing them.
+    """
+
+    def __init__(self, module, buckets, cache_dir=None, compile_fn=None, clock=time.perf_counter, **compile_kwargs):
+        import torch
+        self.module = module
+        self.buckets = [tuple(b) for b in buckets]
+        self.cache_dir = cache_dir
+        self.clock = clock
+        self.report = {}
+        self.stopped = False
+        self.shapes = set()  # Input shapes the compiled forward has been called with
+        self._local = threading.local()
+        raise_recompile_limit(len(self.buckets) + 2)
+        self._compile = lambda forward: (compile_fn or torch.compile)(forward, dynamic=False, **compile_kwargs)
+        self.install()
+
+    def install(self):
+        """Compiles whatever `module.forward` is now (e.g. with offload hooks) and takes its place.
+
+        Returns False if the compiled forward is still in place.
+        """
+        if self.module.forward == self._forward:
+            return False
+        self._eager_forward = self.module.forward
+        self._compiled_forward = self._compile(self.module.forward)
+        self.module.forward = self._forward
+        return True
+
+    def _forward(self, *args, **kwargs):
+        if getattr(self._local, "eager", False):
+            return self._eager_forward(*args, **kwargs)
+        self._mark_dynamic(list(args) + list(kwargs.values()))
+        return self._compiled_forward(*args, **kwargs)
+
+    def _mark_dynamic(self, inputs):
+        """Marks the batch and sequence dims dynamic and keeps the recompile limit above the shapes seen."""
+        import torch
+        shapes = []
+        for value in inputs:
+            if isinstance(value, torch.Tensor):
+                shapes.append(tuple(value.shape))
+                for dim in range(min(value.dim(), DYNAMIC_DIMS)):
+                    torch._dynamo.maybe_mark_dynamic(value, dim)
+        shape = tuple(shapes)
+        if shape not in self.shapes:
+            self.shapes.add(shape)
+            # Every distinct shape could in the worst case need its own graph
+            raise_recompile_limit(len(self.shapes) + 2)
+
+    @contextmanager
+    def eager(self, enabled=True):
+        previous = getattr(self._local, "eager", False)
+        self._local.eager = enabled
+        try:
+            yield
+        finally:
+            self._local.eager = previous
+
+    def snap(self, width, height):
+        return snap_to_bucket(width, height, self.buckets)
+
+    def _timed(self, run, bucket):
+        start = self.clock()
+        run(bucket)
+        return self.clock() - start
+
+    def warm(self, bucket, run):
+        with self.eager():
+            eager = self._timed(run, bucket)
+        first = self._timed(run, bucket)
+        compiled = self._timed(run, bucket)
+        entry = {
+            "compile_seconds": max(0.0, first - eager), "eager_seconds": eager,
+            "compiled_seconds": compiled, "speedup": eager / compiled if compiled else 0.0,
+        }
+        self.report[f"{bucket[0]}x{bucket[1]}"] = entry
+        return entry
+
+    def warm_all(self, run):
+        """Warms every bucket in order; saves artifacts and the report when done."""
+        for bucket in self.buckets:
+            if self.stopped:
+                return self.report
+            try:
+                entry = self.warm(bucket, run)
+                print(f"⚙️ Compiled {bucket[0]}x{bucket[1]}: {entry['compile_seconds']:.1f}s compile, "
+                      f"{entry['speedup']:.2f}x speedup")
+            except Exception as e:
+                print(f"❌ Compile warmup failed for {bucket[0]}x{bucket[1]}: {e}")
+                self.report[f"{bucket[0]}x{bucket[1]}"] = {"error": str(e)}
+        if self.cache_dir:
+            save_artifacts(self.cache_dir)
+            with open(os.path.join(self.cache_dir, REPORT_FILE), "w", encoding="utf-8") as f:
+                json.dump(self.report, f, indent=2)
+        return self.report
@@ -0,0 +1,797 @@
+import os
+import gc
+import contextlib
+import json
+import time
+import hashlib
+import queue
+import atexit
+import random
+import threading
+import psutil
+from admission import AdmissionController, IdlePolicy, MemoryPredictor, RssPeak, megapixels
+from prompt_cache import PromptEmbeddingCache
+from batching import PRIORITY_INTERACTIVE, BatchScheduler, GenerationCancelled, GenerationRequest, cancel_callback
+from output_writer import OutputWriter
+from history import History
+from latent_cache import LatentCache
+from tiled_vae import TiledVAE
+from result_cache import ResultCache, image_digest, result_key
+from metrics import NULL_TRACE, BatchTrace, Tracer
+from offload import (
+    STRATEGIES, HostWeights, apply_strategy, choose_strategy, component_sizes, measure_memory, reset_offload
+)
+
+# --- GENERATION ENGINE ---
+# Model loading and generation logic shared by the Gradio UI (app.py) and the
+# headless batch runner (cli.py). Nothing in here imports Gradio, and torch /
+# diffusers are only imported once the model is actually loaded, so the UI can
+# come up (and --help can answer) before the heavy libraries are in memory.
+# The modules imported below keep their torch imports inside functions for the
+# same reason.
+
+# --- CONFIGURATION ---
+MODEL_ID = "black-forest-labs/FLUX.2-klein-4B"
+LOCAL_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache")
+OUTPUT_DIR = "outputs"
+MAX_SEQUENCE_LENGTH = 512
+PROMPT_CACHE_MAX_MB = 512  # Encoded prompts kept on the CPU (~8MB each at 512 tokens)
+LATENT_CACHE_MAX_MB = 1024 # VAE-encoded img2img source images kept on the CPU
+PREVIEW_INTERVAL = 0.5     # Seconds between progressive previews while denoising
+PREVIEW_MAX_OVERHEAD = 0.05  # Share of the run time previews may cost
+PREVIEW_MAX_SIZE = 512     # Longest side of a preview image
+BATCH_MAX_SIZE = 4         # Concurrent requests merged into one pipeline call
+BATCH_WAIT_MS = 50         # How long the first request waits for others to join
+OUTPUT_FORMAT = "png"      # "png", "webp" or "jpeg"
+OUTPUT_COMPRESS_LEVEL = 4  # PNG zlib level (0 = fastest, 9 = smallest)
+OUTPUT_QUALITY = 95        # WebP/JPEG quality
+OFFLOAD_STRATEGY = "auto"  # "auto" or one of offload.STRATEGIES
+OFFLOAD_DISK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "offload_cache")
+MODEL_WAIT_TIMEOUT = 1800  # Seconds a request waits for the model to finish loading
+GENERATION_TIMEOUT = 0     # Seconds until an unfinished request is cancelled (0 = no deadline)
+TRACING_ENABLED = True     # Per-stage latency histograms (see metrics.py)
+TRACE_DIR = None           # Folder for per-request JSON traces (None = off)
+METRICS_PORT = 7861        # Prometheus text endpoint at http://127.0.0.1:7861/metrics (0 = off)
+RESULT_CACHE_ENABLED = True  # Reuse finished images for identical fixed-seed requests
+RESULT_CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+RESULT_CACHE_MAX_MB = 4096
+MAX_RESOLUTION = 2048      # Longest side decoded in one piece
+HIRES_MAX_RESOLUTION = 4096  # Longest side in high-res mode
+HIRES_DECODE_BUDGET_MB = 2048  # Peak memory for one VAE decode tile
+HIRES_TILE_OVERLAP = 8     # Latent pixels shared by neighbouring tiles
+HIRES_BASE_RESOLUTION = 1024  # Longest side of the first pass before upscale & refine
+HIRES_REFINE_STRENGTH = 0.35
+QUANTIZATION = "bf16"      # "bf16", "int8", "fp8" or "int4" weights for the transformer and text encoder
+QUANTIZATION_MODES = ("bf16", "int8", "fp8", "int4")
+QUANTIZED_DIR = LOCAL_MODEL_DIR + "_quantized"  # Quantized checkpoints and measured speeds
+COMPILE_ENABLED = False    # torch.compile the transformer per resolution bucket (see compile_cache.py)
+COMPILE_BUCKETS = ((1024, 1024), (1152, 896), (896, 1152), (1216, 832), (832, 1216),
+                   (1344, 768), (768, 1344), (512, 512))
+COMPILE_WARMUP_STEPS = 2   # Denoising steps per bucket during the background warmup
+COMPILE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compile_cache")
+VERIFY_MODEL = "quick"     # "quick" (sizes; files hashed once), "full" (rehash every start) or "off"
+MODEL_FORMAT = "shards"    # "shards" (as downloaded) or "consolidated" (one memory-mapped file per component)
+CONSOLIDATED_DIR = LOCAL_MODEL_DIR + "_consolidated"
+HISTORY_DIR = os.path.join(OUTPUT_DIR, ".history")  # Index and thumbnails of the history panel
+ADMISSION_ENABLED = True   # Predict each run's peak memory; queue, split, downscale or reject what won't fit
+ADMISSION_DOWNSCALE = True # Shrink requests that can never fit (False = reject them)
+ADMISSION_WAIT_TIMEOUT = 120  # Seconds a run waits for memory held by other programs before trying anyway
+IDLE_UNLOAD_MINUTES = 0    # Hand the weights' VRAM back after this long without requests (0 = never)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# --- GLOBAL VARIABLES ---
+pipe = None
+worker_pool = None  # Set by start_worker_pool; requests then run in worker processes
+compiler = None  # BucketCompiler while compiled mode is on
+step_hooks = []  # Called with no arguments after every denoising step (worker heartbeats)
+model_revision = None  # Identifies the loaded weights in result-cache keys
+offload_strategy = None
+pipe_lock = threading.RLock()  # Held while the pipeline runs, is placed or is reloaded
+model_ready = threading.Event()  # Set once loading has finished (successfully or not)
+memory_baseline = 0  # Bytes in use before the last run started (the weights, when resident)
+host_weights = HostWeights()  # Where resident weights go while idle
+quantization_summary = {}  # Component -> layers and weight bytes before/after quantization
+speed_stats = {}  # Weight precision -> mean seconds per step and megapixel
+load_state = {"state": "idle", "detail": "Model not loaded", "progress": 0.0, "error": None}
+timings = {"process_start": psutil.Process().create_time(), "first_paint": None, "ready": None, "model_load": None}
+prompt_cache = PromptEmbeddingCache(max_bytes=PROMPT_CACHE_MAX_MB * 1024**2)
+latent_cache = LatentCache(max_bytes=LATENT_CACHE_MAX_MB * 1024**2)
+tracer = Tracer(enabled=TRACING_ENABLED, trace_dir=TRACE_DIR)
+history = History(HISTORY_DIR, OUTPUT_DIR)
+
+def output_written(path, seconds):
+    tracer.observe("save", seconds)
+    history.add(path)
+
+output_writer = OutputWriter(
+    OUTPUT_DIR, fmt=OUTPUT_FORMAT, compress_level=OUTPUT_COMPRESS_LEVEL, quality=OUTPUT_QUALITY,
+    on_write=output_written
+)
+atexit.register(output_writer.close)
+tiled_vae = TiledVAE(budget_bytes=HIRES_DECODE_BUDGET_MB * 1024**2, overlap=HIRES_TILE_OVERLAP)
+result_cache = ResultCache(RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_MB * 1024**2) if RESULT_CACHE_ENABLED else None
+
+# --- LOAD MODEL ---
+def local_model_revision(quantization="bf16"):
+    """Hash of the local model_index.json plus the weight precision (None until downloaded)."""
+    index_path = os.path.join(LOCAL_MODEL_DIR, "model_index.json")
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    return f"{MODEL_ID}@{digest}:{'bfloat16' if quantization == 'bf16' else quantization}"
+
+def set_load_state(state, detail, progress):
+    load_state.update(state=state, detail=detail, progress=progress)
+
+def load_model(stub=False):
+    """Loads the pipeline into `pipe`. `stub=True` uses the CPU stand-in instead."""
+    global pipe, model_revision, compiler, host_weights
+    model_ready.clear()
+    load_state["error"] = None
+    quantization_summary.clear()
+    if compiler is not None:
+        compiler.stopped = True
+        compiler = None
+    host_weights = HostWeights()
+    # Cached embeddings came from the previous weights (a quantized encoder keeps its dtype, so the key can't tell)
+    prompt_cache.clear()
+    try:
+        if stub:
+            from stub_pipeline import StubPipeline
+            pipe = StubPipeline()
+            model_revision = "stub" if QUANTIZATION == "bf16" else f"stub:{QUANTIZATION}"
+            if QUANTIZATION != "bf16":
+                from quantization import quantize_model
+                quantization_summary["transformer"] = quantize_model(pipe.transformer, QUANTIZATION)
+            print("✅ Stub pipeline loaded (no model weights).")
+        else:
+            load_started = time.perf_counter()
+            set_load_state("loading", "Importing libraries", 0.05)
+            import torch
+            from diffusers import Flux2KleinPipeline
+            from model_store import ensure_model, format_load_times, prepare_consolidated, record_load_time
+            # Download directly into local folder (portable, no ~/.cache/huggingface used)
+            if VERIFY_MODEL != "off" or not os.path.exists(os.path.join(LOCAL_MODEL_DIR, "model_index.json")):
+                set_load_state("loading", "Checking model files", 0.1)
+
+                def report(message):
+                    print(message)
+                    if message.startswith("⏳"):
+                        set_load_state("loading", "Downloading model files", 0.15)
+
+                ensure_model(LOCAL_MODEL_DIR, MODEL_ID, full=VERIFY_MODEL == "full", progress=report)
+            model_revision = local_model_revision(QUANTIZATION)
+            components = {}
+            if QUANTIZATION != "bf16":
+                # Quantized once, then loaded from QUANTIZED_DIR on later startups
+                from quantization import QUANTIZED_COMPONENTS, prepare_component
+                set_load_state("loading", f"Preparing {QUANTIZATION} weights", 0.3)
+                for name in QUANTIZED_COMPONENTS:
+                    components[name], quantization_summary[name] = prepare_component(
+                        LOCAL_MODEL_DIR, name, QUANTIZATION, local_model_revision(),
+                        os.path.join(QUANTIZED_DIR, QUANTIZATION)
+                    )
+            if MODEL_FORMAT == "consolidated":
+                # Converted once, then memory-mapped without copies on later startups
+                set_load_state("loading", "Mapping consolidated weights", 0.4)
+                components.update(prepare_consolidated(
+                    LOCAL_MODEL_DIR, CONSOLIDATED_DIR, local_model_revision(), skip=components
+                ))
+            set_load_state("loading", "Loading weights", 0.5)
+            print(f"⏳ Loading model from {LOCAL_MODEL_DIR}...")
+            pipe = Flux2KleinPipeline.from_pretrained(LOCAL_MODEL_DIR, torch_dtype=torch.bfloat16, **components)
+            if MODEL_FORMAT == "consolidated":
+                host_weights.remember(pipe)  # Memory-mapped, so idle unloading needs no RAM copy
+            set_load_state("loading", "Placing weights", 0.9)
+            print(set_offload_strategy(OFFLOAD_STRATEGY))
+            timings["model_load"] = time.perf_counter() - load_started
+            kind, load_history = record_load_time(LOCAL_MODEL_DIR, timings["model_load"], MODEL_FORMAT, psutil.boot_time())
+            print(f"⏱️ Model load: {timings['model_load']:.1f}s ({kind}, {MODEL_FORMAT}) - {format_load_times(load_history)}")
+            print("✅ Model loaded successfully!")
+        if not latent_cache.install(pipe):
+            print("⚠️ Pipeline has no _encode_vae_image, img2img latents will not be cached.")
+        tiled_vae.install(pipe.vae)
+        if COMPILE_ENABLED:
+            start_compile_warmup()
+        import torch
+        # The uncalibrated prior is a guess about VRAM; on the CPU it would only shrink requests for nothing
+        admission.use_prior = torch.cuda.is_available()
+        idle.timeout = IDLE_UNLOAD_MINUTES * 60
+        idle.reset()
+        if idle.timeout:
+            idle.start()
+        timings["ready"] = time.time()
+        set_load_state("ready", "Ready", 1.0)
+        print(f"⏱️ Time to ready: {timings['ready'] - timings['process_start']:.1f}s")
+        return "Ready"
+    except Exception as e:
+        print(f"❌ Loading error: {e}")
+        load_state["error"] = str(e)
+        set_load_state("error", f"Error: {e}", load_state["progress"])
+        return f"Error: {e}"
+    finally:
+        model_ready.set()
+
+def start_background_load(stub=False):
+    """Loads the model on a background thread so the UI can be served meanwhile."""
+    set_load_state("loading", "Starting", 0.0)
+    thread = threading.Thread(target=load_model, kwargs={"stub": stub}, name="model-loader", daemon=True)
+    thread.start()
+    return thread
+
+def start_worker_pool(devices=None, per_device="auto", stub=False):
+    """Runs requests in one worker process per device (each loads its own pipeline)
+    instead of this process; the UI counts as ready once the first worker is."""
+    global worker_pool
+    from worker_pool import WorkerPool, detect_devices
+    set_load_state("loading", "Starting workers", 0.0)
+    worker_pool = WorkerPool(
+        devices or detect_devices(per_device), stub=stub, on_ready=worker_pool_ready, on_done=worker_job_done
+    )
+    return worker_pool.start()
+
+def worker_pool_ready(revision):
+    global model_revision
+    model_revision = revision
+    timings["ready"] = time.time()
+    set_load_state("ready", "Ready", 1.0)
+    model_ready.set()
+    print(f"⏱️ Time to ready: {timings['ready'] - timings['process_start']:.1f}s")
+
+def worker_job_done(request, trace):
+    """Finishes the trace of a request a worker served, from the worker's own trace."""
+    if trace is None or request.trace is None or not request.trace.enabled:
+        return
+    total = time.perf_counter() - request.submitted_at
+    spans = dict(trace["spans"])
+    # Time spent outside the worker (waiting for a free worker, sending the image back) is queueing too
+    spans["queue_wait"] = spans.get("queue_wait", 0.0) + max(0.0, total - spans.get("total", total))
+    spans["total"] = total
+    for name, seconds in spans.items():
+        request.trace.add(name, seconds)
+    for seconds in trace["steps"]:
+        request.trace.step(seconds)
+    request.trace.peak_rss = trace["peak_rss"]
+    request.trace.peak_vram = trace["peak_vram"]
+    tracer.finish(request.trace, mode=request.mode, batch_size=request.batch_size)
+
+def wait_until_ready(timeout=MODEL_WAIT_TIMEOUT):
+    """Blocks until the model is loaded; raises if loading failed or timed out."""
+    if not model_ready.wait(timeout):
+        raise RuntimeError("Timed out waiting for the model to load")
+    if pipe is None:
+        raise RuntimeError(f"Model not loaded! {load_state['error'] or ''}".strip())
+
+def record_first_paint():
+    """Called when the first browser session has rendered the UI."""
+    if timings["first_paint"] is None:
+        timings["first_paint"] = time.time()
+        print(f"⏱️ Time to first paint: {timings['first_paint'] - timings['process_start']:.1f}s")
+
+# --- COMPILED MODE ---
+def start_compile_warmup():
+    """Compiles the transformer and warms up every resolution bucket in the background."""
+    global compiler
+    if offload_strategy not in (None, "resident", "model"):
+        print(f"⚠️ Compiled mode needs the 'resident' or 'model' offload strategy, not '{offload_strategy}'.")
+        return None
+    from compile_cache import BucketCompiler, configure_cache
+    if configure_cache(COMPILE_CACHE_DIR):
+        print(f"⚙️ Loaded compile cache from {COMPILE_CACHE_DIR}")
+    compiler = BucketCompiler(pipe.transformer, COMPILE_BUCKETS, cache_dir=COMPILE_CACHE_DIR)
+    thread = threading.Thread(target=compiler.warm_all, args=(compile_warmup_run,), name="compile-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def compile_warmup_run(bucket):
+    """One short generation at `bucket`; the lock is released between runs so requests can interleave."""
+    import torch
+    width, height = bucket
+    with pipe_lock, torch.inference_mode():
+        pipe(
+            prompt_embeds=encode_prompt_cached(""), height=height, width=width,
+            num_inference_steps=COMPILE_WARMUP_STEPS, generator=torch.Generator(generator_device()).manual_seed(0),
+            max_sequence_length=MAX_SEQUENCE_LENGTH, output_type="latent"
+        )
+
+# --- QUANTIZATION ---
+def set_quantization(mode):
+    """Reloads the pipeline with `mode` weights; returns a summary for the status line."""
+    global QUANTIZATION, pipe
+    if mode not in QUANTIZATION_MODES:
+        return f"Error: Unknown quantization mode '{mode}'"
+    if worker_pool is not None:
+        return "Error: Weight precision can't be switched while using worker processes"
+    stub = (model_revision or "").startswith("stub")
+    with pipe_lock:
+        # Requests arriving meanwhile wait for the reload instead of seeing no pipeline
+        model_ready.clear()
+        QUANTIZATION = mode
+        pipe = None
+        gc.collect()
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        status = load_model(stub=stub)
+    return quantization_report() if status == "Ready" else status
+
+def speed_key(mode):
+    return f"stub:{mode}" if (model_revision or "").startswith("stub") else mode
+
+def load_speed_stats():
+    path = os.path.join(QUANTIZED_DIR, "speed.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            speed_stats.update(json.load(f))
+
+def record_speed(request, batch_size, seconds):
+    """Updates the running mean of seconds per step and megapixel for the loaded precision."""
+    work = batch_size * request.steps * request.width * request.height / 1e6
+    if work <= 0:
+        return
+    entry = speed_stats.setdefault(speed_key(QUANTIZATION), {"count": 0, "mean": 0.0})
+    entry["count"] += 1
+    entry["mean"] += (seconds / work - entry["mean"]) / entry["count"]
+    if (model_revision or "").startswith("stub"):
+        return
+    try:
+        os.makedirs(QUANTIZED_DIR, exist_ok=True)
+        with open(os.path.join(QUANTIZED_DIR, "speed.json"), "w", encoding="utf-8") as f:
+            json.dump(speed_stats, f, indent=2)
+    except OSError as e:
+        print(f"⚠️ Could not save speed stats: {e}")
+
+def format_bytes(n):
+    return f"{n / 1024**3:.1f}GB" if n >= 1024**3 else f"{n / 1024**2:.1f}MB"
+
+def quantization_report():
+    """e.g. "🗜️ int8 weights: 15.6GB → 8.3GB (7.3GB saved), 0.91x bf16 speed"."""
+    text = f"🗜️ {QUANTIZATION} weights"
+    if quantization_summary:
+        before = sum(s["bytes_before"] for s in quantization_summary.values())
+        after = sum(s["bytes_after"] for s in quantization_summary.values())
+        text += f": {format_bytes(before)} → {format_bytes(after)} ({format_bytes(before - after)} saved)"
+    if QUANTIZATION != "bf16":
+        baseline, current = speed_stats.get(speed_key("bf16")), speed_stats.get(speed_key(QUANTIZATION))
+        if baseline and current and current["mean"] > 0:
+            text += f", {baseline['mean'] / current['mean']:.2f}x bf16 speed"
+        else:
+            text += ", speed vs bf16 not measured yet"
+    return text
+
+load_speed_stats()
+
+# --- OFFLOAD STRATEGY ---
+def set_offload_strategy(strategy="auto", probe=measure_memory):
+    """(Re)applies an offload strategy to the loaded pipeline; "auto" measures free memory first."""
+    global offload_strategy, memory_baseline
+    if pipe is None:
+        return "Error: Model not loaded!"
+    if strategy != "auto" and strategy not in STRATEGIES:
+        return f"Error: Unknown offload strategy '{strategy}'"
+    import torch
+    try:
+        with pipe_lock:
+            reason = "selected manually"
+            if strategy == "auto":
+                # Measure with the weights back on the CPU, otherwise resident weights count as used
+                if torch.cuda.is_available():
+                    reset_offload(pipe)
+                    torch.cuda.empty_cache()
+                free_vram, free_ram = probe()
+                strategy, reason = choose_strategy(free_vram, free_ram, component_sizes(pipe))
+            apply_strategy(pipe, strategy, disk_dir=OFFLOAD_DISK_DIR)
+            if compiler is not None:
+                # Removing the old hooks restored the uncompiled forward
+                compiler.install()
+            offload_strategy = strategy
+            memory_baseline = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+            host_weights.released = 0
+            idle.reset()
+        return f"🧠 Offload: {strategy} ({reason})"
+    except Exception as e:
+        return f"❌ Offload error: {e}"
+
+# --- MEMORY ADMISSION & IDLE UNLOADING ---
+def memory_probe():
+    """(free, reclaimable) bytes of the memory runs use: VRAM with CUDA, RAM otherwise.
+
+    Reclaimable is what this process holds above the weights (finished runs' cached blocks).
+    """
+    import torch
+    if torch.cuda.is_available():
+        free = torch.cuda.mem_get_info()[0]
+        return free, max(0, torch.cuda.memory_reserved() - memory_baseline)
+    return psutil.virtual_memory().available, 0
+
+def memory_key(request):
+    """Runs with the same key share one calibration line (see admission.py)."""
+    return f"{model_revision}|{offload_strategy}|{request.mode}|{'tiled' if request.hires else 'full'}"
+
+def reload_bytes():
+    """VRAM the next run needs for bringing released weights back."""
+    return host_weights.released if idle.state == "unloaded" else 0
+
+def unload_weights():
+    """Idle policy hook: resident weights go to their host copies; False if that's not possible now."""
+    import torch
+    if pipe is None or offload_strategy != "resident" or not torch.cuda.is_available():
+        return False
+    if not pipe_lock.acquire(blocking=False):
+        return False  # A run, reload or strategy change is under way
+    try:
+        try:
+            freed = host_weights.release(pipe)
+        except Exception:
+            host_weights.restore(pipe)  # e.g. out of RAM for pinned copies: put back what already moved
+            raise
+        torch.cuda.empty_cache()
+    finally:
+        pipe_lock.release()
+    print(f"💤 Idle for {IDLE_UNLOAD_MINUTES} min, released {format_bytes(freed)} of VRAM.")
+    return True
+
+def reload_weights():
+    started = time.perf_counter()
+    host_weights.restore(pipe)
+    print(f"⚡ Weights back on the GPU in {time.perf_counter() - started:.2f}s.")
+
+def admit(request):
+    """Downscales or rejects a request that can't fit even with all our memory free (caller's thread)."""
+    decision = admission.decide(
+        memory_key(request), request.width, request.height, extra=reload_bytes(), downscale=ADMISSION_DOWNSCALE
+    )
+    if decision["action"] == "downscale":
+        print(f"📉 {request.width}x{request.height} needs ~{format_bytes(decision['need'])}, "
+              f"running at {decision['width']}x{decision['height']} instead.")
+        request.requested_size = (request.width, request.height)
+        request.width, request.height = decision["width"], decision["height"]
+    elif decision["action"] == "reject":
+        raise RuntimeError(
+            f"Not enough memory for {request.width}x{request.height}: needs ~{format_bytes(decision['need'])}, "
+            f"{format_bytes(decision['available'])} available"
+        )
+    return decision
+
+def max_batch(request, limit):
+    """How many requests like this one fit in memory at once, up to `limit`."""
+    if not ADMISSION_ENABLED or worker_pool is not None or limit <= 1:
+        return limit
+    return admission.max_batch(memory_key(request), request.width, request.height, limit, extra=reload_bytes())
+
+def wait_for_memory(requests, check_cancelled):
+    """Waits (without the pipeline lock) until the batch fits in free memory."""
+    first = requests[0]
+    if not admission.wait(
+        memory_key(first), first.width, first.height, len(requests), extra=reload_bytes(),
+        timeout=ADMISSION_WAIT_TIMEOUT, cancelled=lambda: all(r.is_cancelled() for r in requests)
+    ):
+        check_cancelled(None, -1, None, {})  # Cancelled while waiting for memory
+        print("⚠️ Still short of memory, trying anyway.")
+
+@contextlib.contextmanager
+def admitted(requests):
+    """Brings released weights back, then records the run's peak memory above the
+    baseline to calibrate the predictor.
+
+    Yields an RssPeak step callback on the CPU (None with CUDA).
+    """
+    global memory_baseline
+    import torch
+    first = requests[0]
+    key = memory_key(first)
+    with idle.active():
+        cuda = torch.cuda.is_available()
+        rss_peak = None
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+            memory_baseline = torch.cuda.memory_allocated()
+        else:
+            rss_peak = RssPeak()
+            memory_baseline = rss_peak.baseline
+        yield rss_peak
+        if cuda:
+            peak = torch.cuda.max_memory_allocated()
+        else:
+            rss_peak.sample()
+            peak = rss_peak.peak
+    memory_predictor.observe(key, megapixels(first.width, first.height, len(requests)), peak - memory_baseline)
+    if not (model_revision or "").startswith("stub"):
+        memory_predictor.save()
+
+memory_predictor = MemoryPredictor(os.path.join(QUANTIZED_DIR, "memory.json"))
+admission = AdmissionController(memory_predictor, memory_probe, use_prior=False)  # See load_model
+idle = IdlePolicy(unload_weights, reload_weights, timeout=IDLE_UNLOAD_MINUTES * 60)
+
+# --- PROMPT ENCODING ---
+def encode_prompt_cached(prompt):
+    """Returns prompt embeddings, running the text encoder only on a cache miss."""
+    device = pipe._execution_device
+
+    def encode(text):
+        prompt_embeds, _ = pipe.encode_prompt(
+            prompt=text, device=device, max_sequence_length=MAX_SEQUENCE_LENGTH
+        )
+        return prompt_embeds
+
+    return prompt_cache.get_or_encode(
+        prompt, encode, max_sequence_length=MAX_SEQUENCE_LENGTH,
+        dtype=pipe.text_encoder.dtype, device=device
+    )
+
+# --- GENERATE IMAGE ---
+def combine_step_callbacks(callbacks):
+    """Chains several callback_on_step_end functions into one."""
+    def callback(pipe, step, timestep, callback_kwargs):
+        for fn in callbacks:
+            callback_kwargs = fn(pipe, step, timestep, callback_kwargs) or callback_kwargs
+        return callback_kwargs
+    return callback
+
+def run_step_hooks(pipe, step, timestep, callback_kwargs):
+    for hook in step_hooks:
+        hook()
+    return callback_kwargs
+
+def generator_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def release_memory():
+    """Frees what an aborted run left behind: activations, cached blocks, offloaded models."""
+    gc.collect()
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    with pipe_lock:
+        if pipe is not None and hasattr(pipe, "maybe_free_model_hooks"):
+            pipe.maybe_free_model_hooks()
+
+def run_batch(requests):
+    """Runs a batch of compatible requests as one pipeline call (scheduler thread),
+    or in several smaller ones when the whole batch would not fit in memory."""
+    size = max_batch(requests[0], len(requests))
+    if size < len(requests):
+        print(f"✂️ Batch of {len(requests)} doesn't fit in memory, running {size} at a time.")
+        images = []
+        for i in range(0, len(requests), size):
+            chunk = requests[i:i + size]
+            for r in chunk:
+                r.batch_size = len(chunk)
+            try:
+                images += run_batch(chunk)
+            except GenerationCancelled:
+                images += [None] * len(chunk)  # Their futures have already failed
+        return images
+    try:
+        return run_pipeline(requests)
+    except GenerationCancelled as e:
+        reason = e.reason
+    # Outside the except block the aborted run's frames, and the tensors they hold, are gone
+    release_memory()
+    print(f"🛑 Generation stopped ({reason}).")
+    raise GenerationCancelled(reason)
+
+def run_pipeline(requests):
+    # Requests submitted during warm-up wait here instead of being rejected
+    wait_until_ready()
+    import torch
+    import numpy as np
+    first = requests[0]
+    check_cancelled = cancel_callback(requests)
+    check_cancelled(None, -1, None, {})  # Cancelled while queued behind the model load
+    batch_trace = BatchTrace([r.trace or NULL_TRACE for r in requests])
+    if ADMISSION_ENABLED:
+        wait_for_memory(requests, check_cancelled)
+    try:
+        with pipe_lock, torch.inference_mode(), admitted(requests) as rss_peak:
+            started = time.perf_counter()
+            for r in requests:
+                (r.trace or NULL_TRACE).add("queue_wait", started - r.submitted_at)
+            with batch_trace.span("encode"):
+                prompt_embeds = torch.cat([encode_prompt_cached(r.prompt) for r in requests])
+            generators = [torch.Generator(generator_device()).manual_seed(r.seed) for r in requests]
+            # Compiled mode runs at the nearest bucket; sizes far from every bucket run eagerly
+            width, height = first.width, first.height
+            bucket = compiler.snap(width, height) if compiler is not None else None
+            if bucket is not None:
+                width, height = bucket
+            kwargs = dict(
+                prompt_embeds=prompt_embeds, height=height, width=width,
+                num_inference_steps=first.steps, guidance_scale=first.guidance,
+                generator=generators if len(generators) > 1 else generators[0],
+                max_sequence_length=MAX_SEQUENCE_LENGTH
+            )
+            if first.input_image is not None:
+                # Image-to-Image: use strength to shorten the sigma schedule
+                steps = first.steps
+                full_sigmas = np.linspace(1.0, 1 / steps, steps)
+                start = int(round(steps * (1 - first.strength)))
+                kwargs["image"] = first.input_image
+                kwargs["sigmas"] = full_sigmas[start:].tolist()
+            # Checked at the end of every denoising step, so a cancel stops within one step
+            step_callbacks = [check_cancelled]
+            if batch_trace.enabled:
+                step_callbacks.append(batch_trace.on_step_end)
+            if rss_peak is not None:
+                step_callbacks.append(rss_peak)
+            preview = None
+            if any(r.on_preview is not None for r in requests):
+                from previews import PreviewCallback
+                preview = PreviewCallback(
+                    requests, height, width, interval=PREVIEW_INTERVAL,
+                    max_overhead=PREVIEW_MAX_OVERHEAD, max_size=PREVIEW_MAX_SIZE
+                )
+                step_callbacks.append(preview)
+            if step_hooks:
+                step_callbacks.append(run_step_hooks)
+            if batch_trace.enabled:
+                # Previews rendered at a step's end don't count towards the next step's time
+                step_callbacks.append(batch_trace.resume)
+            kwargs["callback_on_step_end"] = combine_step_callbacks(step_callbacks)
+            kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+            batch_trace.begin_pipeline()
+            pipeline_started = time.perf_counter()
+            eager = compiler.eager(bucket is None) if compiler is not None else contextlib.nullcontext()
+            with latent_cache.source(first.input_digest), tiled_vae.active(first.hires), eager:
+                images = pipe(**kwargs).images
+            if bucket is not None:
+                from compile_cache import fit_to_size
+                images = [fit_to_size(image, r.width, r.height) for image, r in zip(images, requests)]
+            record_speed(first, len(requests), time.perf_counter() - pipeline_started)
+            batch_trace.end_pipeline()
+            if preview is not None:
+                batch_trace.add("preview", preview.overhead)
+
+        if batch_trace.enabled:
+            peak_vram = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+            finished = time.perf_counter()
+            for r in requests:
+                if r.trace is not None and r.trace.enabled:
+                    r.trace.peak_vram = peak_vram
+                    r.trace.add("total", finished - r.submitted_at)
+                    tracer.finish(r.trace, mode=r.mode, batch_size=len(requests))
+        return images
+    finally:
+        # Resident weights stay put, so there is nothing to hand back
+        if torch.cuda.is_available() and offload_strategy != "resident":
+            torch.cuda.empty_cache()
+
+scheduler = BatchScheduler(run_batch, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_WAIT_MS / 1000)
+
+# --- METRICS ---
+tracer.registry.gauge("prompt_cache_hits", lambda: prompt_cache.hits, help="Prompt embedding cache hits")
+tracer.registry.gauge("prompt_cache_misses", lambda: prompt_cache.misses, help="Prompt embedding cache misses")
+tracer.registry.gauge("latent_cache_hits", lambda: latent_cache.hits, help="img2img source latent cache hits")
+tracer.registry.gauge("result_cache_hits", lambda: result_cache.hits if result_cache else 0, help="Result cache hits")
+tracer.registry.gauge("compiled_buckets", lambda: len(compiler.report) if compiler else 0, help="Resolution buckets warmed up")
+tracer.registry.gauge("model_load_seconds", lambda: timings["model_load"] or 0, help="Seconds the last model load took")
+tracer.registry.gauge("requests_cancelled", lambda: scheduler.cancelled, help="Requests cancelled or past their deadline")
+tracer.registry.gauge("requests_downscaled", lambda: admission.decisions["downscale"], help="Requests shrunk to fit in memory")
+tracer.registry.gauge("requests_rejected", lambda: admission.decisions["reject"], help="Requests too large for the memory")
+tracer.registry.gauge("weights_released", lambda: int(idle.state == "unloaded"), help="1 while idle weights are off the GPU")
+tracer.registry.gauge("model_ready", lambda: int(load_state["state"] == "ready"), help="1 once the model is loaded")
+
+def configure_tracing(enabled=True, trace_dir=None):
+    tracer.enabled = enabled
+    tracer.trace_dir = trace_dir
+
+def make_request(prompt, input_image=None, width=1024, height=1024, steps=4, guidance=1.0, seed=-1,
+                 strength=0.8, hires=False, priority=PRIORITY_INTERACTIVE, timeout=None):
+    """Builds a GenerationRequest, drawing a random seed for -1/None.
+
+    Sizes above MAX_RESOLUTION always use high-res mode (tiled VAE decode).
+    `timeout` defaults to GENERATION_TIMEOUT.
+    """
+    if seed == -1 or seed is None:
+        seed = random.randint(0, 2**32 - 1)
+    if max(width, height) > HIRES_MAX_RESOLUTION:
+        raise ValueError(f"Width and height are limited to {HIRES_MAX_RESOLUTION}px")
+    return GenerationRequest(
+        prompt, width, height, steps, guidance, seed, input_image=input_image, strength=strength,
+        hires=hires or max(width, height) > MAX_RESOLUTION, priority=priority,
+        timeout=timeout if timeout is not None else (GENERATION_TIMEOUT or None)
+    )
+
+# --- UPSCALE & REFINE ---
+def base_request(request):
+    """First pass of upscale & refine: the same prompt and seed at HIRES_BASE_RESOLUTION."""
+    scale = min(1.0, HIRES_BASE_RESOLUTION / max(request.width, request.height))
+    width = max(64, int(request.width * scale) // 64 * 64)
+    height = max(64, int(request.height * scale) // 64 * 64)
+    return make_request(
+        request.prompt, request.input_image, width, height, request.steps, request.guidance,
+        request.seed, request.strength, priority=request.priority, timeout=request.timeout
+    )
+
+def refine_request(request, base_image):
+    """Second pass: img2img at full size from the Lanczos-upscaled first pass."""
+    from PIL import Image
+    upscaled = base_image.resize((request.width, request.height), Image.LANCZOS)
+    return make_request(
+        request.prompt, upscaled, request.width, request.height, request.steps, request.guidance,
+        request.seed, HIRES_REFINE_STRENGTH, hires=True, priority=request.priority, timeout=request.timeout
+    )
+
+def submit(request):
+    """Queues a request on the batch scheduler and returns its Future.
+
+    While the model is still loading the request simply waits in the queue.
+    """
+    if load_state["state"] in ("idle", "error"):
+        raise RuntimeError(f"Model not loaded! {load_state['error'] or ''}".strip())
+    request.input_digest = image_digest(request.input_image)
+    if result_cache is not None and model_revision is not None and cached_result(request):
+        return request.future
+
+    if ADMISSION_ENABLED and worker_pool is None and load_state["state"] == "ready":
+        # Workers make this call themselves, with their own device's memory
+        admit(request)
+        # A downscaled result is stored under its actual size, so look that up too
+        if request.requested_size is not None and request.cache_key is not None and cached_result(request):
+            return request.future
+
+    print(f"🎨 Generating ({request.mode}): '{request.prompt}'")
+    request.trace = tracer.start()
+    future = (worker_pool or scheduler).submit(request)
+    if request.cache_key is not None:
+        future.add_done_callback(lambda f: remember_result(request, f))
+    return future
+
+def cached_result(request):
+    """Resolves the request's Future from the result cache; False on a miss.
+
+    Lookup runs on the caller's thread, never on the scheduler thread.
+    """
+    request.cache_key = result_key(output_params(request, 0), model_revision, request.input_digest)
+    cached = result_cache.lookup(request.cache_key)
+    if cached is None:
+        return False
+    print(f"♻️ Cached result ({request.mode}): '{request.prompt}'")
+    request.cache_hit = True
+    request.future.set_result(cached)
+    return True
+
+def cancel(request, reason="cancelled"):
+    """Stops a request: dropped from the queue, or aborted at its next denoising step."""
+    (worker_pool or scheduler).cancel(request, reason)
+
+def remember_result(request, future):
+    """Stores a finished image in the result cache (in the background)."""
+    if future.exception() is None:
+        result_cache.store(request.cache_key, future.result(), output_params(request, 0))
+
+def output_params(request, elapsed_time):
+    """Generation parameters embedded in the saved file."""
+    return {
+        "prompt": request.prompt, "seed": request.seed, "width": request.width, "height": request.height,
+        "steps": request.steps, "guidance": request.guidance, "mode": request.mode,
+        "strength": request.strength if request.input_image is not None else None,
+        "hires": request.hires or None,
+        "model": MODEL_ID, "elapsed": round(elapsed_time, 3),
+    }
+
+def generate(request):
+    """Runs one request to completion; returns (image, elapsed seconds)."""
+    start_time = time.time()
+    image = submit(request).result()
+    return image, time.time() - start_time
+
+def generate_stream(request, poll_interval=0.1):
+    """Runs one request, yielding ("preview", image, (step, total)) while it denoises
+    and finally ("done", image, elapsed seconds)."""
+    previews = queue.Queue()
+    request.on_preview = lambda image, step, total: previews.put((image, step, total))
+    start_time = time.time()
+    future = submit(request)
+    while True:
+        try:
+            image, step, total = previews.get(timeout=poll_interval)
+        except queue.Empty:
+            if future.done():
+                break
+            continue
+        yield "preview", image, (step, total)
+    image = future.result()
+    yield "done", image, time.time() - start_time
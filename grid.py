@@ -0,0 +1,144 @@
+import random
+import textwrap
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from PIL import Image, ImageDraw, ImageFont
+
+# --- PROMPT x SEED GRID ---
+# Runs N prompts against M values of one setting (seed, steps or strength) as a
+# single job. Cells are queued grouped by batch key, so cells that can share a
+# pipeline call reach the scheduler together, and the number queued at once is
+# capped by what admission control says fits in memory. Each prompt is encoded once (the other cells hit
+# the prompt cache). Finished cells are yielded as they arrive; a labelled
+# contact sheet is assembled at the end.
+
+AXES = ("seed", "steps", "strength")
+SHEET_BACKGROUND = (13, 15, 24)
+SHEET_TEXT = (240, 240, 245)
+
+
+def parse_values(text, axis):
+    """Parses "1,2,5", "10-13" (integer range) or "0.2:0.8:0.2" (start:stop:step)."""
+    if axis not in AXES:
+        raise ValueError(f"Unknown grid axis '{axis}' (choose from {', '.join(AXES)})")
+    cast = float if axis == "strength" else int
+    values = []
+    for part in str(text).replace(" ", "").split(","):
+        if not part:
+            continue
+        if ":" in part:
+            start, stop, step = (float(v) for v in part.split(":"))
+            if step <= 0:
+                raise ValueError(f"Step must be positive in '{part}'")
+            count = int(round((stop - start) / step)) + 1
+            values.extend(cast(round(start + i * step, 6)) for i in range(count))
+        elif "-" in part[1:] and cast is int:
+            split = part.index("-", 1)
+            values.extend(range(int(part[:split]), int(part[split + 1:]) + 1))
+        else:
+            values.append(cast(part))
+    if not values:
+        raise ValueError(f"No {axis} values given")
+    return values
+
+
+class GridCell:
+    """One (prompt, value) cell: its request, position and, once finished, its image."""
+
+    def __init__(self, row, col, request, label):
+        self.row = row
+        self.col = col
+        self.request = request
+        self.label = label
+        self.image = None
+        self.elapsed = None
+        self.started = None
+
+    def filename(self, extension):
+        return f"r{self.row:02d}_c{self.col:02d}_{self.label.replace(' ', '')}{extension}"
+
+
+def plan_grid(make_request, prompts, axis, values, **settings):
+    """One cell per prompt and value; `settings` are the shared make_request arguments.
+
+    When the axis is not the seed, one random seed is drawn for the whole grid so
+    the cells differ only in the swept setting.
+    """
+    if axis not in AXES:
+        raise ValueError(f"Unknown grid axis '{axis}' (choose from {', '.join(AXES)})")
+    if axis != "seed" and settings.get("seed", -1) in (-1, None):
+        settings["seed"] = random.randint(0, 2**32 - 1)
+    cells = []
+    for row, prompt in enumerate(prompts):
+        for col, value in enumerate(values):
+            request = make_request(prompt, **{**settings, axis: value})
+            cells.append(GridCell(row, col, request, f"{axis} {value}"))
+    return cells
+
+
+def submission_order(cells):
+    """Cells grouped by batch key, so cells that can share a pipeline call are queued together."""
+    groups = OrderedDict()
+    for cell in cells:
+        groups.setdefault(cell.request.batch_key(), []).append(cell)
+    return [cell for group in groups.values() for cell in group]
+
+
+def run_grid(submit, cells, max_in_flight, clock=time.perf_counter, cancel=None):
+    """Submits cells with `submit(request) -> Future`, keeping at most `max_in_flight`
+    queued, and yields every cell as soon as its image is ready.
+
+    If a cell fails or the caller stops iterating, the cells still queued are
+    passed to `cancel(request)`.
+    """
+    pending = submission_order(cells)
+    in_flight = {}
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                cell = pending.pop(0)
+                cell.started = clock()
+                in_flight[submit(cell.request)] = cell
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                cell = in_flight.pop(future)
+                cell.image = future.result()
+                cell.elapsed = clock() - cell.started
+                yield cell
+    finally:
+        if cancel is not None:
+            for future, cell in in_flight.items():
+                if not future.done():
+                    cancel(cell.request)
+
+
+def contact_sheet(cells, row_labels, col_labels, thumb_size=256, label_width=200, padding=8):
+    """Lays finished cells out in a labelled grid (prompts down, values across)."""
+    font = ImageFont.load_default()
+    first = next(cell.image for cell in cells if cell.image is not None)
+    thumb_w = thumb_size
+    thumb_h = max(1, round(thumb_size * first.height / first.width))
+    header = 24
+    sheet = Image.new(
+        "RGB",
+        (label_width + len(col_labels) * (thumb_w + padding) + padding,
+         header + len(row_labels) * (thumb_h + padding) + padding),
+        SHEET_BACKGROUND
+    )
+    draw = ImageDraw.Draw(sheet)
+    for col, label in enumerate(col_labels):
+        draw.text((label_width + col * (thumb_w + padding) + padding, 6), label, fill=SHEET_TEXT, font=font)
+    line_height = 14
+    for row, label in enumerate(row_labels):
+        lines = textwrap.wrap(label, width=max(8, label_width // 7))[:thumb_h // line_height]
+        for i, line in enumerate(lines):
+            draw.text((padding, header + row * (thumb_h + padding) + i * line_height), line, fill=SHEET_TEXT, font=font)
+    for cell in cells:
+        if cell.image is None:
+            continue
+        thumb = cell.image.convert("RGB").resize((thumb_w, thumb_h), Image.LANCZOS)
+        sheet.paste(thumb, (label_width + cell.col * (thumb_w + padding) + padding,
+                            header + cell.row * (thumb_h + padding)))
+    return sheet
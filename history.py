@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# --- OUTPUT HISTORY ---
+# A SQLite index of every image under the output folder (prompt, seed, settings,
+# timing and path), read back from the parameters the output writer embeds in
+# each file. Pages are fetched with keyset pagination on (created, id), so the
+# newest page and the thousandth cost the same, and prompt search goes through
+# an FTS5 index when SQLite has it (a LIKE scan otherwise). Thumbnails are made
+# on first view by a small thread pool and kept on disk next to the index.
+# A scan at startup brings in files that are new or changed since the last run
+# and drops entries whose files are gone.
+
+IMAGE_EXTENSIONS = (".png", ".webp", ".jpg", ".jpeg")
+EXIF_IMAGE_DESCRIPTION = 0x010E
+PAGE_SIZE = 48
+THUMB_SIZE = 256
+SCAN_BATCH = 500  # Files indexed per transaction
+COLUMNS = ("id", "path", "created", "prompt", "seed", "width", "height", "steps", "guidance",
+           "strength", "mode", "elapsed", "params")
+
+
+def read_parameters(path):
+    """Generation parameters embedded in an image (PNG "parameters" text or EXIF), or {}."""
+    try:
+        with Image.open(path) as image:
+            text = image.info.get("parameters")
+            if text is None and image.format in ("WEBP", "JPEG"):
+                text = image.getexif().get(EXIF_IMAGE_DESCRIPTION)
+            size = image.size
+    except OSError:
+        return None
+    params = {}
+    if text:
+        try:
+            params = json.loads(text)
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            params = {"prompt": str(text)}
+    params.setdefault("width", size[0])
+    params.setdefault("height", size[1])
+    return params
+
+
+def fts_query(text):
+    """Each word of `text` as a quoted FTS5 prefix term (so user input can't break the syntax)."""
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+class History:
+    """Index of generated images with paginated prompt search and cached thumbnails.
+
+    `page()` returns (rows, cursor); pass the cursor back for the next page.
+    The folder and the index are created on first use, not when the index is built.
+    """
+
+    def __init__(self, root, output_dir, thumb_size=THUMB_SIZE, workers=2):
+        self.root = root
+        self.output_dir = output_dir
+        self.thumb_size = thumb_size
+        self.thumb_dir = os.path.join(root, "thumbs")
+        self.thumbs_made = 0
+        self.fts = None  # Whether SQLite has FTS5; known once the index is created
+        self._db_path = os.path.join(root, "history.sqlite")
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-thumbs")
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._create_lock = threading.Lock()
+
+    def _create(self):
+        with self._create_lock:
+            if self.fts is not None:
+                return
+            os.makedirs(self.thumb_dir, exist_ok=True)
+            db = sqlite3.connect(self._db_path, timeout=30)
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS images ("
+                    " id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL,"
+                    " created REAL NOT NULL, prompt TEXT, seed INTEGER, width INTEGER, height INTEGER,"
+                    " steps INTEGER, guidance REAL, strength REAL, mode TEXT, elapsed REAL, params TEXT)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS images_created ON images(created, id)")
+                try:
+                    db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5("
+                               "prompt, content='images', content_rowid='id')")
+                    db.execute("CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN"
+                               " INSERT INTO images_fts(rowid, prompt) VALUES (new.id, new.prompt); END")
+                    db.execute("CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN"
+                               " INSERT INTO images_fts(images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END")
+                    fts = True
+                except sqlite3.OperationalError:
+                    fts = False  # SQLite built without FTS5
+            db.close()
+            self.fts = fts
+
+    def _connect(self):
+        """One connection per thread; WAL lets the UI read while the scanner writes."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self._create()
+            db = sqlite3.connect(self._db_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _row(self, path, stat):
+        params = read_parameters(path)
+        if params is None:
+            return None
+        prompt = params.get("prompt")
+        if prompt is None and params.get("prompts"):
+            prompt = " | ".join(params["prompts"])  # Grid contact sheets
+        return (
+            os.path.abspath(path), stat.st_mtime, stat.st_size, stat.st_mtime, prompt, params.get("seed"),
+            params.get("width"), params.get("height"), params.get("steps"), params.get("guidance"),
+            params.get("strength"), params.get("mode"), params.get("elapsed"), json.dumps(params, default=str),
+        )
+
+    def _insert(self, db, rows):
+        # Replacing goes through DELETE + INSERT so the FTS triggers see both
+        db.executemany("DELETE FROM images WHERE path = ?", [(row[0],) for row in rows])
+        db.executemany(
+            "INSERT INTO images (path, mtime, size, created, prompt, seed, width, height, steps,"
+            " guidance, strength, mode, elapsed, params) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def add(self, path):
+        """Indexes one file (e.g. right after the output writer saved it)."""
+        try:
+            row = self._row(path, os.stat(path))
+        except OSError:
+            return False
+        if row is None:
+            return False
+        db = self._connect()
+        with db:
+            self._insert(db, [row])
+        return True
+
+    def scan(self):
+        """Indexes new or changed files under the output folder and forgets deleted ones;
+        returns counts. Hidden folders (the result cache, this index) are skipped."""
+        with self._scan_lock:
+            db = self._connect()
+            known = {path: (mtime, size) for path, mtime, size in db.execute("SELECT path, mtime, size FROM images")}
+            seen, batch = set(), []
+            added = 0
+            for root, dirs, files in os.walk(self.output_dir):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for name in files:
+                    if not name.lower().endswith(IMAGE_EXTENSIONS) or name.startswith("."):
+                        continue
+                    path = os.path.abspath(os.path.join(root, name))
+                    seen.add(path)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if known.get(path) == (stat.st_mtime, stat.st_size):
+                        continue
+                    row = self._row(path, stat)
+                    if row is not None:
+                        batch.append(row)
+                    if len(batch) >= SCAN_BATCH:
+                        with db:
+                            self._insert(db, batch)
+                        added += len(batch)
+                        batch = []
+            if batch:
+                with db:
+                    self._insert(db, batch)
+                added += len(batch)
+            removed = [path for path in known if path not in seen]
+            with db:
+                db.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in removed])
+            for path in removed:
+                thumb = self.thumb_path(path, *known[path])
+                if os.path.exists(thumb):
+                    os.remove(thumb)
+            return {"files": len(seen), "added": added, "removed": len(removed)}
+
+    def start_scan(self):
+        thread = threading.Thread(target=self._scan_logged, name="history-scan", daemon=True)
+        thread.start()
+        return thread
+
+    def _scan_logged(self):
+        started = time.perf_counter()
+        try:
+            counts = self.scan()
+            if counts["added"] or counts["removed"]:
+                print(f"🕘 History: {counts['added']} images indexed, {counts['removed']} removed "
+                      f"({time.perf_counter() - started:.1f}s)")
+        except Exception as e:
+            print(f"❌ History scan failed: {e}")
+
+    def page(self, query="", cursor=None, limit=PAGE_SIZE):
+        """Newest first. `query` matches prompt words (prefixes); `cursor` continues a listing."""
+        db = self._connect()
+        where, args = [], []
+        if cursor is not None:
+            # A row-value comparison lets SQLite seek in images_created instead of scanning from the top
+            where.append("(images.created, images.id) < (?, ?)")
+            args += [cursor[0], cursor[1]]
+        query = (query or "").strip()
+        source = "images"
+        if query and self.fts and fts_query(query):
+            source = "images JOIN images_fts ON images_fts.rowid = images.id"
+            where.append("images_fts MATCH ?")
+            args.append(fts_query(query))
+        elif query:
+            where.append("images.prompt LIKE ?")
+            args.append(f"%{query}%")
+        sql = (f"SELECT {', '.join('images.' + c for c in COLUMNS)} FROM {source}"
+               + (f" WHERE {' AND '.join(where)}" if where else "")
+               + " ORDER BY images.created DESC, images.id DESC LIMIT ?")
+        rows = [dict(zip(COLUMNS, row)) for row in db.execute(sql, args + [limit])]
+        next_cursor = (rows[-1]["created"], rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_cursor
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def thumb_path(self, path, mtime, size):
+        key = hashlib.sha1(f"{path}|{mtime}|{size}|{self.thumb_size}".encode("utf-8")).hexdigest()
+        return os.path.join(self.thumb_dir, key[:2], key + ".jpg")
+
+    def thumbnail(self, row):
+        """Future of the thumbnail path for a page row; made in the background on first use."""
+        path = row["path"]
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            return self._executor.submit(self._missing, e)
+        thumb = self.thumb_path(path, stat.st_mtime, stat.st_size)
+        with self._lock:
+            future = self._pending.get(thumb)
+            if future is None:
+                future = self._executor.submit(self._make_thumbnail, path, thumb)
+                self._pending[thumb] = future
+                future.add_done_callback(lambda f, thumb=thumb: self._done(thumb))
+            return future
+
+    def _done(self, thumb):
+        with self._lock:
+            self._pending.pop(thumb, None)
+
+    @staticmethod
+    def _missing(error):
+        raise error
+
+    def _make_thumbnail(self, path, thumb):
+        if os.path.exists(thumb):
+            return thumb
+        with Image.open(path) as image:
+            image.draft("RGB", (self.thumb_size, self.thumb_size))  # JPEG: decode at a reduced scale
+            image = image.convert("RGB")
+            image.thumbnail((self.thumb_size, self.thumb_size), Image.BILINEAR, reducing_gap=2.0)
+        os.makedirs(os.path.dirname(thumb), exist_ok=True)
+        tmp_path = thumb + ".tmp"
+        image.save(tmp_path, format="JPEG", quality=85)
+        os.replace(tmp_path, thumb)
+        with self._lock:
+            self.thumbs_made += 1
+        return thumb
+
+    def thumbnails(self, rows):
+        """Thumbnail paths for a page (None where the image can't be read)."""
+        paths = []
+        for future in [self.thumbnail(row) for row in rows]:
+            try:
+                paths.append(future.result())
+            except Exception:
+                paths.append(None)
+        return paths
+
+    def prefetch(self, rows):
+        """Starts thumbnails for rows the user is likely to open next, without waiting."""
+        for row in rows:
+            self.thumbnail(row)
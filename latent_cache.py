@@ -0,0 +1,56 @@
+import threading
+from contextlib import contextmanager
+
+from prompt_cache import TensorLRUCache
+
+# --- IMG2IMG SOURCE LATENT CACHE ---
+# Strength and prompt sweeps over the same uploaded image re-encode it with the
+# VAE on every call (and, under CPU offload, load the VAE for it). The pipeline's
+# _encode_vae_image is wrapped so that encoded source latents are kept on the CPU
+# and reused, keyed by the image's content hash, target resolution and dtype.
+# The Flux.2 pipeline encodes condition images with the distribution's mode
+# ("argmax"), so a cached latent is identical to a fresh one.
+
+
+class LatentCache(TensorLRUCache):
+    """LRU cache of VAE-encoded source images, installed on a pipeline with `install`."""
+
+    def __init__(self, max_bytes=1024**3, max_entries=64):
+        super().__init__(max_bytes=max_bytes, max_entries=max_entries)
+        self._context = threading.local()
+
+    @staticmethod
+    def make_key(digest, height, width, dtype):
+        return (digest, int(height), int(width), str(dtype))
+
+    @contextmanager
+    def source(self, digest):
+        """Marks the image being encoded on this thread; outside of it nothing is cached."""
+        previous = getattr(self._context, "digest", None)
+        self._context.digest = digest
+        try:
+            yield
+        finally:
+            self._context.digest = previous
+
+    def install(self, pipe):
+        """Wraps `pipe._encode_vae_image`; returns False if the pipeline has none."""
+        original = getattr(pipe, "_encode_vae_image", None)
+        if original is None:
+            return False
+        if getattr(original, "latent_cache", None) is self:
+            return True
+
+        def encode_vae_image(image, *args, **kwargs):
+            digest = getattr(self._context, "digest", None)
+            if digest is None:
+                return original(image, *args, **kwargs)
+            key = self.make_key(digest, image.shape[-2], image.shape[-1], image.dtype)
+            latents = self.get(key)
+            if latents is None:
+                latents = self.put(key, original(image, *args, **kwargs))
+            return latents.to(image.device)
+
+        encode_vae_image.latent_cache = self
+        pipe._encode_vae_image = encode_vae_image
+        return True
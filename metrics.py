@@ -0,0 +1,309 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+# --- LATENCY TRACING & METRICS ---
+# Each request gets a Trace with stage spans (queue wait, prompt encoding,
+# denoising steps, VAE decode, ...). Finished traces feed histograms that are
+# served in the Prometheus text format, and can optionally be dumped as JSON.
+# With tracing disabled every request shares NULL_TRACE, whose methods do nothing.
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(gb * 1024**3 for gb in (1, 2, 4, 6, 8, 12, 16, 24, 32, 48, 64, 96))
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Bucket upper bound below which a fraction `q` of observations fall."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class MetricsRegistry:
+    """Histograms, counters and callback gauges, rendered as Prometheus text."""
+
+    def __init__(self, prefix="flux"):
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, help="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+                self._help.setdefault(name, help)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, help="", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._help.setdefault(name, help)
+
+    def gauge(self, name, fn, help=""):
+        """Registers a gauge whose value is read from `fn()` at scrape time."""
+        self._gauges[name] = fn
+        self._help.setdefault(name, help)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                if self._help.get(name):
+                    lines.append(f"# HELP {self.prefix}_{name} {self._help[name]}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), h in histograms:
+            declare(name, "histogram")
+            labels = dict(labels)
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f"{self.prefix}_{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {h.count}")
+            lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {h.total}")
+            lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {h.count}")
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{self.prefix}_{name}{format_labels(dict(labels))} {value}")
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            declare(name, "gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class NullTrace:
+    """Stand-in used when tracing is off: every call is a no-op."""
+
+    enabled = False
+
+    def span(self, name):
+        return nullcontext()
+
+    def add(self, name, seconds):
+        pass
+
+    def step(self, seconds):
+        pass
+
+    def sample_memory(self):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Trace:
+    """Stage timings and memory peaks of one request."""
+
+    enabled = True
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.time()
+        self.spans = {}
+        self.steps = []
+        self.peak_rss = 0
+        self.peak_vram = 0
+        self._process = psutil.Process()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+            self.sample_memory()
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def step(self, seconds):
+        self.steps.append(seconds)
+
+    def sample_memory(self):
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id, "started": self.started, "spans": self.spans,
+            "steps": self.steps, "peak_rss": self.peak_rss, "peak_vram": self.peak_vram,
+        }
+
+
+class BatchTrace:
+    """Times the stages of one pipeline call and records them on every trace in the batch.
+
+    `on_step_end` and `resume` have the signature of diffusers' `callback_on_step_end`.
+    Step-end work between the two (previews) is left out of the step timings.
+    """
+
+    def __init__(self, traces):
+        self.traces = [t for t in traces if t.enabled]
+        self.enabled = bool(self.traces)
+        self._pipeline_start = None
+        self._last_step = None
+        self._steps = []
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        for trace in self.traces:
+            trace.add(name, seconds)
+            trace.sample_memory()
+
+    def begin_pipeline(self):
+        self._pipeline_start = self._last_step = time.perf_counter()
+
+    def on_step_end(self, pipe, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        seconds = now - self._last_step
+        self._last_step = now
+        self._steps.append(seconds)
+        for trace in self.traces:
+            trace.step(seconds)
+            trace.sample_memory()
+        return callback_kwargs
+
+    def resume(self, pipe, step, timestep, callback_kwargs):
+        """Last step-end callback: the next step is timed from here."""
+        self._last_step = time.perf_counter()
+        return callback_kwargs
+
+    def end_pipeline(self):
+        if not self.enabled or self._pipeline_start is None:
+            return
+        now = time.perf_counter()
+        self.add("denoise", sum(self._steps))
+        self.add("decode", now - self._last_step)
+        if len(self._steps) > 1:
+            # Under offload the first step also pays for moving the transformer onto the GPU
+            rest = sorted(self._steps[1:])
+            self.add("first_step_overhead", max(0.0, self._steps[0] - rest[len(rest) // 2]))
+
+
+class Tracer:
+    """Creates traces and folds finished ones into the metrics registry."""
+
+    def __init__(self, enabled=True, trace_dir=None, registry=None):
+        self.enabled = enabled
+        self.trace_dir = trace_dir
+        self.registry = registry or MetricsRegistry()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self.enabled:
+            return NULL_TRACE
+        with self._lock:
+            self._counter += 1
+            request_id = f"{int(time.time() * 1000)}-{self._counter}"
+        return Trace(request_id)
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.registry.observe("stage_seconds", seconds, help="Time spent per generation stage", stage=stage)
+
+    def finish(self, trace, mode="txt2img", batch_size=1):
+        if not trace.enabled:
+            return
+        reg = self.registry
+        for stage, seconds in trace.spans.items():
+            reg.observe("stage_seconds", seconds, help="Time spent per generation stage", stage=stage)
+        for seconds in trace.steps:
+            reg.observe("step_seconds", seconds, help="Duration of one denoising step")
+        reg.observe("peak_rss_bytes", trace.peak_rss, buckets=BYTES_BUCKETS, help="Peak process RSS per request")
+        reg.observe("peak_vram_bytes", trace.peak_vram, buckets=BYTES_BUCKETS, help="Peak allocated VRAM per request")
+        reg.observe("batch_size", batch_size, buckets=SIZE_BUCKETS, help="Pipeline batch size per request")
+        reg.inc("requests_total", help="Finished generation requests", mode=mode)
+        if self.trace_dir:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, f"trace_{trace.request_id}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({**trace.to_dict(), "mode": mode, "batch_size": batch_size}, f, indent=2)
+
+
+# --- METRICS ENDPOINT ---
+def start_metrics_server(registry, port, host="127.0.0.1"):
+    """Serves `registry` at http://host:port/metrics on a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 Metrics at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,375 @@
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import struct
+import time
+
+# --- MODEL STORE ---
+# Keeps model_cache trustworthy and fast to load:
+#   * a manifest (manifest.json) records the size and sha256 of every file of
+#     the Hub snapshot. Startup compares sizes every time and hashes a file only
+#     when it is new or changed since it was last verified, so a truncated or
+#     damaged shard is found before diffusers trips over it.
+#   * missing or damaged files are deleted and downloaded again; an interrupted
+#     download resumes where it stopped (huggingface_hub keeps the partial file).
+#   * optionally, each component's shards are converted once into a single
+#     safetensors file whose tensors all start on a page boundary. That file is
+#     memory-mapped and every weight is a view into the mapping: no read(), no
+#     copy, and pages the OS already has cached cost nothing.
+
+MANIFEST_FILE = "manifest.json"
+LOAD_TIMES_FILE = "load_times.json"
+CONSOLIDATED_INDEX = "consolidated.json"
+PAGE_SIZE = 4096  # Alignment of every tensor in a consolidated file
+HASH_CHUNK = 8 * 1024**2
+IGNORED_FILES = (MANIFEST_FILE, LOAD_TIMES_FILE, ".gitattributes")
+IGNORED_DIRS = (".cache",)  # huggingface_hub's download metadata and partial files
+
+SAFETENSORS_DTYPES = {
+    "BOOL": "bool", "U8": "uint8", "I8": "int8", "I16": "int16", "I32": "int32", "I64": "int64",
+    "F16": "float16", "BF16": "bfloat16", "F32": "float32", "F64": "float64",
+    "F8_E4M3": "float8_e4m3fn", "F8_E5M2": "float8_e5m2",
+}
+
+
+# --- MANIFEST & VERIFICATION ---
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_files(model_dir):
+    """Relative paths (forward slashes) of the snapshot's files, without our own bookkeeping."""
+    files = []
+    for root, dirs, names in os.walk(model_dir):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_DIRS)
+        for name in sorted(names):
+            rel = os.path.relpath(os.path.join(root, name), model_dir).replace(os.sep, "/")
+            if rel not in IGNORED_FILES:
+                files.append(rel)
+    return files
+
+
+def build_manifest(model_dir, repo_id=None, revision=None):
+    """Manifest of the files currently in `model_dir` (sizes and hashes taken as they are)."""
+    files = {}
+    for rel in list_files(model_dir):
+        path = os.path.join(model_dir, rel)
+        files[rel] = {"size": os.path.getsize(path), "sha256": file_sha256(path)}
+    return {"repo_id": repo_id, "revision": revision, "files": files, "verified": {}}
+
+
+def hub_manifest(repo_id, revision=None):
+    """Manifest from the Hub's file metadata (LFS files come with their sha256)."""
+    from huggingface_hub import HfApi
+    info = HfApi().model_info(repo_id, revision=revision, files_metadata=True)
+    files = {}
+    for sibling in info.siblings:
+        if sibling.rfilename in IGNORED_FILES:
+            continue
+        lfs = sibling.lfs
+        sha256 = None
+        if lfs is not None:
+            sha256 = lfs["sha256"] if isinstance(lfs, dict) else lfs.sha256
+        files[sibling.rfilename] = {"size": sibling.size, "sha256": sha256}
+    return {"repo_id": repo_id, "revision": info.sha, "files": files, "verified": {}}
+
+
+def read_manifest(model_dir):
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(model_dir, manifest):
+    os.makedirs(model_dir, exist_ok=True)
+    tmp_path = os.path.join(model_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(model_dir, MANIFEST_FILE))
+
+
+def verify(model_dir, manifest, full=False, files=None):
+    """Checks the manifest's files; returns [(path, reason)] for the missing or damaged ones.
+
+    Sizes are always compared. A file is hashed when `full` is set or when it changed
+    (size or mtime) since it was last verified; verified files are recorded in the
+    manifest so the next check is quick.
+    """
+    problems = []
+    verified = manifest.setdefault("verified", {})
+    for rel in (files if files is not None else sorted(manifest["files"])):
+        expected = manifest["files"][rel]
+        path = os.path.join(model_dir, rel)
+        if not os.path.exists(path):
+            problems.append((rel, "missing"))
+            continue
+        stat = os.stat(path)
+        if expected.get("size") is not None and stat.st_size != expected["size"]:
+            problems.append((rel, f"size {stat.st_size} instead of {expected['size']}"))
+            verified.pop(rel, None)
+            continue
+        if not full and verified.get(rel) == [stat.st_size, stat.st_mtime_ns]:
+            continue
+        if expected.get("sha256") and file_sha256(path) != expected["sha256"]:
+            problems.append((rel, "checksum mismatch"))
+            verified.pop(rel, None)
+            continue
+        verified[rel] = [stat.st_size, stat.st_mtime_ns]
+    return problems
+
+
+def hub_download(model_dir, repo_id, revision, files):
+    from huggingface_hub import snapshot_download
+    snapshot_download(repo_id=repo_id, revision=revision, local_dir=model_dir, allow_patterns=list(files))
+
+
+def repair(model_dir, manifest, problems, download=None):
+    """Deletes the files in `problems` and downloads them again with
+    `download(model_dir, repo_id, revision, files)` (the Hub by default)."""
+    files = [rel for rel, _ in problems]
+    for rel in files:
+        path = os.path.join(model_dir, rel)
+        if os.path.exists(path):
+            os.remove(path)
+        # Without its download metadata huggingface_hub won't assume the file is current
+        metadata = os.path.join(model_dir, ".cache", "huggingface", "download", rel + ".metadata")
+        if os.path.exists(metadata):
+            os.remove(metadata)
+    (download or hub_download)(model_dir, manifest["repo_id"], manifest.get("revision"), files)
+    return verify(model_dir, manifest, full=True, files=files)
+
+
+def ensure_model(model_dir, repo_id, full=False, download=None, fetch_manifest=None, progress=print):
+    """Makes `model_dir` a complete, verified copy of `repo_id`, downloading whatever
+    is missing or damaged; returns the manifest. Raises RuntimeError if that fails."""
+    manifest = read_manifest(model_dir)
+    if manifest is None:
+        try:
+            manifest = (fetch_manifest or hub_manifest)(repo_id)
+        except Exception as e:
+            if not os.path.exists(os.path.join(model_dir, "model_index.json")):
+                raise RuntimeError(f"Can't fetch the file list of {repo_id}: {e}")
+            # An older download and no connection: trust it as it is from now on
+            progress(f"⚠️ Hub unreachable ({e}), recording the local files as they are")
+            manifest = build_manifest(model_dir, repo_id)
+        write_manifest(model_dir, manifest)
+
+    problems = verify(model_dir, manifest, full=full)
+    if problems:
+        absent = sum(1 for _, reason in problems if reason == "missing")
+        if absent < len(problems):
+            for rel, reason in problems:
+                if reason != "missing":
+                    progress(f"⚠️ {rel}: {reason}")
+        progress(f"⏳ Downloading {len(problems)} of {len(manifest['files'])} model files "
+                 f"({len(problems) - absent} damaged)...")
+        problems = repair(model_dir, manifest, problems, download)
+    write_manifest(model_dir, manifest)
+    if problems:
+        raise RuntimeError(f"{problems[0][0]} is still damaged after downloading it again ({problems[0][1]})")
+    return manifest
+
+
+# --- CONSOLIDATED FORMAT ---
+def load_component(model_dir, name, empty=False):
+    """Loads one pipeline component in bf16, or only its skeleton (weights on "meta")."""
+    import torch
+    with open(os.path.join(model_dir, "model_index.json"), "r", encoding="utf-8") as f:
+        library, class_name = json.load(f)[name]
+    cls = getattr(importlib.import_module(library), class_name)
+    folder = os.path.join(model_dir, name)
+    if not empty:
+        return cls.from_pretrained(folder, torch_dtype=torch.bfloat16)
+    from accelerate import init_empty_weights
+    if library == "diffusers":
+        with init_empty_weights():
+            return cls.from_config(cls.load_config(folder))
+    from transformers import AutoConfig
+    with init_empty_weights():
+        return cls._from_config(AutoConfig.from_pretrained(folder), torch_dtype=torch.bfloat16)
+
+
+def assign_state_dict(model, state, source):
+    """Moves `state`'s tensors into an empty (meta-device) `model` without copying them."""
+    model.load_state_dict(state, strict=False, assign=True)
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+    missing = [name for name, t in itertools.chain(model.named_parameters(), model.named_buffers()) if t.is_meta]
+    if missing:
+        raise RuntimeError(f"{source} is missing {len(missing)} tensors (e.g. {missing[0]})")
+    return model.eval()
+
+
+def torch_dtype(code):
+    import torch
+    return getattr(torch, SAFETENSORS_DTYPES[code])
+
+
+def write_aligned(path, entries):
+    """Writes a safetensors file in which every tensor starts on a PAGE_SIZE boundary.
+
+    `entries` is a list of (name, dtype code, shape, load) where `load()` returns the
+    tensor; tensors are loaded and written one at a time. safetensors forbids gaps
+    in the data section, so alignment gaps are filled with "__pad" uint8 tensors.
+    """
+    import torch
+    header, layout, offset = {}, [], 0
+    for name, code, shape, load in entries:
+        pad = -offset % PAGE_SIZE
+        if pad:
+            header[f"__pad{len(layout)}__"] = {"dtype": "U8", "shape": [pad], "data_offsets": [offset, offset + pad]}
+            layout.append((pad, None))
+            offset += pad
+        nbytes = torch_dtype(code).itemsize
+        for dim in shape:
+            nbytes *= dim
+        header[name] = {"dtype": code, "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        layout.append((nbytes, load))
+        offset += nbytes
+    header["__metadata__"] = {"format": "pt", "alignment": str(PAGE_SIZE)}
+    encoded = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # Header padded with spaces so the data section starts on a page boundary too
+    encoded += b" " * (-(8 + len(encoded)) % PAGE_SIZE)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for nbytes, load in layout:
+            if load is None:
+                f.write(bytes(nbytes))
+                continue
+            tensor = load().contiguous().reshape(-1).view(torch.uint8)
+            if tensor.numel() != nbytes:
+                raise ValueError(f"Tensor size changed while writing {path}")
+            f.write(tensor.numpy().data)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(length)), 8 + length
+
+
+def load_aligned(path):
+    """Maps a file written by write_aligned; returns {name: tensor}, all views of one
+    copy-on-write mapping of the file (nothing is read until a tensor is used)."""
+    import torch
+    header, data_start = read_header(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__" or name.startswith("__pad"):
+            continue
+        dtype = torch_dtype(info["dtype"])
+        begin = data_start + info["data_offsets"][0]
+        if begin % dtype.itemsize:
+            raise ValueError(f"{path} is not aligned (tensor {name})")
+        shape = info["shape"]
+        strides = [1] * len(shape)
+        for i in range(len(shape) - 2, -1, -1):
+            strides[i] = strides[i + 1] * shape[i + 1]
+        tensors[name] = torch.empty(0, dtype=dtype).set_(storage, begin // dtype.itemsize, shape, strides)
+    return tensors
+
+
+def shard_entries(folder, cast=None):
+    """(name, dtype code, shape, load) for every tensor in a folder's safetensors shards;
+    floating point tensors are converted to `cast` (a dtype code) if given."""
+    from safetensors import safe_open
+    entries = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(".safetensors"):
+            continue
+        path = os.path.join(folder, filename)
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                tensor_slice = f.get_slice(name)
+                code = tensor_slice.get_dtype()
+                convert = cast is not None and code in ("F16", "BF16", "F32", "F64") and code != cast
+                entries.append((name, cast if convert else code, tuple(tensor_slice.get_shape()),
+                                lambda path=path, name=name, convert=convert: read_tensor(path, name, convert and cast)))
+    if not entries:
+        raise FileNotFoundError(f"No safetensors weights in {folder}")
+    return entries
+
+
+def read_tensor(path, name, cast=None):
+    from safetensors import safe_open
+    with safe_open(path, framework="pt") as f:
+        tensor = f.get_tensor(name)
+    return tensor.to(torch_dtype(cast)) if cast else tensor
+
+
+def weight_components(model_dir):
+    """Pipeline components that have safetensors weights (transformer, text_encoder, vae...)."""
+    with open(os.path.join(model_dir, "model_index.json"), "r", encoding="utf-8") as f:
+        index = json.load(f)
+    return [
+        name for name, value in index.items()
+        if isinstance(value, list) and os.path.isdir(os.path.join(model_dir, name))
+        and any(f.endswith(".safetensors") for f in os.listdir(os.path.join(model_dir, name)))
+    ]
+
+
+def prepare_consolidated(model_dir, directory, revision, skip=(), cast="BF16", load=None):
+    """Returns {component: model} memory-mapped from consolidated files in `directory`;
+    a component is converted first if it has no file for this source revision yet."""
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, CONSOLIDATED_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    components = {}
+    for name in weight_components(model_dir):
+        if name in skip:
+            continue
+        path = os.path.join(directory, f"{name}.safetensors")
+        if index.get(name, {}).get("source") != revision or not os.path.exists(path):
+            print(f"⏳ Converting {name} to the consolidated format (first time only)...")
+            started = time.perf_counter()
+            write_aligned(path, shard_entries(os.path.join(model_dir, name), cast))
+            index[name] = {"source": revision, "bytes": os.path.getsize(path),
+                           "seconds": round(time.perf_counter() - started, 1)}
+            with open(index_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=2)
+        skeleton = (load or load_component)(model_dir, name, empty=True)
+        components[name] = assign_state_dict(skeleton, load_aligned(path), path)
+    return components
+
+
+# --- LOAD TIMES ---
+def record_load_time(model_dir, seconds, fmt, boot_time):
+    """Stores the load time as "cold" (first load since the machine booted, so nothing
+    was in the page cache) or "warm"; returns (kind, history of the last times)."""
+    path = os.path.join(model_dir, LOAD_TIMES_FILE)
+    history = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+    kind = "cold" if history.get("last_load", 0) < boot_time else "warm"
+    history[f"{kind}_{fmt}"] = round(seconds, 2)
+    history["last_load"] = time.time()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=2)
+    return kind, history
+
+
+def format_load_times(history):
+    """E.g. "cold: 41.2s shards, 9.8s consolidated · warm: 12.5s shards"."""
+    parts = []
+    for kind in ("cold", "warm"):
+        times = [f"{history[key]:.1f}s {key.split('_', 1)[1]}" for key in sorted(history) if key.startswith(kind + "_")]
+        if times:
+            parts.append(f"{kind}: {', '.join(times)}")
+    return " · ".join(parts)
@@ -0,0 +1,152 @@
+import psutil
+
+# --- OFFLOAD STRATEGIES ---
+# How the pipeline's weights are split between VRAM, RAM and disk.
+#   resident   - everything on the GPU, no transfers (fastest, needs the most VRAM)
+#   model      - whole components swapped onto the GPU when used (enable_model_cpu_offload)
+#   sequential - individual layers swapped in per forward pass (lowest VRAM, slowest)
+#   group      - blocks streamed in groups with prefetching (low VRAM, much faster than sequential)
+#   disk       - like group, but offloaded weights live on disk instead of RAM
+
+STRATEGIES = ("resident", "model", "sequential", "group", "disk")
+ACTIVATION_RESERVE = 3 * 1024**3  # VRAM kept free for activations and the VAE decode
+GB = 1024**3
+
+
+def measure_memory():
+    """Returns (free VRAM, free RAM) in bytes; free VRAM is 0 without CUDA."""
+    import torch
+    free_vram = torch.cuda.mem_get_info()[0] if torch.cuda.is_available() else 0
+    return free_vram, psutil.virtual_memory().available
+
+
+def pipeline_modules(pipe):
+    """The pipeline's torch modules (transformer, text encoder, VAE) by name."""
+    import torch
+    components = getattr(pipe, "components", None) or {}
+    return {name: m for name, m in components.items() if isinstance(m, torch.nn.Module)}
+
+
+def module_nbytes(module):
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def component_sizes(pipe):
+    return {name: module_nbytes(m) for name, m in pipeline_modules(pipe).items()}
+
+
+def choose_strategy(free_vram, free_ram, sizes, reserve=ACTIVATION_RESERVE):
+    """Picks a strategy from measured free memory and component sizes.
+
+    Returns (strategy, reason). Pure function so it can be checked with fake readings.
+    """
+    if free_vram <= 0:
+        return "resident", "no CUDA device, running on the CPU"
+    total = sum(sizes.values())
+    largest = max(sizes.values(), default=0)
+    if free_vram >= total + reserve:
+        return "resident", f"{free_vram / GB:.1f}GB free VRAM fits all weights ({total / GB:.1f}GB)"
+    if free_vram >= largest + reserve and free_ram >= total:
+        return "model", f"largest component ({largest / GB:.1f}GB) fits in {free_vram / GB:.1f}GB VRAM"
+    if free_ram >= total:
+        return "group", f"only {free_vram / GB:.1f}GB VRAM free, streaming blocks from RAM"
+    return "disk", f"only {free_ram / GB:.1f}GB RAM free for {total / GB:.1f}GB of weights"
+
+
+def reset_offload(pipe):
+    """Removes offload hooks and moves every component back to the CPU."""
+    if hasattr(pipe, "remove_all_hooks"):
+        pipe.remove_all_hooks()
+    for module in pipeline_modules(pipe).values():
+        registry = getattr(module, "_diffusers_hook", None)
+        if registry is not None:
+            for name in list(registry.hooks):
+                registry.remove_hook(name, recurse=True)
+        module.to("cpu")
+
+
+def apply_strategy(pipe, strategy, disk_dir=None):
+    """Applies `strategy` to a loaded pipeline, undoing any previous one."""
+    import torch
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown offload strategy '{strategy}' (choose from {', '.join(STRATEGIES)})")
+    if not torch.cuda.is_available():
+        return
+    reset_offload(pipe)
+    if strategy == "resident":
+        pipe.to("cuda")
+    elif strategy == "model":
+        pipe.enable_model_cpu_offload()
+    elif strategy == "sequential":
+        pipe.enable_sequential_cpu_offload()
+    else:
+        from diffusers.hooks import apply_group_offloading
+        kwargs = dict(
+            onload_device=torch.device("cuda"), offload_device=torch.device("cpu"),
+            offload_type="leaf_level", use_stream=True
+        )
+        if strategy == "disk":
+            kwargs["offload_to_disk_path"] = disk_dir
+        for module in pipeline_modules(pipe).values():
+            apply_group_offloading(module, **kwargs)
+    torch.cuda.empty_cache()
+
+
+def weight_slots(pipe):
+    """(key, owning module, attribute name, tensor) for every parameter and buffer."""
+    for component, module in pipeline_modules(pipe).items():
+        for prefix, sub in module.named_modules():
+            for name, tensor in list(sub._parameters.items()) + list(sub._buffers.items()):
+                if tensor is not None:
+                    yield f"{component}.{prefix}.{name}", sub, name, tensor
+
+
+def set_slot(owner, name, tensor):
+    if name in owner._parameters:
+        owner._parameters[name].data = tensor  # Keeps the Parameter object (and anything holding it)
+    else:
+        owner._buffers[name] = tensor
+
+
+class HostWeights:
+    """Host copies of resident weights, for handing VRAM back while idle.
+
+    Tensors recorded with `remember()` before placement (memory-mapped consolidated
+    weights) are reused as they are, costing no RAM; everything else is copied into
+    pinned memory on release, which makes the copy back fast, and dropped after it.
+    """
+
+    def __init__(self):
+        self.mapped = {}
+        self.released = 0  # Bytes currently held on the host instead of the GPU
+
+    def remember(self, pipe):
+        for key, _, _, tensor in weight_slots(pipe):
+            if tensor.device.type == "cpu":
+                self.mapped[key] = tensor.detach()
+
+    def release(self, pipe):
+        """Moves every CUDA weight to its host copy; returns the bytes freed."""
+        import torch
+        freed = 0
+        for key, owner, name, tensor in weight_slots(pipe):
+            if tensor.device.type != "cuda":
+                continue
+            host = self.mapped.get(key)
+            if host is None or host.shape != tensor.shape or host.dtype != tensor.dtype:
+                host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                host.copy_(tensor.detach())
+            set_slot(owner, name, host)
+            freed += tensor.numel() * tensor.element_size()
+        self.released = freed
+        return freed
+
+    def restore(self, pipe, device="cuda"):
+        """Copies released weights back to `device`."""
+        import torch
+        for _, owner, name, tensor in weight_slots(pipe):
+            if tensor.device.type == "cpu":
+                set_slot(owner, name, tensor.detach().to(device, non_blocking=tensor.is_pinned()))
+        torch.cuda.synchronize()
+        self.released = 0
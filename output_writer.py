@@ -0,0 +1,155 @@
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+# --- BACKGROUND OUTPUT WRITER ---
+# Encoding a large PNG takes hundreds of milliseconds, so images are handed to a
+# small pool of writer threads and the result is returned to the UI right away.
+
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+
+def encode_metadata(params, ensure_ascii=False):
+    return json.dumps(params, ensure_ascii=ensure_ascii, sort_keys=True, default=str)
+
+
+class OutputWriter:
+    """Thread pool that saves images atomically (temp file + rename).
+
+    `compress_level` is the PNG zlib level (0-9), `quality` is used for WebP/JPEG.
+    The queue is bounded, so `submit` blocks if the disk cannot keep up.
+    `on_write(path, seconds)` is called after every successful write.
+    """
+
+    def __init__(self, output_dir, fmt="png", compress_level=4, quality=95, workers=2, max_queue=16, on_write=None):
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{fmt}' (choose from {', '.join(OUTPUT_FORMATS)})")
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.compress_level = compress_level
+        self.quality = quality
+        self.on_write = on_write
+        self.written = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._reserved = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        os.makedirs(output_dir, exist_ok=True)
+        self._threads = [
+            threading.Thread(target=self._loop, name=f"output-writer-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.fmt][1]
+
+    def reserve_path(self, stem):
+        """Returns a path for `stem` that is not on disk and not already queued."""
+        with self._lock:
+            candidate = os.path.join(self.output_dir, stem + self.extension)
+            counter = 1
+            while candidate in self._reserved or os.path.exists(candidate):
+                candidate = os.path.join(self.output_dir, f"{stem}_{counter}{self.extension}")
+                counter += 1
+            self._reserved.add(candidate)
+            return candidate
+
+    def submit(self, image, params=None, filename=None):
+        """Queues `image` for writing and returns the path it will be written to.
+
+        Without `filename` a collision-free `flux2_<timestamp>_<seed>` name is used;
+        an explicit `filename` (relative to the output dir) is overwritten as-is.
+        """
+        if self._closed:
+            raise RuntimeError("Output writer is closed")
+        params = params or {}
+        if filename is None:
+            path = self.reserve_path(f"flux2_{int(time.time())}_{params.get('seed', 0)}")
+        else:
+            path = os.path.join(self.output_dir, filename)
+            with self._lock:
+                self._reserved.add(path)
+        self._queue.put((image, params, path))
+        return path
+
+    def flush(self):
+        """Blocks until every queued image is on disk."""
+        self._queue.join()
+
+    def close(self):
+        """Flushes pending writes and stops the writer threads."""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _save_kwargs(self, params):
+        if self.fmt == "png":
+            info = PngInfo()
+            info.add_text("parameters", encode_metadata(params))
+            return {"pnginfo": info, "compress_level": self.compress_level}
+        exif = Image.Exif()
+        # EXIF strings are ASCII; escaped JSON keeps non-Latin prompts readable by the history scanner
+        exif[EXIF_IMAGE_DESCRIPTION] = encode_metadata(params, ensure_ascii=True)
+        return {"exif": exif, "quality": self.quality}
+
+    def write(self, image, params, path):
+        """Encodes and writes one image (runs on a writer thread)."""
+        pil_format = OUTPUT_FORMATS[self.fmt][0]
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format=pil_format, **self._save_kwargs(params))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            image, params, path = item
+            ok = False
+            try:
+                start = time.perf_counter()
+                self.write(image, params, path)
+                ok = True
+                if self.on_write is not None:
+                    self.on_write(path, time.perf_counter() - start)
+            except Exception as e:
+                print(f"❌ Could not save {path}: {e}")
+            finally:
+                with self._lock:
+                    self._reserved.discard(path)
+                    if ok:
+                        self.written += 1
+                    else:
+                        self.failed += 1
+                self._queue.task_done()
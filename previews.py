@@ -0,0 +1,107 @@
+import time
+
+import torch
+from PIL import Image
+
+# --- PROGRESSIVE PREVIEWS ---
+# While the transformer denoises, the packed latents are turned into a rough RGB
+# preview with a linear projection (no VAE): each latent token is one 16x16
+# pixel patch, and its channels are projected onto three colours. Previews are
+# throttled by time and by the share of the run they are allowed to cost.
+
+PATCH = 16  # Pixels per packed latent token along each axis
+
+
+def unpack_latents(latents, height, width):
+    """(B, seq, C) packed latents -> (B, C, h, w) token grid."""
+    batch, seq, channels = latents.shape
+    h, w = height // PATCH, width // PATCH
+    if h * w != seq:
+        h = w = int(seq ** 0.5)
+        if h * w != seq:
+            raise ValueError(f"Cannot unpack {seq} latent tokens for {width}x{height}")
+    return latents.reshape(batch, h, w, channels).permute(0, 3, 1, 2)
+
+
+def project_to_rgb(grid, rgb_factors=None):
+    """Projects a (C, h, w) grid to (h, w, 3) uint8.
+
+    With `rgb_factors` (a C x 3 matrix) the projection is fixed; otherwise the three
+    principal components of this grid are used, which shows structure without
+    needing calibrated factors.
+    """
+    channels, h, w = grid.shape
+    flat = grid.reshape(channels, -1).T.float()
+    if rgb_factors is not None:
+        rgb = flat @ torch.as_tensor(rgb_factors, dtype=flat.dtype, device=flat.device)
+    else:
+        centered = flat - flat.mean(dim=0, keepdim=True)
+        _, _, v = torch.linalg.svd(centered, full_matrices=False)
+        basis = v[:3].T
+        # Fix the sign of each component so colours don't flip between previews
+        signs = torch.sign(basis.gather(0, basis.abs().argmax(dim=0, keepdim=True)))
+        rgb = centered @ (basis * signs)
+    low = rgb.quantile(0.01, dim=0, keepdim=True)
+    high = rgb.quantile(0.99, dim=0, keepdim=True)
+    rgb = ((rgb - low) / (high - low).clamp_min(1e-6)).clamp(0, 1)
+    return (rgb * 255).to(torch.uint8).reshape(h, w, 3).cpu().numpy()
+
+
+def latents_to_previews(latents, height, width, max_size=512, rgb_factors=None):
+    """Cheap RGB previews (PIL) for every item of a packed latent batch."""
+    grid = unpack_latents(latents.detach(), height, width)
+    scale = min(1.0, max_size / max(height, width))
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return [
+        Image.fromarray(project_to_rgb(item, rgb_factors), "RGB").resize(size, Image.BILINEAR)
+        for item in grid
+    ]
+
+
+class PreviewCallback:
+    """Step-end callback that sends throttled previews to each request's `on_preview`.
+
+    A preview is made at most every `interval` seconds, and only while the time
+    spent on previews stays below `max_overhead` of the elapsed run time.
+    """
+
+    def __init__(self, requests, height, width, interval=0.5, max_overhead=0.05,
+                 max_size=512, rgb_factors=None, clock=time.perf_counter):
+        self.requests = requests
+        self.height = height
+        self.width = width
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_size = max_size
+        self.rgb_factors = rgb_factors
+        self.clock = clock
+        self.overhead = 0.0
+        self.previews = 0
+        self.skipped = 0
+        self._start = clock()
+        self._last = None
+
+    def should_preview(self, now):
+        if self._last is not None and now - self._last < self.interval:
+            return False
+        elapsed = now - self._start
+        return elapsed > 0 and self.overhead / elapsed < self.max_overhead
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        latents = callback_kwargs.get("latents")
+        total = getattr(pipe, "num_timesteps", None)
+        # The last step is followed by the real decode, so no preview is needed there
+        if latents is None or (total and step + 1 >= total):
+            return callback_kwargs
+        now = self.clock()
+        if not self.should_preview(now):
+            self.skipped += 1
+            return callback_kwargs
+        images = latents_to_previews(latents, self.height, self.width, self.max_size, self.rgb_factors)
+        for request, image in zip(self.requests, images):
+            if request.on_preview is not None:
+                request.on_preview(image, step + 1, total)
+        self._last = self.clock()
+        self.overhead += self._last - now
+        self.previews += 1
+        return callback_kwargs
@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+# --- PROMPT EMBEDDING CACHE ---
+# Keeps encoded prompts around so seed/steps/strength sweeps skip the text encoder
+# (and, under CPU offload, the encoder's round trip to the GPU).
+
+DEFAULT_MAX_BYTES = 512 * 1024**2
+
+
+def tensor_nbytes(value):
+    """Size in bytes of a tensor or a (nested) tuple/list of tensors."""
+    if value is None:
+        return 0
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_nbytes(v) for v in value)
+    return value.element_size() * value.nelement()
+
+
+class TensorLRUCache:
+    """Bounded, size-aware LRU cache of tensors.
+
+    Entries are stored on the CPU so the cache never holds on to VRAM; eviction
+    starts with the least recently used entry once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entries=256):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, tensor):
+        tensor = tensor.detach().to("cpu")
+        size = tensor_nbytes(tensor)
+        if size > self.max_bytes:
+            return tensor
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (tensor, size)
+            self._bytes += size
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+        return tensor
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class PromptEmbeddingCache(TensorLRUCache):
+    """LRU cache of prompt embeddings keyed by (prompt, max_sequence_length, dtype)."""
+
+    @staticmethod
+    def make_key(prompt, max_sequence_length, dtype):
+        return (prompt, int(max_sequence_length), str(dtype))
+
+    def get_or_encode(self, prompt, encode_fn, max_sequence_length=512, dtype=None, device=None):
+        """Return embeddings for `prompt`, calling `encode_fn(prompt)` only on a miss.
+
+        `encode_fn` must return the prompt embedding tensor. The result is moved to
+        `device` (if given) before it is handed back.
+        """
+        key = self.make_key(prompt, max_sequence_length, dtype)
+        embeds = self.get(key)
+        if embeds is None:
+            embeds = self.put(key, encode_fn(prompt))
+        if device is not None:
+            embeds = embeds.to(device)
+        return embeds
@@ -0,0 +1,210 @@
+import json
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from model_store import assign_state_dict, load_component
+from offload import module_nbytes
+
+# --- WEIGHT QUANTIZATION ---
+# Weight-only low-precision modes for the large Linear layers of the transformer
+# and the text encoder:
+#   int8 - symmetric int8 with one scale per output channel (half of bf16)
+#   fp8  - float8_e4m3fn with one scale per output channel (half of bf16)
+#   int4 - symmetric int4 with one scale per 64 weights, two weights per byte (~30%)
+# Weights are dequantized to the activation dtype inside forward(), so every
+# mode runs on any device, the CPU included. The gain is memory and offload
+# traffic, not matmul speed. Quantized components are saved as safetensors
+# next to model_cache, so later startups load them directly and skip both the
+# bf16 weights and the quantization pass.
+
+GROUP_SIZE = 64           # int4 weights sharing one scale
+MIN_WEIGHT_NUMEL = 4096   # Smaller layers stay in bf16
+# Embedders, norms, modulation and output projections are small and sensitive, so they stay in bf16
+SKIP_MODULES = ("proj_out", "norm", "embed", "time_", "guidance_", "modulation", "lm_head")
+QUANTIZED_COMPONENTS = ("transformer", "text_encoder")
+
+
+class Int8Linear(nn.Module):
+    """Linear layer with int8 weights and a per-output-channel scale."""
+
+    storage_dtype = torch.int8
+    max_value = 127
+
+    def __init__(self, in_features, out_features, bias=True, device=None, dtype=torch.bfloat16):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.empty((out_features, in_features), dtype=self.storage_dtype, device=device))
+        self.register_buffer("scale", torch.empty(out_features, dtype=dtype, device=device))
+        self.register_buffer("bias", torch.empty(out_features, dtype=dtype, device=device) if bias else None)
+
+    @classmethod
+    def empty_like(cls, linear):
+        return cls(linear.in_features, linear.out_features, linear.bias is not None,
+                   device="meta", dtype=linear.weight.dtype)
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None,
+                     device=weight.device, dtype=linear.weight.dtype)
+        scale = weight.abs().amax(dim=1).clamp_min(1e-8) / cls.max_value
+        module.weight.copy_(cls.quantize(weight / scale[:, None]))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    @classmethod
+    def quantize(cls, scaled):
+        return scaled.round().clamp(-cls.max_value, cls.max_value).to(cls.storage_dtype)
+
+    def dequantize(self, dtype):
+        return self.weight.to(dtype) * self.scale.to(dtype)[:, None]
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class Fp8Linear(Int8Linear):
+    """Linear layer with float8 (e4m3) weights and a per-output-channel scale."""
+
+    storage_dtype = torch.float8_e4m3fn
+    max_value = 448.0
+
+    @classmethod
+    def quantize(cls, scaled):
+        return scaled.clamp(-cls.max_value, cls.max_value).to(cls.storage_dtype)
+
+
+class Int4Linear(Int8Linear):
+    """Linear layer with int4 weights packed two per byte and one scale per GROUP_SIZE weights."""
+
+    def __init__(self, in_features, out_features, bias=True, device=None, dtype=torch.bfloat16):
+        nn.Module.__init__(self)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.empty((out_features, in_features // 2), dtype=torch.uint8, device=device))
+        self.register_buffer("scale", torch.empty((out_features, in_features // GROUP_SIZE), dtype=dtype, device=device))
+        self.register_buffer("bias", torch.empty(out_features, dtype=dtype, device=device) if bias else None)
+
+    @classmethod
+    def from_linear(cls, linear):
+        weight = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None,
+                     device=weight.device, dtype=linear.weight.dtype)
+        groups = weight.reshape(linear.out_features, -1, GROUP_SIZE)
+        scale = groups.abs().amax(dim=2).clamp_min(1e-8) / 7
+        q = (groups / scale[..., None]).round().clamp(-8, 7).to(torch.int16) + 8
+        q = q.reshape(linear.out_features, -1).to(torch.uint8)
+        module.weight.copy_(q[:, ::2] | (q[:, 1::2] << 4))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    def dequantize(self, dtype):
+        q = torch.stack((self.weight & 0x0F, self.weight >> 4), dim=-1).reshape(self.out_features, -1)
+        groups = (q.to(dtype) - 8).reshape(self.out_features, -1, GROUP_SIZE)
+        return (groups * self.scale.to(dtype)[..., None]).reshape(self.out_features, self.in_features)
+
+
+LINEAR_TYPES = {"int8": Int8Linear, "fp8": Fp8Linear, "int4": Int4Linear}
+
+
+def quantizable(name, module, mode):
+    if not isinstance(module, nn.Linear) or module.weight.numel() < MIN_WEIGHT_NUMEL:
+        return False
+    if any(part in name for part in SKIP_MODULES):
+        return False
+    return mode != "int4" or module.in_features % GROUP_SIZE == 0
+
+
+def replace_linears(model, mode, build):
+    """Swaps every quantizable nn.Linear in `model` for `build(linear)`; returns their names."""
+    names = []
+    for name, module in list(model.named_modules()):
+        if quantizable(name, module, mode):
+            parent_name, _, child = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child, build(module))
+            names.append(name)
+    return names
+
+
+def quantize_model(model, mode):
+    """Quantizes `model` in place; returns the layer count and weight bytes before and after."""
+    if mode not in LINEAR_TYPES:
+        raise ValueError(f"Unknown quantization mode '{mode}' (choose from {', '.join(LINEAR_TYPES)})")
+    bytes_before = module_nbytes(model)
+    with torch.no_grad():
+        layers = replace_linears(model, mode, LINEAR_TYPES[mode].from_linear)
+    return {"mode": mode, "layers": len(layers), "bytes_before": bytes_before, "bytes_after": module_nbytes(model)}
+
+
+def save_quantized(model, path):
+    """Writes a quantized model's state dict; tied tensors (shared storage) are stored once."""
+    from safetensors.torch import save_file
+    state, seen = {}, set()
+    for key, tensor in model.state_dict().items():
+        identity = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if tensor.numel() and identity in seen:
+            continue
+        seen.add(identity)
+        state[key] = tensor.detach().contiguous()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    save_file(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_quantized(model, path, mode):
+    """Fills an empty (meta-device) `model` from a checkpoint written by save_quantized."""
+    from safetensors.torch import load_file
+    replace_linears(model, mode, LINEAR_TYPES[mode].empty_like)
+    return assign_state_dict(model, load_file(path), path)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, "quantization.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def prepare_component(model_dir, name, mode, revision, directory):
+    """Returns (component in `mode`, summary): from `directory` if it holds a checkpoint
+    of the same source revision, otherwise quantized from bf16 now and saved there."""
+    path = os.path.join(directory, f"{name}.safetensors")
+    manifest = read_manifest(directory)
+    entry = manifest.get(name)
+    if entry and entry.get("source") == revision and entry.get("mode") == mode and os.path.exists(path):
+        print(f"⏳ Loading {mode} {name} from {path}...")
+        return load_quantized(load_component(model_dir, name, empty=True), path, mode), entry
+
+    print(f"⏳ Quantizing {name} to {mode} (first time only)...")
+    model = load_component(model_dir, name)
+    summary = quantize_model(model, mode)
+    summary["source"] = revision
+    save_quantized(model, path)
+    manifest[name] = summary
+    with open(os.path.join(directory, "quantization.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return model, summary
+
+
+def image_psnr(a, b):
+    """PSNR in dB between two same-sized PIL images (inf if identical)."""
+    import numpy as np
+    x = np.asarray(a.convert("RGB"), dtype=np.float64)
+    y = np.asarray(b.convert("RGB"), dtype=np.float64)
+    mse = np.mean((x - y) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# --- DETERMINISTIC RESULT CACHE ---
+# With a fixed seed the same prompt, settings and input image always give the
+# same picture, so finished results are stored under a hash of those inputs.
+# Objects live in <root>/objects/ab/<hash>.png and a SQLite index keeps their
+# size and last access for LRU eviction. Lookups run on the caller's thread
+# (never the scheduler's); stores and evictions run on a background thread.
+
+KEY_FIELDS = ("prompt", "seed", "width", "height", "steps", "guidance", "strength", "mode", "hires")
+
+
+def image_digest(image):
+    """Content hash of a PIL image (pixels, size and mode)."""
+    if image is None:
+        return None
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size}".encode("utf-8"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def result_key(params, model_revision, input_digest=None):
+    """Hash of everything that determines the output image."""
+    payload = {field: params.get(field) for field in KEY_FIELDS}
+    payload["model_revision"] = model_revision
+    payload["input_image"] = input_digest
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed store of generated images with a size cap and LRU eviction.
+
+    The folder and the index are created on first use, not when the cache is built.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._db_path = os.path.join(root, "index.sqlite")
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        self._created = False
+        self._create_lock = threading.Lock()
+
+    def _create(self):
+        with self._create_lock:
+            if self._created:
+                return
+            os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+            db = sqlite3.connect(self._db_path, timeout=30)
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS results ("
+                    " key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL,"
+                    " created REAL NOT NULL, last_access REAL NOT NULL, params TEXT)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results(last_access)")
+            db.close()
+            self._created = True
+
+    def _connect(self):
+        """One connection per thread; WAL lets lookups proceed while a store commits."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self._create()
+            db = sqlite3.connect(self._db_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def object_path(self, key):
+        return os.path.join(self.root, "objects", key[:2], key + ".png")
+
+    def lookup(self, key):
+        """Returns the cached PIL image for `key`, or None."""
+        db = self._connect()
+        row = db.execute("SELECT path FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            self.misses += 1
+            return None
+        try:
+            with Image.open(row[0]) as f:
+                image = f.copy()
+        except OSError:
+            self.misses += 1
+            return None
+        with db:
+            db.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return image
+
+    def store(self, key, image, params=None):
+        """Queues `image` for storage under `key`; returns immediately."""
+        return self._executor.submit(self._store, key, image, params or {})
+
+    def _store(self, key, image, params):
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                image.save(f, format="PNG", compress_level=1)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        now = time.time()
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, path, size, created, last_access, params)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, path, os.path.getsize(path), now, now, json.dumps(params, default=str)),
+            )
+        self._evict(db)
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, path, size in db.execute(
+            "SELECT key, path, size FROM results ORDER BY last_access ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            if os.path.exists(path):
+                os.remove(path)
+            with db:
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+
+    def flush(self):
+        """Waits for queued stores to finish."""
+        self._executor.submit(lambda: None).result()
+
+    def stats(self):
+        db = self._connect()
+        entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size,
+                "max_bytes": self.max_bytes}
@@ -0,0 +1,141 @@
+import hashlib
+import time
+from types import SimpleNamespace
+
+import torch
+from PIL import Image
+
+# --- STUB PIPELINE ---
+# CPU stand-in for Flux2KleinPipeline with the same call signature. It produces
+# deterministic images from the seed and prompt, so the batching, caching and
+# output paths can be exercised (and benchmarked) without the 16GB model.
+
+LATENT_CHANNELS = 128  # Packed 2x2 patches, like the real transformer input
+PATCH = 16             # Pixels per latent token along each axis
+
+
+class StubVAE:
+    """Stub decoder: (B, C, h, w) -> (B, 3, h*16, w*16) in [-1, 1] by nearest upsampling.
+
+    Every decode call's output size is tracked in `peak_bytes`, which stands in for
+    the activation memory a real decoder would need for that call.
+    """
+
+    def __init__(self):
+        self.decode_calls = 0
+        self.peak_bytes = 0
+
+    def decode(self, z, return_dict=True):
+        self.decode_calls += 1
+        sample = z[:, :3].tanh().repeat_interleave(PATCH, dim=-2).repeat_interleave(PATCH, dim=-1)
+        self.peak_bytes = max(self.peak_bytes, sample.numel() * sample.element_size())
+        return SimpleNamespace(sample=sample) if return_dict else (sample,)
+
+
+class StubPipeline:
+    """Deterministic, weight-free pipeline.
+
+    `step_time`, `encode_time` and `vae_time` simulate the cost of one denoising
+    step, one text-encoder pass and one VAE encode. Every call's batch size is
+    recorded in `batch_sizes`.
+    """
+
+    def __init__(self, step_time=0.0, encode_time=0.0, vae_time=0.0, embed_dim=64):
+        self.step_time = step_time
+        self.encode_time = encode_time
+        self.vae_time = vae_time
+        self.embed_dim = embed_dim
+        self.encode_calls = 0
+        self.vae_encode_calls = 0
+        self.batch_sizes = []
+        self._execution_device = torch.device("cpu")
+        self.text_encoder = SimpleNamespace(dtype=torch.float32)
+        self.vae = StubVAE()
+        # A tiny MLP stands in for the transformer, so weight quantization has something to act on
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(0)
+            self.transformer = torch.nn.Sequential(
+                torch.nn.Linear(LATENT_CHANNELS, 256), torch.nn.GELU(), torch.nn.Linear(256, LATENT_CHANNELS)
+            ).to(torch.bfloat16)
+        self._interrupt = False
+        self.num_timesteps = 0
+
+    @property
+    def interrupt(self):
+        return self._interrupt
+
+    def encode_prompt(self, prompt, device=None, max_sequence_length=512, **kwargs):
+        self.encode_calls += 1
+        if self.encode_time:
+            time.sleep(self.encode_time)
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        embeds = []
+        for text in prompts:
+            seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+            g = torch.Generator("cpu").manual_seed(seed)
+            embeds.append(torch.randn((1, max_sequence_length, self.embed_dim), generator=g))
+        prompt_embeds = torch.cat(embeds).to(device or self._execution_device)
+        text_ids = torch.zeros((len(prompts), max_sequence_length, 4), dtype=torch.long)
+        return prompt_embeds, text_ids
+
+    def _encode_vae_image(self, image, generator=None):
+        """Stub VAE encode: (B, 3, H, W) in [-1, 1] -> (B, 3, H/16, W/16) "latents"."""
+        self.vae_encode_calls += 1
+        if self.vae_time:
+            time.sleep(self.vae_time)
+        return torch.nn.functional.avg_pool2d(image, PATCH)
+
+    def preprocess(self, image, height, width):
+        image = image.convert("RGB").resize((width, height), Image.BICUBIC)
+        pixels = torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8).float()
+        return (pixels.reshape(1, height, width, 3).permute(0, 3, 1, 2) / 127.5) - 1
+
+    def prepare_latents(self, batch_size, height, width, generator):
+        shape = (1, (height // PATCH) * (width // PATCH), LATENT_CHANNELS)
+        generators = generator if isinstance(generator, list) else [generator] * batch_size
+        return torch.cat([torch.randn(shape, generator=g) for g in generators])
+
+    def decode(self, latents, height, width):
+        """Turns packed latents into PIL images through the stub VAE."""
+        grid = latents.reshape(latents.shape[0], height // PATCH, width // PATCH, -1).permute(0, 3, 1, 2)
+        sample = self.vae.decode(grid, return_dict=False)[0]
+        pixels = ((sample + 1) * 127.5).clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1)
+        return [Image.fromarray(item.numpy(), "RGB") for item in pixels]
+
+    def __call__(self, prompt=None, prompt_embeds=None, image=None, height=1024, width=1024,
+                 num_inference_steps=4, sigmas=None, guidance_scale=1.0, generator=None,
+                 max_sequence_length=512, callback_on_step_end=None,
+                 callback_on_step_end_tensor_inputs=("latents",), output_type="pil", **kwargs):
+        if prompt_embeds is None:
+            prompt_embeds, _ = self.encode_prompt(prompt, max_sequence_length=max_sequence_length)
+        batch_size = prompt_embeds.shape[0]
+        self.batch_sizes.append(batch_size)
+        self._interrupt = False
+
+        if generator is None:
+            generator = torch.Generator("cpu").manual_seed(0)
+        latents = self.prepare_latents(batch_size, height, width, generator)
+        conditioning = prompt_embeds.mean(dim=1, keepdim=True)[..., :1].to(latents.dtype)
+        if image is not None:
+            image_latents = self._encode_vae_image(self.preprocess(image, height, width), generator)
+            packed = image_latents.flatten(2).transpose(1, 2)
+            latents[..., :3] = latents[..., :3] * 0.5 + packed.to(latents.dtype)
+
+        timesteps = sigmas if sigmas is not None else [1.0 - i / num_inference_steps for i in range(num_inference_steps)]
+        self.num_timesteps = len(timesteps)
+        for i, t in enumerate(timesteps):
+            if self._interrupt:
+                continue
+            if self.step_time:
+                time.sleep(self.step_time)
+            update = self.transformer(latents.to(torch.bfloat16)).to(latents.dtype)
+            latents = latents * 0.9 + conditioning * 0.1 + update * 0.1
+            if callback_on_step_end is not None:
+                tensors = {"latents": latents}
+                callback_kwargs = {k: tensors[k] for k in callback_on_step_end_tensor_inputs if k in tensors}
+                callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+                latents = (callback_outputs or {}).get("latents", latents)
+
+        if output_type == "latent":
+            return SimpleNamespace(images=latents)
+        return SimpleNamespace(images=self.decode(latents, height, width))
@@ -0,0 +1,171 @@
+import sys
+import threading
+import time
+from collections import deque
+
+import psutil
+
+# --- SHARED SYSTEM MONITOR ---
+# One background thread samples CPU/RAM/VRAM (and GPU load/temperature when
+# NVML is available) into a fixed-size ring buffer. Every browser tab is served
+# the same snapshot, and the rendered HTML is reused until the numbers change.
+
+GB = 1024**3
+
+
+def nvml_probe():
+    """Returns a probe for (util %, temp °C, used bytes, total bytes) of GPU 0, or None."""
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+    except Exception:
+        return None
+
+    def probe():
+        util = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu
+        temp = pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
+        memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        return util, temp, memory.used, memory.total
+
+    return probe
+
+
+def torch_vram_probe():
+    """(used, total) VRAM via torch, but only once something else has imported torch."""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    free, total = torch.cuda.mem_get_info()
+    return total - free, total
+
+
+def default_probes():
+    probes = {
+        "cpu": lambda: psutil.cpu_percent(interval=None),
+        "ram": lambda: psutil.virtual_memory().percent,
+        "vram": torch_vram_probe,
+        "gpu": None,
+    }
+    gpu = nvml_probe()
+    if gpu is not None:
+        probes["gpu"] = gpu
+        probes["vram"] = lambda: gpu()[2:]
+    return probes
+
+
+class SystemSampler:
+    """Samples system stats on a fixed interval into a ring buffer.
+
+    `probes` maps "cpu", "ram", "vram" and "gpu" to callables (see default_probes);
+    `clock` supplies timestamps. Pass `start=False` and call `sample()` by hand to
+    drive it with fake probes and a fake clock.
+    """
+
+    def __init__(self, interval=1.0, history=60, probes=None, clock=time.monotonic, start=True):
+        self.interval = interval
+        self.probes = probes or default_probes()
+        self.clock = clock
+        self.history = deque(maxlen=history)
+        self.last_peak = None
+        self._render_key = None
+        self._render_html = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if start:
+            self.start()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="system-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _read(self, name):
+        probe = self.probes.get(name)
+        if probe is None:
+            return None
+        try:
+            return probe()
+        except Exception:
+            return None
+
+    def sample(self):
+        """Takes one reading and appends it to the history."""
+        snapshot = {"time": self.clock(), "cpu": self._read("cpu"), "ram": self._read("ram")}
+        vram = self._read("vram")
+        snapshot["vram_used"], snapshot["vram_total"] = vram if vram else (None, None)
+        gpu = self._read("gpu")
+        snapshot["gpu_util"], snapshot["gpu_temp"] = gpu[:2] if gpu else (None, None)
+        with self._lock:
+            self.history.append(snapshot)
+        return snapshot
+
+    def snapshot(self):
+        with self._lock:
+            return self.history[-1] if self.history else None
+
+    def series(self, key):
+        with self._lock:
+            return [s[key] for s in self.history if s[key] is not None]
+
+    def mark_generation(self, start, end=None, peak_vram=None):
+        """Records the VRAM peak of a generation between clock times `start` and `end`.
+
+        The peak is taken from the samples in that window, or `peak_vram` if larger.
+        """
+        end = self.clock() if end is None else end
+        with self._lock:
+            used = [s["vram_used"] for s in self.history
+                    if s["vram_used"] is not None and start <= s["time"] <= end]
+        peak = max(used + ([peak_vram] if peak_vram else []), default=None)
+        if peak is not None:
+            self.last_peak = {"time": end, "vram": peak}
+        return peak
+
+    def render(self, render_fn, extra_key=None):
+        """Returns `render_fn(sampler)`, re-rendering only when the displayed numbers change."""
+        latest = self.snapshot()
+        key = (
+            extra_key, self.last_peak and round(self.last_peak["vram"] / GB, 1),
+            None if latest is None else tuple(
+                round(latest[k] / GB, 1) if k == "vram_used" and latest[k] is not None else latest[k]
+                for k in ("cpu", "ram", "vram_used", "gpu_util", "gpu_temp")
+            ),
+        )
+        with self._lock:
+            if key == self._render_key and self._render_html is not None:
+                return self._render_html
+        html = render_fn(self)
+        with self._lock:
+            self._render_key, self._render_html = key, html
+        return html
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+
+def sparkline_svg(values, color, maximum=None, marker=None, width=60, height=16):
+    """Tiny inline SVG line chart; `marker` draws a dashed line at that value."""
+    if len(values) < 2:
+        return ""
+    top = maximum or max(max(values), marker or 0) or 1
+    step = width / (len(values) - 1)
+    points = " ".join(
+        f"{i * step:.1f},{height - min(v, top) / top * (height - 2) - 1:.1f}" for i, v in enumerate(values)
+    )
+    marker_line = ""
+    if marker:
+        y = height - min(marker, top) / top * (height - 2) - 1
+        marker_line = (f'<line x1="0" y1="{y:.1f}" x2="{width}" y2="{y:.1f}" stroke="{color}" '
+                       f'stroke-width="1" stroke-dasharray="2,2" opacity="0.6"/>')
+    return (
+        f'<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}" style="vertical-align:middle;">'
+        f'{marker_line}<polyline points="{points}" fill="none" stroke="{color}" stroke-width="1.5" '
+        f'stroke-linejoin="round" stroke-linecap="round"/></svg>'
+    )
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def engine(tmp_path_factory):
+    """engine.py on the stub pipeline, with outputs and caches in a temporary folder."""
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("engine"))
+    try:
+        import engine
+        engine.result_cache = None  # Identical requests must really run
+        engine.load_model(stub=True)
+        yield engine
+    finally:
+        os.chdir(previous)
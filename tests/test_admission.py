@@ -0,0 +1,148 @@
+from admission import AdmissionController, IdlePolicy, MemoryPredictor, megapixels
+
+GB = 1024**3
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def controller(free, reclaimable=0, use_prior=True, samples=()):
+    predictor = MemoryPredictor()
+    for mp, peak in samples:
+        predictor.observe("key", mp, peak)
+    clock = FakeClock()
+    admission = AdmissionController(predictor, lambda: (free, reclaimable), clock=clock, sleep=clock.sleep,
+                                    use_prior=use_prior)
+    return admission, clock
+
+
+def test_downscaled_size_keeps_the_margin():
+    admission, _ = controller(free=6 * GB)
+    decision = admission.decide("key", 2560, 2560)
+    assert decision["action"] == "downscale"
+    need = admission.need("key", decision["width"], decision["height"])
+    assert need <= decision["available"] * (1 - admission.predictor.margin)
+    assert admission.wait("key", decision["width"], decision["height"], timeout=120)
+
+
+def test_wait_returns_at_once_when_nothing_is_reclaimable():
+    admission, clock = controller(free=1 * GB)
+    assert not admission.wait("key", 2048, 2048, timeout=120)
+    assert clock.now == 0.0
+
+
+def test_wait_polls_while_memory_can_come_back():
+    admission, clock = controller(free=1 * GB, reclaimable=1 * GB)
+    assert not admission.wait("key", 2048, 2048, timeout=10, poll=1)
+    assert clock.now >= 10
+
+
+def test_uncalibrated_prior_is_ignored_without_use_prior():
+    admission, _ = controller(free=1 * GB, use_prior=False)
+    assert admission.decide("key", 2560, 2560)["action"] == "admit"
+    assert admission.max_batch("key", 1024, 1024, 4) == 4
+    assert admission.wait("key", 2560, 2560)
+
+
+def test_calibrated_key_is_checked_without_use_prior():
+    samples = [(megapixels(1024, 1024), 2 * GB), (megapixels(2048, 2048), 8 * GB)]
+    admission, _ = controller(free=4 * GB, use_prior=False, samples=samples)
+    assert admission.decide("key", 2560, 2560)["action"] == "downscale"
+    assert admission.max_batch("key", 1024, 1024, 4) == 1
+
+
+class Weights:
+    """unload/reload stand-ins that record the calls."""
+
+    def __init__(self, clock, reload_time=0.0):
+        self.clock = clock
+        self.reload_time = reload_time
+        self.calls = []
+
+    def unload(self):
+        self.calls.append("unload")
+        return True
+
+    def reload(self):
+        self.calls.append("reload")
+        self.clock.sleep(self.reload_time)
+
+
+def idle_policy(timeout=60, reload_time=0.0):
+    clock = FakeClock()
+    weights = Weights(clock, reload_time)
+    return IdlePolicy(weights.unload, weights.reload, timeout=timeout, clock=clock), weights, clock
+
+
+def test_weights_are_released_after_the_timeout():
+    policy, weights, clock = idle_policy()
+    clock.sleep(59)
+    assert not policy.tick()
+    clock.sleep(1)
+    assert policy.tick()
+    assert (policy.state, policy.unloads, weights.calls) == ("unloaded", 1, ["unload"])
+    assert not policy.tick()  # Already released
+
+
+def test_next_run_reloads_and_restarts_the_timer():
+    policy, weights, clock = idle_policy(reload_time=3)
+    clock.sleep(60)
+    policy.tick()
+    with policy.active():
+        assert policy.state == "loaded"
+        assert weights.calls == ["unload", "reload"]
+    assert policy.reload_seconds == 3
+    clock.sleep(59)
+    assert not policy.tick()
+    clock.sleep(1)
+    assert policy.tick()
+
+
+def test_nothing_is_released_while_a_run_is_in_flight():
+    policy, weights, clock = idle_policy()
+    with policy.active():
+        clock.sleep(600)
+        assert not policy.tick()
+    assert weights.calls == []
+    assert not policy.tick()  # The timer counts from the end of the run
+    clock.sleep(60)
+    assert policy.tick()
+
+
+def test_failed_unload_keeps_the_weights_and_zero_timeout_never_unloads():
+    policy, weights, clock = idle_policy()
+    policy.unload = lambda: False
+    clock.sleep(60)
+    assert not policy.tick()
+    assert policy.state == "loaded"
+    policy, weights, clock = idle_policy(timeout=0)
+    clock.sleep(10**6)
+    assert not policy.tick()
+    assert weights.calls == []
+
+
+def test_downscaled_result_is_served_from_the_result_cache(engine, monkeypatch, tmp_path):
+    from result_cache import ResultCache
+    monkeypatch.setattr(engine, "result_cache", ResultCache(str(tmp_path / "results")))
+    monkeypatch.setattr(engine.admission, "decide", lambda key, width, height, **kwargs: {
+        "action": "downscale", "width": 256, "height": 256, "need": GB, "available": GB})
+
+    def run():
+        request = engine.make_request("a red fox", width=512, height=512, seed=3)
+        return request, engine.submit(request).result(30)
+
+    first, image = run()
+    assert (first.width, first.height, first.cache_hit) == (256, 256, False)
+    engine.result_cache.flush()
+    second, cached = run()
+    assert second.cache_hit
+    assert second.cache_key == first.cache_key
+    assert cached.size == image.size == (256, 256)
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+import torch
+from PIL import Image
+
+from batching import PRIORITY_BATCH, BatchScheduler, GenerationCancelled, GenerationRequest, cancel_callback
+from stub_pipeline import StubPipeline
+
+TIMEOUT = 10
+
+
+class FakePipeline:
+    """run_batch stand-in: records every batch and returns one label per request."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, requests):
+        self.batches.append(list(requests))
+        return [r.prompt for r in requests]
+
+    @property
+    def batch_sizes(self):
+        return [len(batch) for batch in self.batches]
+
+
+def make_request(prompt="a cat", width=512, height=512, input_image=None, **kwargs):
+    return GenerationRequest(prompt, width, height, 4, 1.0, 1, input_image=input_image, **kwargs)
+
+
+def run_all(scheduler, requests):
+    futures = [scheduler.submit(r) for r in requests]
+    return [f.result(TIMEOUT) for f in futures]
+
+
+def test_requests_within_max_wait_merge_up_to_max_batch_size():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_batch_size=4, max_wait=0.5)
+    try:
+        prompts = [f"cat {i}" for i in range(6)]
+        assert run_all(scheduler, [make_request(p) for p in prompts]) == prompts
+    finally:
+        scheduler.close()
+    assert pipe.batch_sizes == [4, 2]
+
+
+def test_incompatible_keys_split():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_batch_size=4, max_wait=0.2)
+    try:
+        run_all(scheduler, [make_request(width=512), make_request(width=768), make_request(width=512),
+                            make_request(width=768, hires=True)])
+    finally:
+        scheduler.close()
+    assert sorted(pipe.batch_sizes) == [1, 1, 2]
+    for batch in pipe.batches:
+        assert len({r.batch_key() for r in batch}) == 1
+
+
+def test_equal_reference_images_share_a_batch():
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_batch_size=4, max_wait=0.2)
+    red = [Image.new("RGB", (64, 64), (255, 0, 0)) for _ in range(2)]  # Two objects, same pixels
+    blue = Image.new("RGB", (64, 64), (0, 0, 255))
+    try:
+        run_all(scheduler, [make_request(input_image=red[0]), make_request(input_image=red[1]),
+                            make_request(input_image=blue)])
+    finally:
+        scheduler.close()
+    assert sorted(pipe.batch_sizes) == [1, 2]
+
+
+class GatedPipeline(FakePipeline):
+    """Holds the first batch until `release` is set, so later requests stay queued."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, requests):
+        self.started.set()
+        self.release.wait(TIMEOUT)
+        return super().__call__(requests)
+
+
+def test_cancel_stops_a_running_pipeline_within_a_step():
+    step_time = 0.05
+    pipe = StubPipeline(step_time=step_time)
+    stopped = []
+
+    def run_batch(requests):
+        try:
+            return pipe(prompt=[r.prompt for r in requests], height=64, width=64, num_inference_steps=200,
+                        generator=torch.Generator("cpu").manual_seed(1),
+                        callback_on_step_end=cancel_callback(requests))
+        finally:
+            stopped.append(time.perf_counter())
+
+    scheduler = BatchScheduler(run_batch, max_wait=0)
+    request = make_request()
+    try:
+        future = scheduler.submit(request)
+        time.sleep(5 * step_time)
+        cancelled_at = time.perf_counter()
+        scheduler.cancel(request)
+        with pytest.raises(GenerationCancelled):
+            future.result(TIMEOUT)
+    finally:
+        scheduler.close()
+    assert stopped[0] - cancelled_at < 3 * step_time
+    assert scheduler.cancelled == 1
+
+
+def test_queued_request_fails_when_its_deadline_passes():
+    pipe = GatedPipeline()
+    scheduler = BatchScheduler(pipe, max_wait=0)
+    try:
+        scheduler.submit(make_request("running"))
+        assert pipe.started.wait(TIMEOUT)
+        request = make_request("queued", width=768, timeout=0.2)
+        started = time.perf_counter()
+        future = scheduler.submit(request)
+        with pytest.raises(GenerationCancelled):
+            future.result(TIMEOUT)
+        # The watchdog failed it while the first batch was still running
+        assert time.perf_counter() - started < 1.0
+        assert request.cancel_reason == "deadline"
+        assert not pipe.batches
+    finally:
+        pipe.release.set()
+        scheduler.close()
+    assert [r.prompt for batch in pipe.batches for r in batch] == ["running"]
+
+
+def test_interactive_request_runs_before_queued_batch_jobs():
+    pipe = GatedPipeline()
+    scheduler = BatchScheduler(pipe, max_wait=0)
+    try:
+        futures = [scheduler.submit(make_request("running"))]
+        assert pipe.started.wait(TIMEOUT)
+        # Different sizes, so nothing merges and the order is the scheduler's choice
+        for i in range(3):
+            futures.append(scheduler.submit(make_request(f"batch {i}", width=512 + 64 * i, priority=PRIORITY_BATCH)))
+        futures.append(scheduler.submit(make_request("click", width=1024)))
+        pipe.release.set()
+        for future in futures:
+            future.result(TIMEOUT)
+    finally:
+        pipe.release.set()
+        scheduler.close()
+    assert [batch[0].prompt for batch in pipe.batches] == ["running", "click", "batch 0", "batch 1", "batch 2"]
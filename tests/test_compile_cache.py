@@ -0,0 +1,152 @@
+import os
+
+import pytest
+import torch
+
+from compile_cache import ARTIFACTS_FILE, BucketCompiler, configure_cache, save_artifacts, snap_to_bucket
+
+BUCKETS = [(1024, 1024), (1152, 896), (896, 1152), (1216, 832), (832, 1216), (1344, 768), (768, 1344), (512, 512)]
+
+
+class TinyTransformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = torch.nn.Linear(8, 8)
+
+    def forward(self, hidden_states, encoder_hidden_states, timestep):
+        tokens = torch.cat([encoder_hidden_states, hidden_states], dim=1)
+        return self.proj(tokens)[:, -hidden_states.shape[1]:] + timestep[:, None, None]
+
+
+def run(module, batch, tokens):
+    torch.manual_seed(batch * 100 + tokens)
+    return module(torch.randn(batch, tokens, 8), torch.randn(batch, 5, 8), torch.rand(batch))
+
+
+def test_batch_and_token_counts_share_a_graph():
+    from torch._dynamo.utils import counters
+    torch._dynamo.reset()
+    counters.clear()
+    module = TinyTransformer()
+    compiler = BucketCompiler(module, [(512, 512)], backend="eager")
+    shapes = [(1, 16), (2, 16), (3, 16), (4, 16), (2, 24), (3, 40), (4, 48)]
+    for batch, tokens in shapes:
+        out = run(module, batch, tokens)
+        with compiler.eager():
+            assert torch.allclose(out, run(module, batch, tokens))
+    # Batch 1 is specialised, every other shape reuses one dynamic graph
+    assert counters["stats"]["unique_graphs"] <= 2
+    assert len(compiler.shapes) == len(shapes)
+    assert torch._dynamo.config.recompile_limit >= len(shapes) + 2
+
+
+@pytest.mark.parametrize("size, expected", [
+    ((1024, 1024), (1024, 1024)),      # Exact bucket
+    ((1000, 1000), (1024, 1024)),      # Same aspect, slightly smaller
+    ((1160, 900), (1152, 896)),
+    ((900, 1160), (896, 1152)),        # Portrait picks the portrait bucket
+    ((1400, 800), (1344, 768)),
+    ((1920, 1080), None),              # Right aspect, twice the area
+    ((600, 600), (512, 512)),          # Closer in area to the small square
+    ((640, 640), None),                # Between the squares, too far from both
+    ((2048, 512), None),               # No bucket within the aspect error
+    ((2048, 2048), None),              # Area more than 1.5x any bucket
+    ((256, 256), None),
+])
+def test_snap_to_bucket(size, expected):
+    assert snap_to_bucket(*size, BUCKETS) == expected
+
+
+def test_snap_limits_are_configurable():
+    assert snap_to_bucket(2048, 2048, BUCKETS, max_area_ratio=4.0) == (1024, 1024)
+    assert snap_to_bucket(1100, 1000, [(1024, 1024)]) == (1024, 1024)
+    assert snap_to_bucket(1100, 1000, [(1024, 1024)], max_aspect_error=0.05) is None
+
+
+class FakeArtifacts:
+    """torch.compiler.save/load_cache_artifacts stand-ins."""
+
+    def __init__(self, data=b"compiled kernels"):
+        self.data = data
+        self.loaded = []
+
+    def save(self):
+        return None if self.data is None else (self.data, {})
+
+    def load(self, data):
+        if data != self.data:
+            raise RuntimeError("corrupt artifacts")
+        self.loaded.append(data)
+
+
+@pytest.fixture
+def artifacts(monkeypatch):
+    fake = FakeArtifacts()
+    monkeypatch.setattr(torch.compiler, "save_cache_artifacts", fake.save, raising=False)
+    monkeypatch.setattr(torch.compiler, "load_cache_artifacts", fake.load, raising=False)
+    for name in ("TORCHINDUCTOR_CACHE_DIR", "TORCHINDUCTOR_FX_GRAPH_CACHE", "TORCHINDUCTOR_AUTOGRAD_CACHE"):
+        monkeypatch.delenv(name, raising=False)
+    return fake
+
+
+def test_saved_artifacts_are_loaded_on_the_next_start(tmp_path, artifacts):
+    cache_dir = str(tmp_path / "compile")
+    assert not configure_cache(cache_dir)  # First start: nothing saved yet
+    assert os.environ["TORCHINDUCTOR_CACHE_DIR"] == os.path.join(cache_dir, "inductor")
+    assert os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] == "1"
+    assert save_artifacts(cache_dir)
+    assert os.listdir(cache_dir) == [ARTIFACTS_FILE]  # Written atomically, no .tmp left over
+    assert configure_cache(cache_dir)
+    assert artifacts.loaded == [b"compiled kernels"]
+
+
+def test_unusable_artifacts_are_ignored(tmp_path, artifacts):
+    cache_dir = str(tmp_path)
+    with open(os.path.join(cache_dir, ARTIFACTS_FILE), "wb") as f:
+        f.write(b"from another torch version")
+    assert not configure_cache(cache_dir)
+    artifacts.data = None  # Nothing was compiled in this process
+    assert not save_artifacts(cache_dir)
+
+
+class HookedForward:
+    """Stand-in for an offload hook: wraps `module.forward` and restores it on removal."""
+
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        self.old_forward = module.forward
+        module.forward = self
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.old_forward(*args, **kwargs)
+
+    def remove(self):
+        self.module.forward = self.old_forward
+
+
+def test_install_compiles_the_forward_again_after_offload_hooks_change():
+    compiled = []
+
+    def compile_fn(forward, **kwargs):
+        compiled.append(forward)
+        return lambda *args, **kw: forward(*args, **kw)
+
+    module = TinyTransformer()
+    hook = HookedForward(module)
+    compiler = BucketCompiler(module, [(512, 512)], compile_fn=compile_fn)
+    assert not compiler.install()  # Still in place, no second compile
+    assert compiled == [hook]
+
+    # Switching strategy: the old hook restores the forward it wrapped, a new one wraps that
+    hook.remove()
+    assert module.forward == TinyTransformer.forward.__get__(module)
+    hook = HookedForward(module)
+    assert compiler.install()
+    assert compiled[-1] is hook
+    run(module, 2, 16)
+    assert hook.calls == 1
+    with compiler.eager():
+        run(module, 2, 16)
+    assert hook.calls == 2
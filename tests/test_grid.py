@@ -0,0 +1,68 @@
+from PIL import Image
+
+from batching import PRIORITY_BATCH, BatchScheduler
+from grid import contact_sheet, plan_grid, run_grid, submission_order
+
+PROMPTS = ["a red fox", "a blue whale"]
+TIMEOUT = 10
+
+
+def color(request):
+    return (request.seed % 256, request.steps * 10 % 256, len(request.prompt) * 7 % 256)
+
+
+class FakePipeline:
+    """run_batch stand-in: one solid image per request, coloured by its settings."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, requests):
+        self.batches.append(list(requests))
+        return [Image.new("RGB", (64, 48), color(r)) for r in requests]
+
+
+def run(engine, axis, values, max_batch_size=4, window=8):
+    pipe = FakePipeline()
+    scheduler = BatchScheduler(pipe, max_batch_size=max_batch_size, max_wait=0.2)
+    cells = plan_grid(engine.make_request, PROMPTS, axis, values, width=64, height=48, steps=4, seed=5,
+                      priority=PRIORITY_BATCH)
+    try:
+        finished = list(run_grid(scheduler.submit, cells, window, cancel=scheduler.cancel))
+    finally:
+        scheduler.close()
+    return cells, finished, pipe
+
+
+def test_seed_grid_is_submitted_at_batch_priority_and_batched(engine):
+    cells, finished, pipe = run(engine, "seed", [1, 2, 3, 4])
+    assert len(finished) == 8
+    assert all(r.priority == PRIORITY_BATCH for batch in pipe.batches for r in batch)
+    assert [len(batch) for batch in pipe.batches] == [4, 4]
+    for cell in cells:
+        assert cell.request.prompt == PROMPTS[cell.row]
+        assert cell.request.seed == [1, 2, 3, 4][cell.col]
+        assert cell.image.getpixel((0, 0)) == color(cell.request)
+
+
+def test_steps_grid_groups_cells_by_batch_key(engine):
+    cells, finished, pipe = run(engine, "steps", [2, 4, 8])
+    assert [cell.label for cell in submission_order(cells)] == ["steps 2"] * 2 + ["steps 4"] * 2 + ["steps 8"] * 2
+    assert [len(batch) for batch in pipe.batches] == [2, 2, 2]
+    for batch in pipe.batches:
+        assert len({r.steps for r in batch}) == 1
+    # Sweeps over anything but the seed share one seed
+    assert len({cell.request.seed for cell in cells}) == 1
+
+
+def test_contact_sheet_places_cells_by_row_and_column(engine):
+    cells, _, _ = run(engine, "seed", [1, 2, 3])
+    thumb, label_width, padding, header = 64, 100, 8, 24
+    sheet = contact_sheet(cells, PROMPTS, ["seed 1", "seed 2", "seed 3"], thumb_size=thumb,
+                          label_width=label_width, padding=padding)
+    thumb_h = 48
+    assert sheet.size == (label_width + 3 * (thumb + padding) + padding, header + 2 * (thumb_h + padding) + padding)
+    for cell in cells:
+        x = label_width + cell.col * (thumb + padding) + padding + thumb // 2
+        y = header + cell.row * (thumb_h + padding) + thumb_h // 2
+        assert sheet.getpixel((x, y)) == color(cell.request)
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+from PIL import Image
+
+from history import History
+from output_writer import OutputWriter
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    return str(tmp_path / "outputs")
+
+
+@pytest.fixture
+def history(outputs):
+    return History(os.path.join(outputs, ".history"), outputs, thumb_size=32)
+
+
+def save(outputs, name, prompt, seed, created, fmt="png"):
+    """Writes an output the way the app does and dates it `created` seconds after the epoch."""
+    writer = OutputWriter(outputs, fmt=fmt)
+    path = os.path.join(outputs, name + writer.extension)
+    writer.write(Image.new("RGB", (64, 48), (seed % 256, 0, 0)),
+                 {"prompt": prompt, "seed": seed, "steps": 4, "guidance": 1.0, "mode": "txt2img"}, path)
+    writer.close()
+    os.utime(path, (created, created))
+    return path
+
+
+def test_added_file_is_indexed_with_its_parameters(outputs, history):
+    path = save(outputs, "a", "a red fox in the snow", 42, 1000)
+    assert not os.path.exists(os.path.join(outputs, ".history"))  # Nothing until first use
+    assert history.add(path)
+    rows, cursor = history.page()
+    assert cursor is None
+    assert len(rows) == 1
+    row = rows[0]
+    assert (row["path"], row["prompt"], row["seed"], row["width"], row["height"], row["steps"]) == (
+        os.path.abspath(path), "a red fox in the snow", 42, 64, 48, 4)
+
+
+def test_pages_are_newest_first_and_do_not_overlap(outputs, history):
+    for i in range(10):
+        history.add(save(outputs, f"img{i}", f"prompt {i}", i, 1000 + i))
+    seeds, cursor = [], None
+    while True:
+        rows, cursor = history.page(cursor=cursor, limit=4)
+        seeds += [row["seed"] for row in rows]
+        if cursor is None:
+            break
+    assert seeds == list(range(9, -1, -1))
+
+
+def test_search_matches_word_prefixes(outputs, history):
+    history.add(save(outputs, "fox", "a red fox in the snow", 1, 1000))
+    history.add(save(outputs, "whale", "a blue whale", 2, 1001))
+    history.add(save(outputs, "cat", "ein Kätzchen im Schnee", 3, 1002, fmt="webp"))
+    assert [row["seed"] for row in history.page("fox")[0]] == [1]
+    assert [row["seed"] for row in history.page("bl wha")[0]] == [2]
+    assert [row["seed"] for row in history.page("Kätzchen")[0]] == [3]
+    assert history.page('"; DROP TABLE images')[0] == []
+    assert history.count() == 3
+
+
+def test_scan_indexes_new_files_and_prunes_missing_ones(outputs, history):
+    kept = save(outputs, "kept", "kept", 1, 1000)
+    gone = save(outputs, "gone", "gone", 2, 1001)
+    assert history.scan() == {"files": 2, "added": 2, "removed": 0}
+    assert history.scan()["added"] == 0  # Unchanged files are skipped
+    rows, _ = history.page()
+    thumbs = history.thumbnails(rows)
+    assert all(thumb is not None and os.path.exists(thumb) for thumb in thumbs)
+    gone_thumb = thumbs[[row["path"] for row in rows].index(os.path.abspath(gone))]
+
+    os.remove(gone)
+    assert history.scan() == {"files": 1, "added": 0, "removed": 1}
+    assert [row["path"] for row in history.page()[0]] == [os.path.abspath(kept)]
+    assert not os.path.exists(gone_thumb)
@@ -0,0 +1,81 @@
+import torch
+from PIL import Image
+
+from latent_cache import LatentCache
+from result_cache import image_digest
+from stub_pipeline import PATCH, StubPipeline
+
+RED = Image.new("RGB", (96, 96), (255, 0, 0))
+BLUE = Image.new("RGB", (96, 96), (0, 0, 255))
+
+
+def img2img(pipe, cache, image, strength=0.6, size=64, steps=4):
+    """One stub img2img call, starting the schedule at `strength` the way the engine does."""
+    sigmas = [strength * (1.0 - i / steps) for i in range(steps)]
+    with cache.source(image_digest(image)):
+        return pipe(prompt="a cat", image=image, height=size, width=size, sigmas=sigmas,
+                    generator=torch.Generator("cpu").manual_seed(1), output_type="latent").images
+
+
+def make_pipe(**kwargs):
+    pipe = StubPipeline()
+    cache = LatentCache(**kwargs)
+    assert cache.install(pipe)
+    assert cache.install(pipe)  # Installing twice doesn't wrap twice
+    return pipe, cache
+
+
+def test_strength_sweep_encodes_the_source_once():
+    pipe, cache = make_pipe()
+    for strength in (0.3, 0.6, 0.9):
+        img2img(pipe, cache, RED, strength)
+    assert pipe.vae_encode_calls == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cached_latents_match_a_fresh_encode():
+    pipe, cache = make_pipe()
+    img2img(pipe, cache, RED)
+    cached = img2img(pipe, cache, RED)
+    assert pipe.vae_encode_calls == 1
+    fresh = StubPipeline()
+    with torch.no_grad():
+        expected = fresh(prompt="a cat", image=RED, height=64, width=64,
+                         sigmas=[0.6 * (1.0 - i / 4) for i in range(4)],
+                         generator=torch.Generator("cpu").manual_seed(1), output_type="latent").images
+    assert torch.equal(cached, expected)
+
+
+def test_key_changes_with_the_image_and_the_size():
+    pipe, cache = make_pipe()
+    img2img(pipe, cache, RED)
+    img2img(pipe, cache, Image.new("RGB", (96, 96), (255, 0, 0)))  # Another object, same pixels
+    assert pipe.vae_encode_calls == 1
+    img2img(pipe, cache, BLUE)
+    assert pipe.vae_encode_calls == 2
+    img2img(pipe, cache, RED, size=128)
+    assert pipe.vae_encode_calls == 3
+    assert cache.stats()["entries"] == 3
+
+
+def test_nothing_is_cached_outside_a_source_block():
+    pipe, cache = make_pipe()
+    for _ in range(2):
+        pipe(prompt="a cat", image=RED, height=64, width=64, output_type="latent")
+    assert pipe.vae_encode_calls == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_eviction_respects_the_byte_budget():
+    entry = 3 * (64 // PATCH) ** 2 * 4  # One float32 64x64 source latent
+    pipe, cache = make_pipe(max_bytes=2 * entry)
+    images = [Image.new("RGB", (96, 96), (i * 60, 0, 0)) for i in range(3)]
+    for image in images:
+        img2img(pipe, cache, image)
+    stats = cache.stats()
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert stats["entries"] == 2
+    img2img(pipe, cache, images[2])  # Most recent is kept
+    assert pipe.vae_encode_calls == 3
+    img2img(pipe, cache, images[0])  # Oldest was evicted
+    assert pipe.vae_encode_calls == 4
@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+import pytest
+
+from model_store import ensure_model, read_manifest
+
+REPO = "test/model"
+FILES = {
+    "model_index.json": b'{"_class_name": "Stub"}',
+    "transformer/config.json": b'{"layers": 2}',
+    "transformer/diffusion_pytorch_model-00001-of-00002.safetensors": bytes(range(256)) * 64,
+    "transformer/diffusion_pytorch_model-00002-of-00002.safetensors": bytes(range(255, -1, -1)) * 64,
+    "vae/diffusion_pytorch_model.safetensors": b"\x01\x02" * 1000,
+}
+
+
+def fetch_manifest(repo_id):
+    files = {rel: {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()} for rel, data in FILES.items()}
+    return {"repo_id": repo_id, "revision": "abc123", "files": files, "verified": {}}
+
+
+def offline(*args):
+    raise AssertionError("no network call expected")
+
+
+class FakeHub:
+    """download() stand-in that writes the original bytes and records what was asked for."""
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, model_dir, repo_id, revision, files):
+        self.requests.append(sorted(files))
+        for rel in files:
+            write(model_dir, rel, FILES[rel])
+
+
+def write(model_dir, rel, data):
+    path = os.path.join(model_dir, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    for rel, data in FILES.items():
+        write(str(tmp_path), rel, data)
+    ensure_model(str(tmp_path), REPO, download=offline, fetch_manifest=fetch_manifest, progress=lambda m: None)
+    return str(tmp_path)
+
+
+def test_clean_dir_makes_no_network_calls(model_dir):
+    manifest = ensure_model(model_dir, REPO, download=offline, fetch_manifest=offline, progress=lambda m: None)
+    assert sorted(manifest["verified"]) == sorted(FILES)
+    ensure_model(model_dir, REPO, full=True, download=offline, fetch_manifest=offline, progress=lambda m: None)
+
+
+def test_only_the_corrupt_and_missing_files_are_fetched(model_dir):
+    corrupt = "transformer/diffusion_pytorch_model-00002-of-00002.safetensors"
+    missing = "vae/diffusion_pytorch_model.safetensors"
+    data = bytearray(FILES[corrupt])
+    data[100] ^= 0xFF  # Same size, so only the checksum can tell
+    write(model_dir, corrupt, bytes(data))
+    os.utime(os.path.join(model_dir, corrupt), ns=(1, 1))
+    os.remove(os.path.join(model_dir, missing))
+
+    hub = FakeHub()
+    messages = []
+    ensure_model(model_dir, REPO, download=hub, fetch_manifest=offline, progress=messages.append)
+    assert hub.requests == [sorted([corrupt, missing])]
+    assert any("checksum mismatch" in m for m in messages)
+    for rel, data in FILES.items():
+        with open(os.path.join(model_dir, rel), "rb") as f:
+            assert f.read() == data
+    ensure_model(model_dir, REPO, download=offline, fetch_manifest=offline, progress=lambda m: None)
+
+
+def test_download_that_stays_damaged_raises(model_dir):
+    missing = "transformer/config.json"
+    os.remove(os.path.join(model_dir, missing))
+    with pytest.raises(RuntimeError, match="still damaged"):
+        ensure_model(model_dir, REPO, download=lambda *args: None, fetch_manifest=offline, progress=lambda m: None)
+    assert read_manifest(model_dir)["revision"] == "abc123"
@@ -0,0 +1,34 @@
+import pytest
+
+from offload import ACTIVATION_RESERVE, GB, STRATEGIES, choose_strategy
+
+# Roughly FLUX.2 Klein 4B in bf16: 15GB of weights, the text encoder the largest part
+SIZES = {"transformer": 7 * GB, "text_encoder": 8 * GB, "vae": GB // 4}
+TOTAL = sum(SIZES.values())
+LARGEST = max(SIZES.values())
+
+
+@pytest.mark.parametrize("free_vram, free_ram, expected", [
+    (0, 64 * GB, "resident"),                                    # No CUDA
+    (TOTAL + ACTIVATION_RESERVE, 0, "resident"),                 # Exactly fits everything
+    (32 * GB, 64 * GB, "resident"),
+    (TOTAL + ACTIVATION_RESERVE - 1, TOTAL, "model"),            # One byte short of resident
+    (LARGEST + ACTIVATION_RESERVE, TOTAL, "model"),              # Exactly fits the largest component
+    (LARGEST + ACTIVATION_RESERVE - 1, TOTAL, "group"),          # One byte short of model
+    (4 * GB, TOTAL, "group"),
+    (4 * GB, TOTAL - 1, "disk"),                                 # RAM can't hold the weights either
+    (LARGEST + ACTIVATION_RESERVE, TOTAL - 1, "disk"),           # Enough VRAM for model, too little RAM
+])
+def test_thresholds(free_vram, free_ram, expected):
+    strategy, reason = choose_strategy(free_vram, free_ram, SIZES)
+    assert strategy == expected
+    assert strategy in STRATEGIES and reason
+
+
+def test_reserve_is_configurable():
+    assert choose_strategy(TOTAL, 64 * GB, SIZES, reserve=0)[0] == "resident"
+    assert choose_strategy(TOTAL, 64 * GB, SIZES)[0] == "model"
+
+
+def test_reason_reports_the_readings():
+    assert choose_strategy(4 * GB, TOTAL, SIZES)[1] == "only 4.0GB VRAM free, streaming blocks from RAM"
@@ -0,0 +1,112 @@
+import torch
+
+from batching import GenerationRequest
+from previews import PreviewCallback
+from stub_pipeline import LATENT_CHANNELS, StubPipeline
+
+WIDTH, HEIGHT = 128, 96
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_request(seed=1):
+    return GenerationRequest("a lighthouse at dusk", WIDTH, HEIGHT, 8, 1.0, seed)
+
+
+def latents():
+    return torch.randn(1, (HEIGHT // 16) * (WIDTH // 16), LATENT_CHANNELS)
+
+
+def run(pipe, callback=None, tensor_inputs=("latents",), seed=1, steps=8):
+    return pipe(
+        prompt="a lighthouse at dusk", height=HEIGHT, width=WIDTH, num_inference_steps=steps,
+        generator=torch.Generator("cpu").manual_seed(seed), callback_on_step_end=callback,
+        callback_on_step_end_tensor_inputs=list(tensor_inputs),
+    ).images[0]
+
+
+def test_previews_are_throttled_by_interval():
+    clock = FakeClock()
+    request = make_request()
+    received = []
+    request.on_preview = lambda image, step, total: received.append(step)
+    callback = PreviewCallback([request], HEIGHT, WIDTH, interval=0.5, max_overhead=1.0, clock=clock)
+    pipe = StubPipeline()
+    pipe.num_timesteps = 20
+    for step in range(19):
+        clock.now += 0.2  # One denoising step
+        callback(pipe, step, None, {"latents": latents()})
+    # A preview needs 0.5s since the last one, i.e. every third 0.2s step
+    assert received == [1, 4, 7, 10, 13, 16, 19]
+    assert callback.previews == len(received)
+    assert callback.skipped == 19 - len(received)
+
+
+def test_preview_overhead_stays_under_cap():
+    clock = FakeClock()
+    request = make_request()
+
+    def slow_preview(image, step, total):
+        clock.now += 0.1  # Each preview costs half a step
+
+    request.on_preview = slow_preview
+    callback = PreviewCallback([request], HEIGHT, WIDTH, interval=0.0, max_overhead=0.05, clock=clock)
+    pipe = StubPipeline()
+    pipe.num_timesteps = 200
+    for step in range(199):
+        clock.now += 0.2
+        callback(pipe, step, None, {"latents": latents()})
+    elapsed = clock.now - 0.0
+    assert callback.previews > 1
+    # The cap is checked before each preview, so it is exceeded by at most one preview
+    assert callback.overhead <= 0.05 * elapsed + 0.1
+    assert callback.skipped > callback.previews
+
+
+def test_no_preview_for_the_last_step():
+    request = make_request()
+    received = []
+    request.on_preview = lambda image, step, total: received.append(step)
+    callback = PreviewCallback([request], HEIGHT, WIDTH, interval=0.0, max_overhead=1.0, clock=FakeClock())
+    pipe = StubPipeline()
+    pipe.num_timesteps = 1
+    callback.clock.now = 1.0
+    callback(pipe, 0, None, {"latents": latents()})
+    assert received == []
+
+
+def test_final_image_identical_with_and_without_previews():
+    request = make_request()
+    received = []
+    request.on_preview = lambda image, step, total: received.append(image.size)
+    plain = run(StubPipeline())
+    previewed = run(StubPipeline(), PreviewCallback([request], HEIGHT, WIDTH, interval=0.0, max_overhead=1.0))
+    assert received, "expected at least one preview"
+    assert received[0] == (WIDTH, HEIGHT)
+    assert plain.tobytes() == previewed.tobytes()
+
+
+def test_without_latents_in_tensor_inputs_previews_are_skipped():
+    request = make_request()
+    received = []
+    request.on_preview = lambda image, step, total: received.append(step)
+    callback = PreviewCallback([request], HEIGHT, WIDTH, interval=0.0, max_overhead=1.0)
+    image = run(StubPipeline(), callback, tensor_inputs=())
+    assert received == []
+    assert callback.previews == 0
+    assert image.tobytes() == run(StubPipeline()).tobytes()
+
+
+def test_generate_stream_matches_generate(engine):
+    streamed = list(engine.generate_stream(engine.make_request("a fox", width=256, height=256, steps=6, seed=7)))
+    kind, final, _ = streamed[-1]
+    assert kind == "done"
+    assert all(kind == "preview" for kind, _, _ in streamed[:-1])
+    plain, _ = engine.generate(engine.make_request("a fox", width=256, height=256, steps=6, seed=7))
+    assert final.tobytes() == plain.tobytes()
@@ -0,0 +1,79 @@
+import torch
+
+from prompt_cache import PromptEmbeddingCache
+
+
+class StubEncoder:
+    """Text encoder stand-in: a fixed-size embedding per prompt, counting calls."""
+
+    def __init__(self, tokens=8, dim=16, dtype=torch.float32):
+        self.tokens = tokens
+        self.dim = dim
+        self.dtype = dtype
+        self.calls = []
+
+    def __call__(self, prompt):
+        self.calls.append(prompt)
+        seed = sum(map(ord, prompt))
+        return torch.full((1, self.tokens, self.dim), float(seed), dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        return self.tokens * self.dim * torch.tensor([], dtype=self.dtype).element_size()
+
+
+def test_hits_and_misses():
+    cache = PromptEmbeddingCache()
+    encoder = StubEncoder()
+    first = cache.get_or_encode("a cat", encoder)
+    second = cache.get_or_encode("a cat", encoder)
+    cache.get_or_encode("a dog", encoder)
+    assert encoder.calls == ["a cat", "a dog"]
+    assert torch.equal(first, second)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+    assert stats["hit_rate"] == 1 / 3
+
+
+def test_entries_are_kept_on_the_cpu():
+    cache = PromptEmbeddingCache()
+    embeds = cache.get_or_encode("a cat", StubEncoder(), device="cpu")
+    assert embeds.device.type == "cpu"
+    assert cache.stats()["bytes"] == StubEncoder().nbytes
+
+
+def test_byte_budget_evicts_least_recently_used():
+    encoder = StubEncoder()
+    cache = PromptEmbeddingCache(max_bytes=2 * encoder.nbytes)
+    cache.get_or_encode("one", encoder)
+    cache.get_or_encode("two", encoder)
+    cache.get_or_encode("one", encoder)  # "two" is now the least recently used
+    cache.get_or_encode("three", encoder)
+    assert cache.stats()["bytes"] <= cache.max_bytes
+    assert cache.stats()["entries"] == 2
+    encoder.calls.clear()
+    cache.get_or_encode("one", encoder)
+    cache.get_or_encode("two", encoder)
+    assert encoder.calls == ["two"]
+
+
+def test_entry_larger_than_budget_is_not_cached():
+    encoder = StubEncoder()
+    cache = PromptEmbeddingCache(max_bytes=encoder.nbytes - 1)
+    cache.get_or_encode("a cat", encoder)
+    cache.get_or_encode("a cat", encoder)
+    assert len(encoder.calls) == 2
+    assert cache.stats()["bytes"] == 0
+
+
+def test_key_includes_sequence_length_and_dtype():
+    cache = PromptEmbeddingCache()
+    encoder = StubEncoder()
+    cache.get_or_encode("a cat", encoder, max_sequence_length=512, dtype=torch.bfloat16)
+    cache.get_or_encode("a cat", encoder, max_sequence_length=256, dtype=torch.bfloat16)
+    cache.get_or_encode("a cat", encoder, max_sequence_length=512, dtype=torch.float16)
+    cache.get_or_encode("a cat", encoder, max_sequence_length=512, dtype=torch.bfloat16)
+    assert len(encoder.calls) == 3
+    assert PromptEmbeddingCache.make_key("a cat", 512, torch.bfloat16) != PromptEmbeddingCache.make_key(
+        "a cat", 512, torch.float16
+    )
@@ -0,0 +1,66 @@
+import torch
+from torch import nn
+
+from quantization import Int8Linear, load_quantized, quantize_model, save_quantized
+
+
+def linear_stack():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(128, 256), nn.GELU(), nn.Linear(256, 64)).to(torch.bfloat16)
+
+
+def test_int8_weights_stay_within_one_step():
+    model = linear_stack()
+    originals = [layer.weight.detach().float().clone() for layer in (model[0], model[2])]
+    summary = quantize_model(model, "int8")
+    assert summary["layers"] == 2
+    assert summary["bytes_after"] < 0.6 * summary["bytes_before"]
+    for layer, weight in zip((model[0], model[2]), originals):
+        assert isinstance(layer, Int8Linear)
+        error = (layer.dequantize(torch.float32) - weight).abs()
+        # Half a step from rounding, up to half another from storing the scale in bf16
+        assert (error <= layer.scale.float()[:, None]).all()
+
+
+def test_int8_outputs_track_bf16():
+    model = linear_stack()
+    x = torch.randn(8, 128, dtype=torch.bfloat16)
+    expected = model(x).float()
+    quantize_model(model, "int8")
+    actual = model(x).float()
+    assert (actual - expected).norm() / expected.norm() < 0.02
+
+
+def test_saved_checkpoint_loads_into_an_empty_skeleton(tmp_path):
+    model = linear_stack()
+    quantize_model(model, "int8")
+    path = str(tmp_path / "int8" / "model.safetensors")
+    save_quantized(model, path)
+    with torch.device("meta"):
+        skeleton = linear_stack()
+    load_quantized(skeleton, path, "int8")
+    x = torch.randn(4, 128, dtype=torch.bfloat16)
+    assert torch.equal(skeleton(x), model(x))
+
+
+def generate(engine, prompt="a red fox in the snow"):
+    request = engine.make_request(prompt, width=128, height=128, steps=2, seed=7)
+    return engine.generate(request)[0]
+
+
+def test_set_quantization_round_trips(engine):
+    before = generate(engine)
+    try:
+        assert "int8" in engine.set_quantization("int8")
+        assert engine.model_revision == "stub:int8"
+        assert engine.quantization_summary["transformer"]["layers"] == 2
+        # The prompt cached in bf16 is encoded again by the new weights' encoder
+        assert engine.pipe.encode_calls == 0
+        quantized = generate(engine)
+        assert engine.pipe.encode_calls == 1
+        assert quantized.tobytes() != before.tobytes()
+    finally:
+        engine.set_quantization("bf16")
+    assert engine.model_revision == "stub"
+    assert not engine.quantization_summary
+    assert generate(engine).tobytes() == before.tobytes()
@@ -0,0 +1,60 @@
+import torch
+
+from stub_pipeline import PATCH, StubVAE
+from tiled_vae import TiledDecoder, TiledVAE, tile_size_for_budget, tile_starts
+
+
+def latents(height, width):
+    return torch.randn(1, 16, height, width, generator=torch.Generator().manual_seed(height * width))
+
+
+def decode_peak(budget, height, width, enabled=True):
+    """Peak bytes of a single StubVAE decode call for a latent of height x width."""
+    vae = StubVAE()
+    tiled = TiledVAE(budget_bytes=budget, overlap=4, scale=PATCH)
+    tiled.install(vae)
+    with tiled.active(enabled):
+        sample = vae.decode(latents(height, width)).sample
+    assert sample.shape[-2:] == (height * PATCH, width * PATCH)
+    return vae.peak_bytes, tiled
+
+
+def test_peak_follows_tile_size_not_image_size():
+    budget = 64 * 1024**2
+    tile = tile_size_for_budget(budget, PATCH)
+    small, _ = decode_peak(budget, tile * 2, tile * 2)
+    large, tiled = decode_peak(budget, tile * 4, tile * 6)
+    assert tiled.tiles_decoded > 4
+    assert small == large
+    assert large <= 3 * (tile * PATCH) ** 2 * 4  # One float32 RGB tile
+
+
+def test_peak_grows_with_tile_size():
+    small_budget, large_budget = 1024**3, 4 * 1024**3
+    small_side, large_side = tile_size_for_budget(small_budget, PATCH), tile_size_for_budget(large_budget, PATCH)
+    assert small_side < large_side < 128
+    small_tile, _ = decode_peak(small_budget, 128, 128)
+    large_tile, _ = decode_peak(large_budget, 128, 128)
+    assert small_tile == 3 * (small_side * PATCH) ** 2 * 4
+    assert large_tile == 3 * (large_side * PATCH) ** 2 * 4
+
+
+def test_untiled_peak_follows_image_size():
+    small, _ = decode_peak(16 * 1024**2, 64, 64, enabled=False)
+    large, _ = decode_peak(16 * 1024**2, 128, 128, enabled=False)
+    assert large == 4 * small
+
+
+def test_tiled_decode_matches_full_decode():
+    vae = StubVAE()
+    z = latents(40, 56)
+    full = vae.decode(z).sample
+    tiled = TiledDecoder(lambda t: vae.decode(t, return_dict=False)[0], tile_size=16, overlap=4).decode(z)
+    assert torch.allclose(full, tiled, atol=1e-5)
+
+
+def test_tile_starts_cover_the_whole_length():
+    for length in (16, 17, 40, 100):
+        starts = tile_starts(length, 16, 4)
+        assert starts[0] == 0 and starts[-1] == max(0, length - 16)
+        assert all(b - a <= 12 for a, b in zip(starts, starts[1:]))
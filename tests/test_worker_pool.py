@@ -0,0 +1,99 @@
+import os
+import signal
+import time
+from multiprocessing import shared_memory
+
+import pytest
+from PIL import Image
+
+from batching import GenerationRequest
+from worker_pool import WorkerPool, receive_image, share_image
+
+TIMEOUT = 60
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.05)
+
+
+def make_request(seed=3):
+    return GenerationRequest("a lighthouse at dusk", 128, 96, 2, 1.0, seed)
+
+
+@pytest.fixture
+def start_pool(tmp_path, monkeypatch):
+    """Starts a pool of CPU stub workers in a scratch directory; closes it afterwards."""
+    monkeypatch.chdir(tmp_path)
+    pools = []
+
+    def start(**kwargs):
+        pool = WorkerPool(["cpu"], stub=True, poll_interval=0.05, **kwargs).start()
+        pools.append(pool)
+        wait_for(lambda: pool.workers[0].state == "ready")
+        return pool
+
+    yield start
+    for pool in pools:
+        pool.close(timeout=5)
+
+
+def kill_with_job(pool, request):
+    """Kills the worker and hands it `request` before the pool can notice."""
+    worker = pool.workers[0]
+    with pool._lock:
+        os.kill(worker.process.pid, signal.SIGKILL)
+        worker.process.join(TIMEOUT)
+        pool.submit(request)
+        assert list(worker.in_flight.values()) == [request]
+    return worker
+
+
+def test_results_come_back_through_shared_memory_and_are_unlinked():
+    image = Image.new("RGB", (64, 48), (200, 40, 10))
+    name, length, size, mode = share_image(image)
+    received = receive_image(name, length, size, mode)
+    assert received.tobytes() == image.tobytes() and received.size == image.size
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_dispatches_to_a_stub_worker(start_pool, engine):
+    pool = start_pool()
+    request = make_request()
+    image = pool.submit(request).result(TIMEOUT)
+    expected = engine.generate(make_request())[0]
+    assert image.tobytes() == expected.tobytes()
+    assert pool.workers[0].completed == 1 and not pool.workers[0].in_flight
+
+
+def test_killed_worker_restarts_with_backoff_and_retries_its_job(start_pool):
+    pool = start_pool(restart_backoff=0.5, max_retries=1)
+    request = make_request()
+    worker = kill_with_job(pool, request)
+    wait_for(lambda: worker.state == "backoff")
+    assert 0 < worker.restart_at - time.monotonic() <= 0.5
+    assert worker.crashes == 1 and worker.restarts == 0
+    assert request.future.result(TIMEOUT).size == (128, 96)
+    assert worker.restarts == 1 and worker.crashes == 0
+
+
+def test_job_lost_past_max_retries_fails(start_pool):
+    pool = start_pool(restart_backoff=0.5, max_retries=0)
+    request = make_request()
+    kill_with_job(pool, request)
+    with pytest.raises(RuntimeError, match="Job lost"):
+        request.future.result(TIMEOUT)
+
+
+def test_worker_is_given_up_after_max_restarts(start_pool):
+    pool = start_pool(max_restarts=0)
+    request = make_request()
+    worker = kill_with_job(pool, request)
+    wait_for(lambda: worker.state == "failed")
+    with pytest.raises(RuntimeError, match="No worker could load the model"):
+        request.future.result(TIMEOUT)
+    assert worker.restarts == 0
@@ -0,0 +1,139 @@
+import math
+import threading
+from contextlib import contextmanager
+
+# --- TILED VAE DECODE ---
+# Decoding a large latent in one go needs activation memory proportional to the
+# whole output image. Here the latent is cut into overlapping tiles that are
+# decoded one at a time and blended into an output buffer on the CPU, so the
+# device only ever holds one tile's activations: peak memory follows the tile
+# size, not the image size. Overlaps are cross-faded with linear ramps to hide
+# seams.
+
+DECODER_BYTES_PER_PIXEL = 3 * 1024  # Rough decoder activation cost per output pixel (bf16)
+MIN_TILE = 16                       # Latent pixels
+MAX_TILE = 256
+
+
+def tile_size_for_budget(budget_bytes, scale=8, bytes_per_pixel=DECODER_BYTES_PER_PIXEL):
+    """Largest latent tile (multiple of 8) whose decode should fit in `budget_bytes`."""
+    output_side = math.sqrt(max(budget_bytes, 1) / bytes_per_pixel)
+    tile = int(output_side / scale) // 8 * 8
+    return max(MIN_TILE, min(MAX_TILE, tile))
+
+
+def tile_starts(length, tile, overlap):
+    """Start offsets covering `length` with tiles of `tile` overlapping by `overlap`."""
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_ramp(length, overlap, ramp_start, ramp_end):
+    """1D weights: linear ramps over `overlap` at the edges that touch another tile."""
+    import torch
+    weights = torch.ones(length)
+    if overlap > 0:
+        ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+        if ramp_start:
+            weights[:overlap] = ramp
+        if ramp_end:
+            weights[-overlap:] = ramp.flip(0)
+    return weights
+
+
+class TiledDecoder:
+    """Decodes (B, C, H, W) latents tile by tile with `decode_fn(tile) -> (B, 3, h, w)`."""
+
+    def __init__(self, decode_fn, tile_size=64, overlap=8, output_device="cpu"):
+        self.decode_fn = decode_fn
+        self.tile_size = tile_size
+        self.overlap = min(overlap, tile_size // 2)
+        self.output_device = output_device
+        self.tiles_decoded = 0
+
+    def decode(self, latents):
+        import torch
+        _, _, height, width = latents.shape
+        ys = tile_starts(height, self.tile_size, self.overlap)
+        xs = tile_starts(width, self.tile_size, self.overlap)
+        output = weight_sum = None
+        scale = None
+
+        for yi, y in enumerate(ys):
+            for xi, x in enumerate(xs):
+                tile = latents[:, :, y:y + self.tile_size, x:x + self.tile_size]
+                decoded = self.decode_fn(tile).to(self.output_device, torch.float32)
+                self.tiles_decoded += 1
+                if output is None:
+                    scale = decoded.shape[-1] // tile.shape[-1]
+                    output = torch.zeros(
+                        (decoded.shape[0], decoded.shape[1], height * scale, width * scale),
+                        dtype=torch.float32, device=self.output_device
+                    )
+                    weight_sum = torch.zeros((1, 1, height * scale, width * scale), device=self.output_device)
+                overlap = self.overlap * scale
+                wy = blend_ramp(decoded.shape[-2], overlap, yi > 0, yi < len(ys) - 1)
+                wx = blend_ramp(decoded.shape[-1], overlap, xi > 0, xi < len(xs) - 1)
+                weights = (wy[:, None] * wx[None, :]).to(self.output_device)
+                oy, ox = y * scale, x * scale
+                output[:, :, oy:oy + decoded.shape[-2], ox:ox + decoded.shape[-1]] += decoded * weights
+                weight_sum[:, :, oy:oy + decoded.shape[-2], ox:ox + decoded.shape[-1]] += weights
+                del decoded
+
+        return output / weight_sum.clamp_min(1e-6)
+
+
+class TiledVAE:
+    """Wraps `vae.decode` so decodes inside `active()` run tiled under a memory budget.
+
+    `scale` is the decoder's upsampling factor (8 for the Flux.2 VAE).
+    """
+
+    def __init__(self, budget_bytes=2 * 1024**3, overlap=8, scale=8):
+        self.budget_bytes = budget_bytes
+        self.overlap = overlap
+        self.scale = scale
+        self.tiles_decoded = 0
+        self._context = threading.local()
+
+    def tile_size(self):
+        return tile_size_for_budget(self.budget_bytes, self.scale)
+
+    @contextmanager
+    def active(self, enabled=True):
+        previous = getattr(self._context, "enabled", False)
+        self._context.enabled = enabled
+        try:
+            yield
+        finally:
+            self._context.enabled = previous
+
+    def install(self, vae):
+        original = vae.decode
+        if getattr(original, "tiled_vae", None) is self:
+            return
+
+        def decode(z, return_dict=True, *args, **kwargs):
+            tile = self.tile_size()
+            if not getattr(self._context, "enabled", False) or max(z.shape[-2:]) <= tile:
+                return original(z, return_dict, *args, **kwargs)
+            decoder = TiledDecoder(
+                lambda t: original(t, False, *args, **kwargs)[0], tile_size=tile, overlap=self.overlap
+            )
+            sample = decoder.decode(z).to(z.dtype)
+            self.tiles_decoded += decoder.tiles_decoded
+            if not return_dict:
+                return (sample,)
+            try:
+                from diffusers.models.autoencoders.vae import DecoderOutput
+                return DecoderOutput(sample=sample)
+            except ImportError:
+                from types import SimpleNamespace
+                return SimpleNamespace(sample=sample)
+
+        decode.tiled_vae = self
+        vae.decode = decode
@@ -0,0 +1,449 @@
+import contextlib
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import connection, shared_memory
+
+from PIL import Image
+
+from batching import GenerationCancelled
+
+# --- WORKER POOL ---
+# One pipeline per process: every worker process loads its own copy of the
+# model on one device (CUDA_VISIBLE_DEVICES is set before torch is imported)
+# and runs requests through its own batch scheduler. The parent dispatches each
+# request to the ready worker with the fewest jobs in flight (then the most free
+# memory), watches the processes, and restarts a worker that died or stopped
+# making progress, putting its unfinished jobs back in the queue. Restarts back
+# off exponentially, and a worker that keeps crashing before it gets ready is
+# given up on. Each worker reports over its own pipe, made new on every start,
+# so a worker killed halfway through a message can't garble another's, and it
+# sends a heartbeat after every denoising step, so only a run that stops making
+# steps counts as hung, however long it is.
+# Finished images come back through shared memory: the worker copies the raw
+# pixels into a SharedMemory block and only its name is sent over the pipe.
+
+WORKER_MEMORY = 18 * 1024**3  # VRAM one worker needs (weights + activations), for "auto" per device
+MAX_IN_FLIGHT = 8             # Jobs queued on one worker (enough to fill its batches)
+HEARTBEAT_INTERVAL = 1.0      # Seconds between a worker's progress messages while it runs steps
+RESTART_BACKOFF = 1.0         # Seconds before the first restart, doubled per crash in a row
+MAX_BACKOFF = 60.0
+MAX_RESTARTS = 5              # Crashes in a row (without getting ready) before a worker is given up
+
+
+def detect_devices(per_device="auto", worker_memory=WORKER_MEMORY):
+    """One entry per worker: "cuda:N" repeated per worker on that GPU, or ["cpu"]."""
+    import torch
+    if not torch.cuda.is_available():
+        return ["cpu"]
+    devices = []
+    for index in range(torch.cuda.device_count()):
+        count = per_device
+        if per_device == "auto":
+            count = max(1, torch.cuda.get_device_properties(index).total_memory // worker_memory)
+        devices.extend([f"cuda:{index}"] * int(count))
+    return devices
+
+
+def share_image(image):
+    """Copies a PIL image's pixels into a new shared memory block; returns its handle."""
+    data = image.tobytes()
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        block.buf[:len(data)] = data
+        return block.name, len(data), image.size, image.mode
+    finally:
+        block.close()
+
+
+def receive_image(name, length, size, mode):
+    """Rebuilds an image from `share_image`'s handle and frees the shared block."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return Image.frombytes(mode, size, bytes(block.buf[:length]))
+    finally:
+        block.close()
+        block.unlink()
+
+
+def pack_image(image):
+    return None if image is None else (image.mode, image.size, image.tobytes())
+
+
+def unpack_image(packed):
+    return None if packed is None else Image.frombytes(*packed)
+
+
+def free_vram():
+    import torch
+    return torch.cuda.mem_get_info()[0] if torch.cuda.is_available() else 0
+
+
+def worker_main(worker_id, device, stub, jobs, results):
+    """Worker process: loads a pipeline, then runs jobs until it receives None.
+
+    `results` is the sending end of this worker's pipe to the parent.
+    """
+    if device.startswith("cuda:"):
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":", 1)[1]
+    send_lock = threading.Lock()
+    last_beat = [0.0]
+
+    def send(kind, job_id=None, payload=None):
+        with send_lock:  # Messages come from this loop and from the scheduler thread
+            results.send((kind, worker_id, job_id, payload))
+
+    def heartbeat():
+        now = time.monotonic()
+        if now - last_beat[0] >= HEARTBEAT_INTERVAL:
+            last_beat[0] = now
+            send("progress")
+
+    import engine
+    engine.result_cache = None  # The parent looks results up before dispatching
+    engine.step_hooks.append(heartbeat)
+    status = engine.load_model(stub=stub)
+    if status != "Ready":
+        send("error", payload=status)
+        return
+    send("ready", payload=(engine.model_revision, free_vram()))
+
+    running = {}  # job_id -> request, for cancel messages
+
+    def finished(job_id, request, future):
+        running.pop(job_id, None)
+        try:
+            image = future.result()
+            handle = share_image(image)
+            trace = request.trace.to_dict() if request.trace is not None and request.trace.enabled else None
+            send("done", job_id, (handle, request.batch_size, request.requested_size, free_vram(), trace))
+        except GenerationCancelled as e:
+            send("cancelled", job_id, e.reason)
+        except Exception as e:
+            send("failed", job_id, f"{e}")
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if job[0] == "cancel":
+            _, job_id, reason = job
+            if job_id in running:
+                engine.cancel(running[job_id], reason)
+            continue
+        job_id, params, packed_image = job
+        try:
+            request = engine.make_request(input_image=unpack_image(packed_image), **params)
+            running[job_id] = request
+            future = engine.submit(request)
+            future.add_done_callback(lambda f, job_id=job_id, request=request: finished(job_id, request, f))
+        except Exception:
+            send("failed", job_id, traceback.format_exc(limit=1))
+
+
+@contextlib.contextmanager
+def without_main_module():
+    """Spawned children re-import the parent's __main__ (app.py builds the whole UI at
+    import); hiding it while a worker starts means they only import this module."""
+    main = sys.modules["__main__"]
+    saved = {name: getattr(main, name) for name in ("__spec__", "__file__") if hasattr(main, name)}
+    main.__spec__ = None
+    if hasattr(main, "__file__"):
+        del main.__file__
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(main, name, value)
+
+
+class Worker:
+    """Parent-side handle of one worker process."""
+
+    def __init__(self, worker_id, device):
+        self.worker_id = worker_id
+        self.device = device
+        self.process = None
+        self.jobs = None
+        self.results = None  # Receiving end of this process's pipe
+        self.state = "stopped"
+        self.in_flight = {}  # job_id -> request
+        self.free_vram = 0
+        self.last_progress = time.monotonic()
+        self.completed = 0
+        self.restarts = 0
+        self.crashes = 0  # In a row, since the worker was last ready
+        self.restart_at = None
+
+
+class WorkerPool:
+    """Dispatches GenerationRequests to worker processes; `submit` returns a Future.
+
+    `on_ready(model_revision)` is called once, when the first worker has loaded
+    its pipeline, and `on_done(request, trace)` before a finished request's
+    Future is resolved (`trace` is the worker's Trace.to_dict(), or None). A
+    worker with jobs in flight that sends nothing, heartbeats included, for
+    `progress_timeout` seconds is treated as stuck and restarted; a job lost in
+    `max_retries` crashes fails with RuntimeError.
+    """
+
+    def __init__(self, devices, stub=False, progress_timeout=300, max_retries=2, poll_interval=0.5,
+                 max_in_flight=MAX_IN_FLIGHT, on_ready=None, on_done=None, start_method="spawn",
+                 max_restarts=MAX_RESTARTS, restart_backoff=RESTART_BACKOFF):
+        self.stub = stub
+        self.progress_timeout = progress_timeout
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.max_in_flight = max_in_flight
+        self.on_ready = on_ready
+        self.on_done = on_done
+        self.max_restarts = max_restarts
+        self.restart_backoff = restart_backoff
+        self.workers = [Worker(i, device) for i, device in enumerate(devices)]
+        self._context = multiprocessing.get_context(start_method)
+        self._pending = deque()
+        self._lock = threading.RLock()
+        self._job_ids = itertools.count()
+        self._attempts = {}
+        self._ready_called = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="worker-pool", daemon=True)
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self._thread.start()
+        return self
+
+    def _spawn(self, worker):
+        worker.jobs = self._context.Queue()
+        worker.results, child_end = self._context.Pipe(duplex=False)
+        worker.process = self._context.Process(
+            target=worker_main, args=(worker.worker_id, worker.device, self.stub, worker.jobs, child_end),
+            name=f"flux-worker-{worker.worker_id}", daemon=True
+        )
+        with without_main_module():
+            worker.process.start()
+        child_end.close()  # Only the child holds the sending end, so its death shows up as EOF here
+        worker.state = "loading"
+        worker.restart_at = None
+        worker.last_progress = time.monotonic()
+        print(f"⏳ Worker {worker.worker_id} starting on {worker.device} (pid {worker.process.pid})...")
+
+    def submit(self, request):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is shut down")
+            request.submitted_at = time.perf_counter()
+            if request.timeout:
+                request.deadline = request.submitted_at + request.timeout
+            self._pending.append((next(self._job_ids), request))
+            self._dispatch()
+        return request.future
+
+    def cancel(self, request, reason="cancelled"):
+        """Drops a queued request, or asks its worker to stop it at the next step."""
+        request.cancel(reason)
+        with self._lock:
+            for entry in self._pending:
+                if entry[1] is request:
+                    self._pending.remove(entry)
+                    request.fail(GenerationCancelled(reason))
+                    return
+            for worker in self.workers:
+                for job_id, running in worker.in_flight.items():
+                    if running is request:
+                        worker.jobs.put(("cancel", job_id, reason))
+                        return
+
+    def _expire_pending(self):
+        now = time.perf_counter()
+        for entry in [e for e in self._pending if e[1].is_cancelled(now)]:
+            self._pending.remove(entry)
+            self._attempts.pop(entry[0], None)
+            entry[1].fail(GenerationCancelled(entry[1].cancel_reason))
+
+    def _dispatch(self):
+        """Hands the most urgent pending job to the least busy ready worker (ties: most free VRAM)."""
+        self._expire_pending()
+        while self._pending:
+            ready = [w for w in self.workers if w.state == "ready" and len(w.in_flight) < self.max_in_flight]
+            if not ready:
+                return
+            worker = min(ready, key=lambda w: (len(w.in_flight), -w.free_vram))
+            job_id, request = min(self._pending, key=lambda entry: (entry[1].priority, entry[0]))
+            self._pending.remove((job_id, request))
+            params = {
+                "prompt": request.prompt, "width": request.width, "height": request.height,
+                "steps": request.steps, "guidance": request.guidance, "seed": request.seed,
+                "strength": request.strength, "hires": request.hires, "priority": request.priority,
+                # The worker's scheduler enforces what is left of the deadline
+                "timeout": max(0.001, request.deadline - time.perf_counter()) if request.deadline else None,
+            }
+            if not worker.in_flight:
+                worker.last_progress = time.monotonic()
+            worker.in_flight[job_id] = request
+            worker.jobs.put((job_id, params, pack_image(request.input_image)))
+
+    def _loop(self):
+        while not self._closed:
+            with self._lock:
+                pipes = {w.results: w for w in self.workers if w.results is not None}
+            try:
+                for pipe in (connection.wait(list(pipes), timeout=self.poll_interval) if pipes
+                             else time.sleep(self.poll_interval) or []):
+                    worker = pipes[pipe]
+                    try:
+                        kind, _, job_id, payload = pipe.recv()
+                    except Exception:
+                        # The worker died (EOF) or was killed halfway through a message
+                        self._drop_pipe(worker, pipe)
+                        continue
+                    self._handle(worker, kind, job_id, payload)
+            except Exception as e:
+                print(f"❌ Worker pool error: {e}")
+            self._check_workers()
+
+    def _drop_pipe(self, worker, pipe):
+        with self._lock:
+            pipe.close()
+            if worker.results is pipe:
+                worker.results = None
+
+    def _handle(self, worker, kind, job_id, payload):
+        with self._lock:
+            worker.last_progress = time.monotonic()
+            if kind == "progress":
+                return
+            if kind == "ready":
+                revision, worker.free_vram = payload
+                worker.state = "ready"
+                worker.crashes = 0
+                print(f"✅ Worker {worker.worker_id} ready on {worker.device}.")
+                if not self._ready_called and self.on_ready is not None:
+                    self._ready_called = True
+                    self.on_ready(revision)
+            elif kind == "error":
+                print(f"❌ Worker {worker.worker_id} failed to load: {payload}")
+                worker.state = "failed"
+            else:
+                request = worker.in_flight.pop(job_id, None)
+                if request is None:
+                    # A job of a worker that was already restarted; free its pixels
+                    if kind == "done":
+                        receive_image(*payload[0])
+                elif kind == "done":
+                    handle, request.batch_size, requested_size, worker.free_vram, trace = payload
+                    worker.completed += 1
+                    self._attempts.pop(job_id, None)
+                    image = receive_image(*handle)
+                    if requested_size is not None:
+                        # The worker's admission control downscaled it
+                        request.requested_size = tuple(requested_size)
+                        request.width, request.height = image.size
+                    if self.on_done is not None:
+                        self.on_done(request, trace)
+                    if not request.future.done():
+                        request.future.set_result(image)
+                elif kind == "cancelled":
+                    self._attempts.pop(job_id, None)
+                    request.fail(GenerationCancelled(payload))
+                else:
+                    self._attempts.pop(job_id, None)
+                    request.fail(RuntimeError(payload))
+            self._dispatch()
+        self._fail_if_no_workers()
+
+    def _fail_if_no_workers(self):
+        if all(w.state == "failed" for w in self.workers):
+            self._fail_pending(RuntimeError("No worker could load the model"))
+
+    def _check_workers(self):
+        """Restarts workers that died or stopped making progress, with backoff."""
+        with self._lock:
+            now = time.monotonic()
+            for worker in self.workers:
+                if self._closed or worker.state in ("failed", "stopped"):
+                    continue
+                if worker.state == "backoff":
+                    if now >= worker.restart_at:
+                        worker.restarts += 1
+                        self._spawn(worker)
+                    continue
+                if worker.results is None and worker.process.is_alive():
+                    worker.process.join(1)  # The pipe's EOF usually arrives just before the exit
+                if not worker.process.is_alive():
+                    reason = f"exited with code {worker.process.exitcode}"
+                elif worker.results is None:
+                    reason = "broke its result pipe"
+                elif worker.in_flight and now - worker.last_progress > self.progress_timeout:
+                    reason = f"made no progress for {self.progress_timeout}s"
+                else:
+                    continue
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join(5)
+                if worker.results is not None:
+                    self._drop_pipe(worker, worker.results)
+                self._requeue(worker)
+                worker.crashes += 1
+                if worker.crashes > self.max_restarts:
+                    print(f"❌ Worker {worker.worker_id} on {worker.device} {reason}, "
+                          f"giving up after {self.max_restarts} restarts.")
+                    worker.state = "failed"
+                    continue
+                delay = min(MAX_BACKOFF, self.restart_backoff * 2 ** (worker.crashes - 1))
+                print(f"⚠️ Worker {worker.worker_id} on {worker.device} {reason}, restarting in {delay:.0f}s...")
+                worker.state = "backoff"
+                worker.restart_at = now + delay
+            self._dispatch()
+        self._fail_if_no_workers()
+
+    def _requeue(self, worker):
+        """Puts a lost worker's jobs back at the front of the queue (or fails them after max_retries)."""
+        for job_id, request in sorted(worker.in_flight.items(), reverse=True):
+            self._attempts[job_id] = self._attempts.get(job_id, 0) + 1
+            if self._attempts[job_id] > self.max_retries:
+                self._attempts.pop(job_id)
+                request.fail(RuntimeError(f"Job lost in {self.max_retries + 1} worker crashes"))
+            else:
+                self._pending.appendleft((job_id, request))
+        worker.in_flight.clear()
+
+    def _fail_pending(self, error):
+        with self._lock:
+            while self._pending:
+                _, request = self._pending.popleft()
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return [{
+                "worker": w.worker_id, "device": w.device, "state": w.state,
+                "pid": w.process.pid if w.process else None, "in_flight": len(w.in_flight),
+                "completed": w.completed, "restarts": w.restarts, "crashes": w.crashes, "free_vram": w.free_vram,
+            } for w in self.workers]
+
+    def close(self, timeout=10):
+        with self._lock:
+            self._closed = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.jobs.put(None)
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.kill()
+            worker.state = "stopped"
+            for request in worker.in_flight.values():
+                if not request.future.done():
+                    request.future.set_exception(RuntimeError("Worker pool is shut down"))
+            worker.in_flight.clear()
+        self._fail_pending(RuntimeError("Worker pool is shut down"))